@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import time
+import DupFinder.db
+import DupFinder.stats
+
+# Default location of the cache used by find_dups_in_dir --cache.
+DEFAULT_CACHE = os.path.join('~', '.dupfinder-cache.db')
+# Cache keeps at most that many files, least recently used are evicted.
+MAX_ENTRIES = 1000000
+# Files not used for that long (in seconds) are evicted.
+MAX_AGE = 90 * 24 * 60 * 60
+
+SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS Hashes (path TEXT PRIMARY KEY,
+                                       size INTEGER NOT NULL,
+                                       mtime INTEGER NOT NULL,
+                                       inode INTEGER,
+                                       algorithm TEXT NOT NULL,
+                                       partial_hash TEXT,
+                                       hash TEXT,
+                                       used REAL NOT NULL)
+    """
+GET_SQL = """
+    SELECT partial_hash, hash FROM Hashes
+    WHERE path = ? AND size = ? AND mtime = ? AND inode IS ? AND algorithm = ?
+    """
+# Hashes already known for unchanged file are kept, if file was not hashed
+# again (i.e. only its partial hash was needed this time).
+PUT_SQL = """
+    INSERT INTO Hashes(path, size, mtime, inode, algorithm, partial_hash,
+                       hash, used)
+    VALUES(:path, :size, :mtime, :inode, :algorithm, :partial_hash, :hash,
+           :used)
+    ON CONFLICT(path) DO UPDATE SET
+        partial_hash = CASE WHEN size = excluded.size
+                            AND mtime = excluded.mtime
+                            AND inode IS excluded.inode
+                            AND algorithm = excluded.algorithm
+            THEN coalesce(excluded.partial_hash, partial_hash)
+            ELSE excluded.partial_hash END,
+        hash = CASE WHEN size = excluded.size AND mtime = excluded.mtime
+                    AND inode IS excluded.inode
+                    AND algorithm = excluded.algorithm
+            THEN coalesce(excluded.hash, hash)
+            ELSE excluded.hash END,
+        size = excluded.size, mtime = excluded.mtime, inode = excluded.inode,
+        algorithm = excluded.algorithm, used = excluded.used
+    """
+TOUCH_SQL = """
+    UPDATE Hashes SET used = ? WHERE path = ?
+    """
+EVICT_OLD_SQL = """
+    DELETE FROM Hashes WHERE used < ?
+    """
+EVICT_LRU_SQL = """
+    DELETE FROM Hashes WHERE path IN
+        (SELECT path FROM Hashes ORDER BY used DESC LIMIT -1 OFFSET ?)
+    """
+
+
+class HashCache:
+    """
+    Persistent cache of file hashes, so unchanged files (same path, size,
+    modification time and inode) are not hashed again. It is kept in its own
+    sqlite database, independent from the index.
+    """
+
+    def __init__(self, cache_file, max_entries=MAX_ENTRIES, max_age=MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.db = sqlite3.connect(cache_file)
+        DupFinder.db.set_pragmas(self.db)
+        self.db.execute(SCHEMA_SQL)
+        self.db.commit()
+        self._used = set()
+
+    def get(self, entry, key, algorithm):
+        """
+        Returns cached value of key ('hash' or 'partial_hash') of file entry
+        or None if it is not known or file has changed. Entries without
+        modification time cannot be validated, so they are never cached.
+        """
+        if entry.get('mtime') is None:
+            return None
+        row = self.db.execute(GET_SQL, (entry['filepath'], entry['size'],
+                                        entry['mtime'], entry.get('inode'),
+                                        algorithm)).fetchone()
+        value = None
+        if row is not None:
+            value = row[0] if key == 'partial_hash' else row[1]
+        if value is None:
+            DupFinder.stats.add('cache_misses')
+            return None
+        DupFinder.stats.add('cache_hits')
+        self._used.add(entry['filepath'])
+        return value
+
+    def put(self, entries, algorithm):
+        """
+        Stores hashes of file entries (those that have any).
+        """
+        now = time.time()
+        self.db.executemany(PUT_SQL, (
+            {'path': e['filepath'], 'size': e['size'], 'mtime': e['mtime'],
+             'inode': e.get('inode'), 'algorithm': algorithm,
+             'partial_hash': e.get('partial_hash'), 'hash': e['hash'],
+             'used': now}
+            for e in entries if e.get('mtime') is not None
+            and (e['hash'] is not None or e.get('partial_hash') is not None)))
+        self.db.commit()
+
+    def close(self):
+        """
+        Records use of cached entries, evicts old and least recently used
+        ones and closes the cache.
+        """
+        now = time.time()
+        self.db.executemany(TOUCH_SQL, ((now, path) for path in self._used))
+        self.db.execute(EVICT_OLD_SQL, (now - self.max_age,))
+        self.db.execute(EVICT_LRU_SQL, (self.max_entries,))
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_cache(cache_file=DEFAULT_CACHE, max_entries=MAX_ENTRIES,
+               max_age=MAX_AGE):
+    """
+    Opens (or creates) hash cache file.
+
+    Parameters
+    ----------
+    cache_file: string
+        Path to cache file, ~ is expanded.
+    max_entries: int
+        Maximum number of files kept in cache.
+    max_age: int
+        Files not used for that many seconds are evicted.
+
+    Returns
+    -------
+    HashCache
+    """
+    return HashCache(os.path.expanduser(cache_file), max_entries, max_age)
@@ -1,19 +1,338 @@
+import heapq
+import itertools
+import pathlib
 import sqlite3
 import os
+import DupFinder.stats
 
+# Number of rows inserted in one transaction by add_items.
+BATCH_SIZE = 10000
+# Loads of at least that many rows (and not smaller than the table) are done
+# without SizeHashIndex, which is rebuilt afterwards.
+REBUILD_INDEX_THRESHOLD = 100000
+# Write-ahead log lets readers work while index is being written, the rest
+# trades durability of the last transactions on power loss for speed.
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+]
+
+# Version of database schema used by this code. New databases are created
+# and older ones upgraded by running upgrade steps (see UPGRADES).
+SCHEMA_VERSION = 4
+# Path separators, file paths are split into interned directory and name.
+SEPARATORS = [os.sep] + ([os.altsep] if os.altsep else [])
+
+# Hash algorithm used by versions that did not record it.
+LEGACY_ALGORITHM = 'xxh64'
+
+# 64 bit hashes are stored as signed integers, longer ones as blobs. Both
+# are presented as hex strings.
+HEX_HASH_SQL = "CASE WHEN {0} IS NULL THEN NULL ELSE printf('%016x', {0}) END"
+HEX_HASH_V2_SQL = """CASE typeof({0})
+    WHEN 'integer' THEN printf('%016x', {0})
+    WHEN 'blob' THEN lower(hex({0})) END"""
+# Schema of version 1, later versions are created by upgrade steps.
+SCHEMA_V1_SQL = [
+    """
+    CREATE TABLE SchemaVersion (version INTEGER NOT NULL)
+    """,
+    """
+    CREATE TABLE Directories (id INTEGER PRIMARY KEY,
+                              path TEXT NOT NULL UNIQUE)
+    """,
+    """
+    CREATE TABLE Files (id INTEGER PRIMARY KEY,
+                        dir_id INTEGER NOT NULL REFERENCES Directories(id),
+                        name TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        hash INTEGER,
+                        partial_hash INTEGER,
+                        mtime INTEGER,
+                        inode INTEGER,
+                        device INTEGER,
+                        UNIQUE (dir_id, name))
+    """,
+    # Entries as seen by application (and by older versions of it).
+    """
+    CREATE VIEW Dupfinder AS
+    SELECT d.path || f.name AS filepath, f.size AS size,
+           {hash} AS hash, {partial_hash} AS partial_hash,
+           f.mtime AS mtime, f.inode AS inode, f.device AS device
+    FROM Files f JOIN Directories d ON d.id = f.dir_id
+    """.format(hash=HEX_HASH_SQL.format('f.hash'),
+               partial_hash=HEX_HASH_SQL.format('f.partial_hash')),
+    """
+    INSERT INTO SchemaVersion(version) VALUES(0)
+    """,
+]
+# Schema of version 2 - metadata (hash algorithm) and hashes longer than 64
+# bits.
+SCHEMA_V2_SQL = [
+    """
+    CREATE TABLE Metadata (key TEXT PRIMARY KEY, value TEXT)
+    """,
+    """
+    INSERT INTO Metadata(key, value) VALUES('algorithm', '{}')
+    """.format(LEGACY_ALGORITHM),
+    """
+    DROP VIEW Dupfinder
+    """,
+    """
+    CREATE VIEW Dupfinder AS
+    SELECT d.path || f.name AS filepath, f.size AS size,
+           {hash} AS hash, {partial_hash} AS partial_hash,
+           f.mtime AS mtime, f.inode AS inode, f.device AS device
+    FROM Files f JOIN Directories d ON d.id = f.dir_id
+    """.format(hash=HEX_HASH_V2_SQL.format('f.hash'),
+               partial_hash=HEX_HASH_V2_SQL.format('f.partial_hash')),
+]
+# Schema of version 3 - progress of interrupted indexing (see
+# DupFinder.fs.update_index). Paths of directories end with separator.
+SCHEMA_V3_SQL = [
+    """
+    CREATE TABLE ScanProgress (root TEXT NOT NULL, path TEXT NOT NULL,
+                               PRIMARY KEY (root, path))
+    """,
+]
+# Schema of version 4 - indexes of file names and hashes (see
+# search_by_name and search_by_hash).
+SCHEMA_V4_SQL = [
+    """
+    CREATE INDEX IF NOT EXISTS NameIndex ON Files(name)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS HashIndex ON Files(hash)
+    """,
+]
+ADD_SCAN_PROGRESS_SQL = """
+    INSERT OR IGNORE INTO ScanProgress(root, path) VALUES(?, ?)
+    """
+GET_SCAN_PROGRESS_SQL = """
+    SELECT path FROM ScanProgress WHERE root = ?
+    """
+CLEAR_SCAN_PROGRESS_SQL = """
+    DELETE FROM ScanProgress WHERE root = ?
+    """
+GET_METADATA_SQL = """
+    SELECT value FROM Metadata WHERE key = ?
+    """
+SET_METADATA_SQL = """
+    INSERT OR REPLACE INTO Metadata(key, value) VALUES(?, ?)
+    """
+GET_VERSION_SQL = """
+    SELECT version FROM SchemaVersion
+    """
+SET_VERSION_SQL = """
+    UPDATE SchemaVersion SET version = ?
+    """
+TABLE_EXISTS_SQL = """
+    SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?
+    """
+INSERT_DIRECTORY_SQL = """
+    INSERT OR IGNORE INTO Directories(path) VALUES(?)
+    """
 INSERT_SQL = """
-    INSERT INTO Dupfinder(filepath, size, hash) VALUES(:filepath, :size, :hash)
+    INSERT OR REPLACE INTO Files(dir_id, name, size, hash, partial_hash,
+                                 mtime, inode, device)
+    VALUES((SELECT id FROM Directories WHERE path = :directory), :name,
+           :size, :hash, :partial_hash, :mtime, :inode, :device)
     """
 INDEX_SQL = """
-    CREATE INDEX SizeIndex ON Dupfinder(size)
+    CREATE INDEX IF NOT EXISTS SizeHashIndex ON Files(size, hash)
     """
-CREATE_SQL = """
-    CREATE TABLE Dupfinder (filepath, size, hash)
+DROP_INDEX_SQL = """
+    DROP INDEX IF EXISTS SizeHashIndex
+    """
+COUNT_SQL = """
+    SELECT COUNT(*) AS count FROM Files
+    """
+COUNT_INDEXED_SQL = """
+    SELECT COUNT(*) AS count FROM IndexedFiles
     """
 GET_BY_SIZE_SQL = """
-    SELECT filepath, size, hash FROM DupFinder
+    SELECT filepath, size, hash, partial_hash FROM DupFinder
     WHERE size = ?
     """
+GET_UNDER_PATH_SQL = """
+    SELECT d.path || f.name AS filepath, f.size AS size,
+           {hash} AS hash, {partial_hash} AS partial_hash,
+           f.mtime AS mtime, f.inode AS inode, f.device AS device
+    FROM Directories d JOIN Files f ON f.dir_id = d.id
+    WHERE d.path >= ? AND d.path < ?
+    """.format(hash=HEX_HASH_V2_SQL.format('f.hash'),
+               partial_hash=HEX_HASH_V2_SQL.format('f.partial_hash'))
+GET_ITEM_SQL = """
+    SELECT d.path || f.name AS filepath, f.size AS size,
+           {hash} AS hash, {partial_hash} AS partial_hash,
+           f.mtime AS mtime, f.inode AS inode, f.device AS device
+    FROM Directories d JOIN Files f ON f.dir_id = d.id
+    WHERE d.path = ? AND f.name = ?
+    """.format(hash=HEX_HASH_V2_SQL.format('f.hash'),
+               partial_hash=HEX_HASH_V2_SQL.format('f.partial_hash'))
+# Columns of entries as presented by Dupfinder view, for queries joining
+# Files f with Directories d themselves.
+ENTRY_COLUMNS_SQL = """d.path || f.name AS filepath, f.size AS size,
+           {hash} AS hash, {partial_hash} AS partial_hash,
+           f.mtime AS mtime, f.inode AS inode, f.device AS device""".format(
+    hash=HEX_HASH_V2_SQL.format('f.hash'),
+    partial_hash=HEX_HASH_V2_SQL.format('f.partial_hash'))
+# Pattern without wildcards at its beginning is a range search of
+# NameIndex, others scan the index instead of the table.
+SEARCH_NAME_SQL = """
+    SELECT {}
+    FROM Files f INDEXED BY NameIndex JOIN Directories d ON d.id = f.dir_id
+    WHERE f.name GLOB :name AND d.path || f.name GLOB :pattern
+    """.format(ENTRY_COLUMNS_SQL)
+# Without size, hash is looked up in HashIndex.
+SEARCH_HASH_SQL = """
+    SELECT {}
+    FROM Files f JOIN Directories d ON d.id = f.dir_id
+    WHERE f.hash = ?
+    """.format(ENTRY_COLUMNS_SQL)
+SEARCH_SIZE_HASH_SQL = """
+    SELECT {}
+    FROM Files f JOIN Directories d ON d.id = f.dir_id
+    WHERE f.size = ? AND f.hash = ?
+    """.format(ENTRY_COLUMNS_SQL)
+# Groups are found by scan of SizeHashIndex in its (reversed) order, so
+# rows are streamed without sorting, biggest files first.
+DUPLICATES_SQL = """
+    SELECT {}
+    FROM (SELECT size, hash FROM Files GROUP BY size, hash
+          HAVING COUNT(*) > 1 ORDER BY size DESC, hash DESC) g
+    CROSS JOIN Files f ON f.size = g.size AND f.hash = g.hash
+    JOIN Directories d ON d.id = f.dir_id
+    """.format(ENTRY_COLUMNS_SQL)
+# Sizes are read from SizeHashIndex of each database separately (see
+# iterate_sizes), distinct over their union would need temporary b-tree.
+GET_SIZES_SQL = """
+    SELECT DISTINCT size FROM {}.Files ORDER BY size LIMIT ?
+    """
+DATABASE_LIST_SQL = """
+    PRAGMA database_list
+    """
+GET_PARTIAL_HASHES_SQL = """
+    SELECT size, {partial_hash} FROM IndexedFiles
+    """.format(partial_hash=HEX_HASH_V2_SQL.format('partial_hash'))
+GET_ALL_SQL = """
+    SELECT filepath, size, hash, partial_hash, mtime, inode, device
+    FROM Dupfinder
+    """
+# Entries are read in ranges of row ids up to the last one at the start, so
+# entries replaced meanwhile (they get new ids) are not read again.
+MAX_ID_SQL = """
+    SELECT max(id) AS id FROM Files
+    """
+GET_BATCH_SQL = """
+    SELECT f.id AS id, {}
+    FROM Files f JOIN Directories d ON d.id = f.dir_id
+    WHERE f.id > ? AND f.id <= ? ORDER BY f.id LIMIT ?
+    """.format(ENTRY_COLUMNS_SQL)
+CREATE_SUSPECTS_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS Suspects
+        (id INTEGER PRIMARY KEY, size INTEGER, partial_hash INTEGER,
+         hash INTEGER)
+    """
+INSERT_SUSPECT_SQL = """
+    INSERT INTO Suspects(id, size, partial_hash, hash) VALUES(?, ?, ?, ?)
+    """
+CLEAR_SUSPECTS_SQL = """
+    DELETE FROM Suspects
+    """
+# Each stage of comparison narrows down suspects. Entries without partial
+# hash (indexed by older versions) match any partial hash.
+MATCH_SUSPECTS_SQL = {
+    'size': """
+        SELECT s.id FROM Suspects s WHERE EXISTS
+            (SELECT 1 FROM IndexedFiles f WHERE f.size = s.size)
+        ORDER BY s.id
+        """,
+    'partial_hash': """
+        SELECT s.id FROM Suspects s WHERE EXISTS
+            (SELECT 1 FROM IndexedFiles f WHERE f.size = s.size
+             AND (f.partial_hash IS NULL OR f.partial_hash = s.partial_hash))
+        ORDER BY s.id
+        """,
+    'hash': """
+        SELECT s.id FROM Suspects s WHERE EXISTS
+            (SELECT 1 FROM IndexedFiles f
+             WHERE f.size = s.size AND f.hash = s.hash
+             AND (f.partial_hash IS NULL OR f.partial_hash = s.partial_hash))
+        ORDER BY s.id
+        """,
+}
+# Files of database and of shards attached to it for searching (see
+# attach_shards). It is temporary, so each connection has its own.
+INDEXED_FILES_SQL = """
+    CREATE TEMP VIEW IndexedFiles AS
+    {}
+    """
+INDEXED_FILES_PART_SQL = """
+    SELECT size, hash, partial_hash FROM {}.Files
+    """
+DROP_INDEXED_FILES_SQL = """
+    DROP VIEW IF EXISTS temp.IndexedFiles
+    """
+ATTACH_SQL = """
+    ATTACH DATABASE ? AS {}
+    """
+DETACH_SQL = """
+    DETACH DATABASE {}
+    """
+COUNT_SHARD_SQL = """
+    SELECT COUNT(*) AS count FROM shard.Files
+    """
+MERGE_DIRECTORIES_SQL = """
+    INSERT OR IGNORE INTO main.Directories(path)
+    SELECT path FROM shard.Directories
+    """
+# Entries of the same file are merged into one, the one with later
+# modification time wins. Hashes are copied as they are.
+MERGE_FILES_SQL = """
+    INSERT INTO main.Files(dir_id, name, size, hash, partial_hash, mtime,
+                           inode, device)
+    SELECT d.id, f.name, f.size, f.hash, f.partial_hash, f.mtime, f.inode,
+           f.device
+    FROM shard.Files f JOIN shard.Directories sd ON sd.id = f.dir_id
+    JOIN main.Directories d ON d.path = sd.path
+    WHERE true
+    ON CONFLICT(dir_id, name) DO UPDATE SET
+        size = excluded.size, hash = excluded.hash,
+        partial_hash = excluded.partial_hash, mtime = excluded.mtime,
+        inode = excluded.inode, device = excluded.device
+    WHERE coalesce(excluded.mtime, -1) > coalesce(Files.mtime, -1)
+    """
+DELETE_SQL = """
+    DELETE FROM Files
+    WHERE dir_id = (SELECT id FROM Directories WHERE path = ?) AND name = ?
+    """
+DELETE_UNUSED_DIRECTORIES_SQL = """
+    DELETE FROM Directories
+    WHERE NOT EXISTS (SELECT 1 FROM Files WHERE dir_id = Directories.id)
+    """
+ANALYZE_SQL = """
+    ANALYZE
+    """
+VACUUM_SQL = """
+    VACUUM
+    """
+# Schema of version 0 - single untyped table, possibly without some of the
+# columns (they were added over time).
+LEGACY_RENAME_SQL = """
+    ALTER TABLE Dupfinder RENAME TO Dupfinder_v0
+    """
+LEGACY_SELECT_SQL = """
+    SELECT * FROM Dupfinder_v0 ORDER BY rowid
+    """
+LEGACY_DROP_SQL = """
+    DROP TABLE Dupfinder_v0
+    """
+BEGIN_SQL = """
+    BEGIN
+    """
 
 
 def dict_factory(cursor, row):
@@ -23,7 +342,197 @@ def dict_factory(cursor, row):
     return d
 
 
-def create_db(db_file):
+def set_pragmas(db):
+    """
+    Tunes database connection for bulk loads (see PRAGMAS).
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+         Db Connection
+    """
+    for pragma in PRAGMAS:
+        db.execute(pragma)
+
+
+def _hash_to_db(digest):
+    """
+    Converts hex digest to value stored in database - integer for 64 bit
+    digests, bytes for longer ones.
+    """
+    if digest is None:
+        return None
+    if len(digest) > 16:
+        return bytes.fromhex(digest)
+    value = int(digest, 16)
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def split_path(filepath):
+    """
+    Splits file path into directory (with trailing separator) and file name,
+    so that concatenation of both gives exactly the same path.
+
+    Parameters
+    ----------
+    filepath : string
+         Path to be split
+    Returns
+    -------
+    (directory, name) tuple
+    """
+    idx = max(filepath.rfind(sep) for sep in SEPARATORS)
+    return (filepath[:idx + 1], filepath[idx + 1:])
+
+
+def _to_row(item):
+    """
+    Converts item to parameters of INSERT_SQL.
+    """
+    (directory, name) = split_path(item['filepath'])
+    return {'directory': directory, 'name': name, 'size': item['size'],
+            'hash': _hash_to_db(item['hash']),
+            'partial_hash': _hash_to_db(item['partial_hash']),
+            'mtime': item['mtime'], 'inode': item['inode'],
+            'device': item['device']}
+
+
+def _insert(db, items, batch_size=BATCH_SIZE, commit=True):
+    """
+    Inserts items to database with executemany in batches, interning their
+    directories first.
+    """
+    it = iter(items)
+    while True:
+        batch = [_to_row(item) for item in itertools.islice(it, batch_size)]
+        if not batch:
+            break
+        with DupFinder.stats.timed('db'):
+            db.executemany(INSERT_DIRECTORY_SQL,
+                           ((d,) for d in set(r['directory'] for r in batch)))
+            db.executemany(INSERT_SQL, batch)
+            if commit:
+                db.commit()
+        DupFinder.stats.add('db_queries', 2)
+        DupFinder.stats.add('rows_inserted', len(batch))
+
+
+def _legacy_items(db):
+    """
+    Reads entries from table of schema version 0. Columns missing in that
+    table are None, so are hashes that cannot be converted (they need to be
+    recalculated).
+    """
+    for row in db.cursor().execute(LEGACY_SELECT_SQL):
+        item = {'filepath': row['filepath'], 'size': row['size']}
+        for column in ['hash', 'partial_hash']:
+            item[column] = row.get(column)
+            try:
+                _hash_to_db(item[column])
+            except (TypeError, ValueError):
+                item[column] = None
+        for column in ['mtime', 'inode', 'device']:
+            item[column] = row.get(column)
+        yield item
+
+
+def _upgrade_from_v0(db):
+    """
+    Creates schema of version 1. Entries from single untyped Dupfinder table
+    (if there is one) are moved into typed Files table with interned
+    directories. Repeated entries of the same path (older
+    versions inserted them blindly) are replaced by the latest one.
+    """
+    legacy = db.execute(TABLE_EXISTS_SQL, ('Dupfinder',)).fetchone()
+    if legacy is not None:
+        db.execute(LEGACY_RENAME_SQL)
+    for sql in SCHEMA_V1_SQL:
+        db.execute(sql)
+    if legacy is not None:
+        _insert(db, _legacy_items(db), commit=False)
+        db.execute(LEGACY_DROP_SQL)
+
+
+def _upgrade_from_v1(db):
+    """
+    Adds metadata with hash algorithm of existing entries.
+    """
+    for sql in SCHEMA_V2_SQL:
+        db.execute(sql)
+
+
+def _upgrade_from_v2(db):
+    """
+    Adds table with progress of indexing.
+    """
+    for sql in SCHEMA_V3_SQL:
+        db.execute(sql)
+
+
+def _upgrade_from_v3(db):
+    """
+    Adds indexes of file names and hashes.
+    """
+    for sql in SCHEMA_V4_SQL:
+        db.execute(sql)
+
+
+# Upgrade steps, n-th step brings database from version n to n + 1.
+UPGRADES = [_upgrade_from_v0, _upgrade_from_v1, _upgrade_from_v2,
+            _upgrade_from_v3]
+
+
+def get_schema_version(db):
+    """
+    Returns version of database schema. Databases created before schema was
+    versioned are of version 0.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+         Db Connection
+    """
+    if db.execute(TABLE_EXISTS_SQL, ('SchemaVersion',)).fetchone() is None:
+        return 0
+    return db.execute(GET_VERSION_SQL).fetchone()['version']
+
+
+def upgrade_db(db):
+    """
+    Brings database created by older version of this application up to date,
+    running all needed upgrade steps (see UPGRADES). Each step is run in
+    its own explicit transaction (schema changes included), so interrupted
+    upgrade leaves database at version of the last finished step.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+         Db Connection
+    """
+    version = get_schema_version(db)
+    while version < SCHEMA_VERSION:
+        db.execute(BEGIN_SQL)
+        with db:
+            UPGRADES[version](db)
+            db.execute(SET_VERSION_SQL, (version + 1,))
+        version += 1
+    # Interrupted bulk load may have left database without SizeHashIndex.
+    db.execute(INDEX_SQL)
+    db.commit()
+
+
+def _create_indexed_files(db, schemas=('main',)):
+    """
+    (Re)creates IndexedFiles view over Files tables of given schemas.
+    """
+    db.execute(DROP_INDEXED_FILES_SQL)
+    db.execute(INDEXED_FILES_SQL.format(' UNION ALL '.join(
+        INDEXED_FILES_PART_SQL.format(schema) for schema in schemas)))
+
+
+def create_db(db_file, algorithm=None):
     """
     Creates database file using sqlite3 backend. You can pass :memory:
     for inmemory db. If file exists, this function will return None.
@@ -32,6 +541,9 @@ def create_db(db_file):
     ----------
     db_file : string
         Full path to db file that needs to be created.
+    algorithm : string
+        Name of hash algorithm used for entries (see
+        DupFinder.fs.ALGORITHMS). Defaults to LEGACY_ALGORITHM.
 
     Returns
     -------
@@ -42,14 +554,15 @@ def create_db(db_file):
     if os.path.isfile(db_file):
         return None
 
-    conn = sqlite3.connect(db_file)
+    conn = sqlite3.connect(db_file, uri=True)
     conn.row_factory = dict_factory
     if conn is None:
         return None
-    c = conn.cursor()
-    c.execute(CREATE_SQL)
-    c.execute(INDEX_SQL)
-    c.close
+    set_pragmas(conn)
+    upgrade_db(conn)
+    _create_indexed_files(conn)
+    if algorithm is not None:
+        set_algorithm(conn, algorithm)
     return conn
 
 
@@ -72,14 +585,29 @@ def connect_db(db_file):
     """
     if not os.path.isfile(db_file):
         return None
-    conn = sqlite3.connect(db_file)
+    conn = sqlite3.connect(db_file, uri=True)
     conn.row_factory = dict_factory
+    set_pragmas(conn)
+    upgrade_db(conn)
+    _create_indexed_files(conn)
     return conn
 
 
+@DupFinder.stats.timed('db')
+def count_indexed(db):
+    """
+    Returns number of entries in database and shards attached to it (see
+    attach_shards).
+    """
+    DupFinder.stats.add('db_queries')
+    return db.execute(COUNT_INDEXED_SQL).fetchone()['count']
+
+
 def add_item(db, item, commit=True):
     """
-    Adds item to existing db connection.
+    Adds item to existing db connection. Partial hash may be missing (None),
+    full hash is mandatory. Item replaces existing entry with the same
+    filepath.
     Parameters
     ----------
     db : sqlite3.Connection
@@ -95,27 +623,61 @@ def add_item(db, item, commit=True):
         return False
     assert item['hash'] is not None
     assert item['hash'] != ''
-    db.execute(INSERT_SQL, item)
-    if commit:
-        db.commit()
+    _insert(db, [item], commit=commit)
     return True
 
 
-def add_items(db, items):
+def _checked(items):
+    """
+    Passes items through, making sure they have hash (see add_item).
+    """
+    for item in items:
+        assert item['hash'] is not None
+        assert item['hash'] != ''
+        yield item
+
+
+@DupFinder.stats.timed('db')
+def count_items(db):
+    """
+    Returns number of entries in database.
+    """
+    DupFinder.stats.add('db_queries')
+    return db.execute(COUNT_SQL).fetchone()['count']
+
+
+def add_items(db, items, batch_size=BATCH_SIZE, rebuild_index=None):
     """
-    Add many items to database.
-    /This could be optimized - I'm sure/
+    Add many items to database. Items are inserted with executemany in
+    batches, each batch in its own transaction.
     Parameters
     ----------
     db : sqlite3.Connection
          Db Connection
-    items : List of dictionaries of values that are to be added to database
+    items : Iterable of dictionaries (or DupFinder.fs.FileEntry objects) of
+            values that are to be added to database. Can be a generator, it
+            is consumed batch by batch.
+    batch_size : int
+            Number of items committed at once.
+    rebuild_index : boolean
+            Drop SizeHashIndex before load and create it again afterwards,
+            which is faster for very large loads. If None, it is done for
+            lists of at least REBUILD_INDEX_THRESHOLD items, not smaller than
+            database.
     """
-    for d in items:
-        add_item(db, d, False)
+    if rebuild_index is None:
+        rebuild_index = (isinstance(items, list)
+                         and len(items) >= REBUILD_INDEX_THRESHOLD
+                         and len(items) >= count_items(db))
+    if rebuild_index:
+        db.execute(DROP_INDEX_SQL)
+    _insert(db, _checked(items), batch_size)
+    if rebuild_index:
+        db.execute(INDEX_SQL)
     db.commit()
 
 
+@DupFinder.stats.timed('db')
 def get_by_size(db, size):
     """
     Assumingly this is the most used query for DB. It searches database for
@@ -132,6 +694,419 @@ def get_by_size(db, size):
     """
     if db is None:
         return None
+    DupFinder.stats.add('db_queries')
     cur = db.cursor()
     cur.execute(GET_BY_SIZE_SQL, (size,))
     return cur.fetchall()
+
+
+@DupFinder.stats.timed('db')
+def get_item(db, filepath):
+    """
+    Returns entry of file with given path or None if it is not indexed.
+    """
+    DupFinder.stats.add('db_queries')
+    return db.execute(GET_ITEM_SQL, split_path(filepath)).fetchone()
+
+
+@DupFinder.stats.timed('db')
+def get_under_path(db, path):
+    """
+    Returns all entries for files in given directory and its subdirectories.
+    Uses unique index of directories, so only matching rows are read.
+    Parameters
+    ----------
+    db   : sqlite3.Connection
+           Db Connection
+    path : string
+           Directory path
+    Returns
+    ----------
+    List of dictionaries containing rows from databse.
+    """
+    if db is None:
+        return None
+    DupFinder.stats.add('db_queries')
+    prefix = os.path.join(path, '')
+    cur = db.cursor()
+    cur.execute(GET_UNDER_PATH_SQL, (prefix, prefix + '\U0010ffff'))
+    return cur.fetchall()
+
+
+@DupFinder.stats.timed('db')
+def remove_items(db, filepaths):
+    """
+    Removes entries with given file paths from database.
+    Parameters
+    ----------
+    db : sqlite3.Connection
+         Db Connection
+    filepaths : List of paths of entries to be removed
+    """
+    DupFinder.stats.add('db_queries', 2)
+    db.executemany(DELETE_SQL, (split_path(f) for f in filepaths))
+    db.execute(DELETE_UNUSED_DIRECTORIES_SQL)
+    db.commit()
+
+
+@DupFinder.stats.timed('db')
+def match_suspects(db, suspects, stage):
+    """
+    Finds which of suspected files have matching entries in database. All
+    suspects are loaded into temporary table and matched with single query,
+    instead of querying database for every file.
+    Parameters
+    ----------
+    db       : sqlite3.Connection
+               Db Connection
+    suspects : Iterable of (id, size, partial_hash, hash) tuples. Id is any
+               integer unique among suspects.
+    stage    : string
+               What has to match: 'size' only, 'partial_hash' (and size) or
+               'hash' (and size and partial hash).
+    Returns
+    ----------
+    List of ids of suspects that matched, in ascending order.
+    """
+    if db is None:
+        return None
+    DupFinder.stats.add('db_queries', 4)
+    sql = MATCH_SUSPECTS_SQL[stage]
+    db.execute(CREATE_SUSPECTS_SQL)
+    db.executemany(INSERT_SUSPECT_SQL,
+                   ((idx, size, _hash_to_db(partial_hash), _hash_to_db(h))
+                    for (idx, size, partial_hash, h) in suspects))
+    cur = db.cursor()
+    cur.row_factory = None
+    ids = [row[0] for row in cur.execute(sql)]
+    cur.close()
+    db.execute(CLEAR_SUSPECTS_SQL)
+    db.commit()
+    return ids
+
+
+@DupFinder.stats.timed('db')
+def get_algorithm(db):
+    """
+    Returns name of hash algorithm used for entries in database.
+    """
+    DupFinder.stats.add('db_queries')
+    return db.execute(GET_METADATA_SQL, ('algorithm',)).fetchone()['value']
+
+
+def set_algorithm(db, algorithm, commit=True):
+    """
+    Records name of hash algorithm used for entries in database. It does not
+    change entries (see DupFinder.fs.rehash_index).
+    """
+    db.execute(SET_METADATA_SQL, ('algorithm', algorithm))
+    if commit:
+        db.commit()
+
+
+def iterate_items(db):
+    """
+    Returns cursor over all entries in database. Rows are fetched while
+    iterating, so they are not kept in memory all at once.
+    Parameters
+    ----------
+    db : sqlite3.Connection
+         Db Connection
+    Returns
+    ----------
+    Cursor yielding dictionaries containing rows from database.
+    """
+    DupFinder.stats.add('db_queries')
+    return db.cursor().execute(GET_ALL_SQL)
+
+
+def iterate_batches(db, batch_size=BATCH_SIZE):
+    """
+    Returns generator of lists of entries in database (with their row `id`).
+    Each list is fetched whole, so database can be changed between them.
+    Entries added or replaced meanwhile are not returned.
+    Parameters
+    ----------
+    db : sqlite3.Connection
+         Db Connection
+    batch_size : int
+         Maximum number of entries in one list.
+    """
+    DupFinder.stats.add('db_queries')
+    last = db.execute(MAX_ID_SQL).fetchone()['id']
+    start = 0
+    while last is not None and start < last:
+        DupFinder.stats.add('db_queries')
+        with DupFinder.stats.timed('db'):
+            batch = db.execute(GET_BATCH_SQL,
+                               (start, last, batch_size)).fetchall()
+        if not batch:
+            return
+        start = batch[-1]['id']
+        yield batch
+
+
+def replace_hashes(db, items, removed, algorithm):
+    """
+    Replaces entries with ones hashed with another algorithm and records the
+    algorithm, all in single transaction.
+    Parameters
+    ----------
+    db : sqlite3.Connection
+         Db Connection
+    items : Iterable of dictionaries of entries to be stored
+    removed : List of paths of entries to be removed
+    algorithm : Name of hash algorithm used for items
+    """
+    _insert(db, _checked(items), commit=False)
+    DupFinder.stats.add('db_queries', 3)
+    with DupFinder.stats.timed('db'):
+        db.executemany(DELETE_SQL, (split_path(f) for f in removed))
+        db.execute(DELETE_UNUSED_DIRECTORIES_SQL)
+        set_algorithm(db, algorithm, commit=False)
+        db.commit()
+
+
+@DupFinder.stats.timed('db')
+def analyze_db(db):
+    """
+    Gathers statistics of tables and indexes used by query planner.
+    """
+    DupFinder.stats.add('db_queries')
+    db.commit()
+    db.execute(ANALYZE_SQL)
+    db.commit()
+
+
+@DupFinder.stats.timed('db')
+def vacuum_db(db):
+    """
+    Rebuilds database file, giving space of removed entries back.
+    """
+    DupFinder.stats.add('db_queries')
+    db.commit()
+    db.execute(VACUUM_SQL)
+
+
+def add_scan_progress(db, root, path):
+    """
+    Records that directory (with its subdirectories) was completely indexed
+    during indexing of root directory. It is not committed, so it is stored
+    together with the entries of its files (see add_items).
+    Parameters
+    ----------
+    db   : sqlite3.Connection
+           Db Connection
+    root : string
+           Directory being indexed
+    path : string
+           Completed directory
+    """
+    DupFinder.stats.add('db_queries')
+    db.execute(ADD_SCAN_PROGRESS_SQL,
+               (os.path.join(root, ''), os.path.join(path, '')))
+
+
+@DupFinder.stats.timed('db')
+def get_scan_progress(db, root):
+    """
+    Returns set of directories completed by interrupted indexing of root
+    directory (see add_scan_progress). Paths end with separator.
+    """
+    DupFinder.stats.add('db_queries')
+    return set(row['path'] for row in db.execute(
+        GET_SCAN_PROGRESS_SQL, (os.path.join(root, ''),)))
+
+
+@DupFinder.stats.timed('db')
+def clear_scan_progress(db, root):
+    """
+    Forgets progress of indexing of root directory, once it is finished.
+    """
+    DupFinder.stats.add('db_queries')
+    db.execute(CLEAR_SCAN_PROGRESS_SQL, (os.path.join(root, ''),))
+    db.commit()
+
+
+@DupFinder.stats.timed('db')
+def iterate_sizes(db, limit=-1):
+    """
+    Returns iterator over distinct sizes of indexed files (including
+    attached shards), in ascending order. Sizes of each database are read
+    in order from its SizeHashIndex (tables are not read) and merged.
+    Parameters
+    ----------
+    db    : sqlite3.Connection
+            Db Connection
+    limit : int
+            Maximum number of sizes returned, negative for all of them.
+    """
+    schemas = [row['name'] for row in db.execute(DATABASE_LIST_SQL)
+               if row['name'] != 'temp']
+    streams = []
+    for schema in schemas:
+        DupFinder.stats.add('db_queries')
+        cur = db.cursor()
+        cur.row_factory = None
+        cur.execute(GET_SIZES_SQL.format(schema), (limit,))
+        streams.append(row[0] for row in cur)
+    sizes = (size for (size, _) in itertools.groupby(heapq.merge(*streams)))
+    if limit < 0:
+        return sizes
+    return itertools.islice(sizes, limit)
+
+
+def iterate_partial_hashes(db):
+    """
+    Returns iterator over (size, partial hash) of all entries (including
+    attached shards).
+    """
+    DupFinder.stats.add('db_queries')
+    cur = db.cursor()
+    cur.row_factory = None
+    return cur.execute(GET_PARTIAL_HASHES_SQL)
+
+
+def _read_only_uri(db_file):
+    """
+    Returns URI of database file which opens (or attaches) it read-only.
+    """
+    return pathlib.Path(os.path.abspath(db_file)).as_uri() + '?mode=ro'
+
+
+def _check_shard(shard_file):
+    """
+    Checks that shard database is of current schema (shards are only read,
+    so they are not upgraded) and returns its hash algorithm and number of
+    entries.
+    """
+    if not os.path.isfile(shard_file):
+        raise ValueError('No such database: ' + shard_file)
+    shard = sqlite3.connect(_read_only_uri(shard_file), uri=True)
+    shard.row_factory = dict_factory
+    try:
+        version = get_schema_version(shard)
+        if version != SCHEMA_VERSION:
+            raise ValueError(
+                shard_file + ' is of schema version %d, not %d (connect to '
+                'it with this version first to upgrade it)'
+                % (version, SCHEMA_VERSION))
+        return (get_algorithm(shard), count_items(shard))
+    finally:
+        shard.close()
+
+
+def attach_shards(db, shard_files):
+    """
+    Attaches shard databases (i.e. indexes built on other hosts), so that
+    comparisons (see match_suspects, iterate_sizes) search them together
+    with database itself. Shards are only read.
+    Parameters
+    ----------
+    db          : sqlite3.Connection
+                  Db Connection
+    shard_files : List of paths to shard databases
+    """
+    algorithm = get_algorithm(db)
+    schemas = ['main']
+    for (idx, shard_file) in enumerate(shard_files):
+        (shard_algorithm, _) = _check_shard(shard_file)
+        if shard_algorithm != algorithm:
+            raise ValueError(shard_file + ' uses ' + shard_algorithm +
+                             ' hashes, database uses ' + algorithm)
+        schema = 'shard%d' % idx
+        db.execute(ATTACH_SQL.format(schema), (_read_only_uri(shard_file),))
+        schemas.append(schema)
+    _create_indexed_files(db, schemas)
+
+
+def merge_db(db, shard_file):
+    """
+    Merges entries of shard database into database, in single transaction
+    and without rehashing. Entries of files present in both are merged into
+    one, with metadata and hashes of the one modified later. Empty database
+    takes hash algorithm of shard, otherwise algorithms have to match.
+    Parameters
+    ----------
+    db         : sqlite3.Connection
+                 Db Connection
+    shard_file : string
+                 Path to shard database
+    Returns
+    ----------
+    (merged, skipped) - number of shard entries added or updated and number
+    of ones skipped as older than entries already in database.
+    """
+    (algorithm, count) = _check_shard(shard_file)
+    if algorithm != get_algorithm(db):
+        if count_items(db) > 0:
+            raise ValueError(shard_file + ' uses ' + algorithm +
+                             ' hashes, database uses ' + get_algorithm(db))
+        set_algorithm(db, algorithm)
+    db.commit()
+    db.execute(ATTACH_SQL.format('shard'), (_read_only_uri(shard_file),))
+    try:
+        rebuild_index = (count >= REBUILD_INDEX_THRESHOLD
+                         and count >= count_items(db))
+        DupFinder.stats.add('db_queries', 2)
+        with DupFinder.stats.timed('db'):
+            if rebuild_index:
+                db.execute(DROP_INDEX_SQL)
+            db.execute(MERGE_DIRECTORIES_SQL)
+            merged = db.execute(MERGE_FILES_SQL).rowcount
+            if rebuild_index:
+                db.execute(INDEX_SQL)
+            db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        db.execute(DETACH_SQL.format('shard'))
+    DupFinder.stats.add('rows_inserted', merged)
+    return (merged, count - merged)
+
+
+def search_by_name(db, pattern):
+    """
+    Finds entries by file name. Pattern is matched with GLOB rules (*, ?,
+    [...], case sensitive) against file name, or against whole path if it
+    contains path separator (then its last part has to match file name).
+    Parameters
+    ----------
+    db      : sqlite3.Connection
+              Db Connection
+    pattern : string
+              File name or path pattern
+    Returns
+    ----------
+    Cursor yielding dictionaries of entries, fetched while iterating.
+    """
+    DupFinder.stats.add('db_queries')
+    (directory, name) = split_path(pattern)
+    return db.cursor().execute(SEARCH_NAME_SQL, {
+        'name': name or '*', 'pattern': pattern if directory else '*'})
+
+
+def search_by_hash(db, digest, size=None):
+    """
+    Finds entries with given hash (hex digest of algorithm used by
+    database), and size if it is known.
+    Returns
+    ----------
+    Cursor yielding dictionaries of entries, fetched while iterating.
+    """
+    DupFinder.stats.add('db_queries')
+    if size is None:
+        return db.cursor().execute(SEARCH_HASH_SQL, (_hash_to_db(digest),))
+    return db.cursor().execute(SEARCH_SIZE_HASH_SQL,
+                               (size, _hash_to_db(digest)))
+
+
+def iterate_duplicates(db):
+    """
+    Returns cursor over entries of files indexed more than once (same size
+    and hash). Entries of each group follow each other, groups of bigger
+    files come first. Group them with itertools.groupby on (size, hash).
+    """
+    DupFinder.stats.add('db_queries')
+    return db.cursor().execute(DUPLICATES_SQL)
@@ -0,0 +1,207 @@
+import array
+import bisect
+import fnmatch
+import math
+import os
+import xxhash
+import DupFinder.db
+import DupFinder.stats
+
+# Default limit of memory (in bytes) used by IndexFilter. Bigger indexes are
+# checked with SQL only.
+FILTER_MEMORY = 64 * 1024 * 1024
+# Expected rate of false positives of Bloom filter over partial hashes.
+BLOOM_ERROR_RATE = 0.01
+# Name of file with patterns of files and directories ignored by walker in
+# its directory and subdirectories (see ScanFilter).
+IGNORE_FILE = '.dupfinderignore'
+
+
+class BloomFilter:
+    """
+    Set of keys (bytes) that can tell for sure only that key is not in it.
+    Its size is fixed, it does not depend on keys themselves.
+    """
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.bits = max(int(-capacity * math.log(error_rate)
+                            / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.bits / capacity * math.log(2))), 1)
+        self.array = bytearray((self.bits + 7) // 8)
+
+    @staticmethod
+    def memory(capacity, error_rate=BLOOM_ERROR_RATE):
+        """
+        Returns number of bytes used by filter for given number of keys.
+        """
+        capacity = max(capacity, 1)
+        return int(-capacity * math.log(error_rate) / math.log(2) ** 2) // 8
+
+    def _positions(self, key):
+        digest = xxhash.xxh3_128_intdigest(key)
+        (h1, h2) = (digest >> 64, digest & 0xffffffffffffffff)
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.array[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+
+def _key(size, partial_hash):
+    return b'%d:%s' % (size, partial_hash.encode())
+
+
+class IndexFilter:
+    """
+    Sizes of indexed files, kept as sorted array (8 bytes per size), and
+    optionally Bloom filter of their (size, partial hash) pairs. It lets
+    compare_with_db reject most of files without querying database.
+    """
+
+    def __init__(self, sizes, bloom=None):
+        self.sizes = sizes
+        self.bloom = bloom
+
+    def has_size(self, size):
+        """
+        Checks if there is indexed file of given size. The answer is exact.
+        """
+        idx = bisect.bisect_left(self.sizes, size)
+        return idx < len(self.sizes) and self.sizes[idx] == size
+
+    def may_have_partial_hash(self, size, partial_hash):
+        """
+        Checks if there may be indexed file of given size and partial hash.
+        False is certain, True has to be confirmed by database.
+        """
+        if self.bloom is None or partial_hash is None:
+            return True
+        return _key(size, partial_hash) in self.bloom
+
+
+def load_index_filter(db, max_memory=FILTER_MEMORY, partial_hashes=False):
+    """
+    Loads IndexFilter with sizes (and optionally partial hashes) of files
+    indexed in database.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Connection to database
+    max_memory: int
+        Limit of memory used by filter in bytes. Bloom filter is skipped if
+        it does not fit.
+    partial_hashes: boolean
+        Build Bloom filter over (size, partial hash) of indexed files. It is
+        skipped if some entries have no partial hash (indexed by older
+        versions).
+
+    Returns
+    -------
+    IndexFilter or None if sizes do not fit into max_memory.
+    """
+    with DupFinder.stats.timed('filter'):
+        limit = max_memory // 8
+        sizes = array.array('q', DupFinder.db.iterate_sizes(db, limit + 1))
+        if len(sizes) > limit:
+            return None
+        DupFinder.stats.add('filter_sizes', len(sizes))
+        if not partial_hashes:
+            return IndexFilter(sizes)
+        count = DupFinder.db.count_indexed(db)
+        if sizes.itemsize * len(sizes) + BloomFilter.memory(count) \
+                > max_memory:
+            return IndexFilter(sizes)
+        bloom = BloomFilter(count)
+        for (size, partial_hash) in DupFinder.db.iterate_partial_hashes(db):
+            if partial_hash is None:
+                return IndexFilter(sizes)
+            bloom.add(_key(size, partial_hash))
+        return IndexFilter(sizes, bloom)
+
+
+class ScanFilter:
+    """
+    Rules of files and directories skipped while directory is walked (see
+    DupFinder.fs.enumerate_directory). Excluded directories are not listed
+    at all.
+
+    Patterns (shell globs) are matched against names, or against paths
+    relative to where they come from (walked directory or directory of
+    ignore file) if they contain '/'. Patterns ending with '/' match
+    directories only. Ignore files have one pattern per line, empty lines
+    and lines starting with '#' are skipped.
+    """
+
+    def __init__(self, min_size=None, max_size=None, include=(), exclude=(),
+                 ignore_file=IGNORE_FILE, one_filesystem=False):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.ignore_file = ignore_file
+        self.one_filesystem = one_filesystem
+
+    def rules(self, directory, parent=None):
+        """
+        Returns exclusion rules of directory - rules of its parent (or
+        exclude patterns, for walked directory itself) followed by patterns
+        of its ignore file.
+        """
+        if parent is None:
+            parent = [(directory, p) for p in self.exclude]
+        if self.ignore_file is None:
+            return parent
+        try:
+            with open(os.path.join(directory, self.ignore_file),
+                      encoding='utf-8') as f:
+                lines = [line.strip() for line in f]
+        except (OSError, ValueError):
+            return parent
+        return parent + [(directory, line) for line in lines
+                         if line and not line.startswith('#')]
+
+    @staticmethod
+    def _excluded(path, name, is_dir, rules):
+        for (base, pattern) in rules:
+            if pattern.endswith('/'):
+                if not is_dir:
+                    continue
+                pattern = pattern.rstrip('/')
+            if '/' in pattern:
+                relative = os.path.relpath(path, base).replace(os.sep, '/')
+                if fnmatch.fnmatch(relative, pattern.lstrip('/')):
+                    return True
+            elif fnmatch.fnmatch(name, pattern):
+                return True
+        return False
+
+    def accepts_directory(self, entry, rules):
+        """
+        Checks if directory (DirEntry) is to be walked.
+        """
+        return not self._excluded(entry.path, entry.name, True, rules)
+
+    def accepts_file(self, entry, rules):
+        """
+        Checks if file (DirEntry) is to be returned.
+        """
+        if entry.name == self.ignore_file:
+            return False
+        if self.include and not any(fnmatch.fnmatch(entry.name, p)
+                                    for p in self.include):
+            return False
+        if self._excluded(entry.path, entry.name, False, rules):
+            return False
+        if self.min_size is not None or self.max_size is not None:
+            size = entry.stat().st_size
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        return True
@@ -1,57 +1,586 @@
+import collections
+import concurrent.futures
+import functools
+import itertools
+import mmap
 import os
+import random
+import stat
+import sys
+import threading
+import time
 import xxhash
 import DupFinder.db
+import DupFinder.pipeline
+import DupFinder.stats
 
+# Size of a single read when hashing files. Peak memory used by hashing is
+# bound by this value, no matter how big the file is.
+CHUNK_SIZE = 1024 * 1024
+# Number of bytes taken from the beginning and from the end of the file to
+# calculate its partial hash.
+PARTIAL_SIZE = 4 * 1024
+# Size of a single read when files are compared byte by byte (see
+# compare_files). One chunk of every compared file is in memory at once.
+LOCKSTEP_CHUNK_SIZE = 256 * 1024
+# Groups of at most that many files (distinct inodes) of the same size are
+# compared byte by byte right away, bigger ones are narrowed down by hashes
+# first, so there are not too many files open at once.
+LOCKSTEP_MAX_FILES = 16
 
-def enumerate_directory(path):
+# Hash algorithms that can be used for indexing. Databases record which one
+# was used for their entries (see DupFinder.db.get_algorithm).
+ALGORITHMS = {
+    'xxh64': xxhash.xxh64,
+    'xxh3_64': xxhash.xxh3_64,
+    'xxh3_128': xxhash.xxh3_128,
+}
+DEFAULT_ALGORITHM = 'xxh64'
+
+# Number of files sent to a worker process at once when hashing with process
+# pool. Ignored by thread pools.
+MAP_CHUNKSIZE = 64
+# Number of files compared with database at once by compare_with_db. Files
+# are read from their source in such batches, so walking directory overlaps
+# with checking files found so far.
+COMPARE_BATCH_SIZE = 10000
+
+# Number of entries checked (stat-ed in parallel) at once by verify_index.
+VERIFY_BATCH_SIZE = 10000
+
+# Longest time (in seconds) entries indexed by update_index wait to be
+# committed, if there is not enough of them to fill up a batch sooner.
+CHECKPOINT_INTERVAL = 60
+
+# Read buffers are reused between calls (one per thread and chunk size).
+_buffers = threading.local()
+
+
+class FileEntry:
+    """
+    Information about single file. It takes much less memory than dictionary
+    and directory part of its path is shared with other files from the same
+    directory. Fields can be accessed as attributes or as dictionary keys,
+    so it can be used wherever dictionary with file information is expected.
+    """
+    __slots__ = ('directory', 'name', 'size', 'hash', 'partial_hash',
+                 'mtime', 'inode', 'device')
+    KEYS = ('filepath', 'size', 'hash', 'partial_hash', 'mtime', 'inode',
+            'device')
+
+    def __init__(self, filepath, size, hash=None, partial_hash=None,
+                 mtime=None, inode=None, device=None):
+        self.filepath = filepath
+        self.size = size
+        self.hash = hash
+        self.partial_hash = partial_hash
+        self.mtime = mtime
+        self.inode = inode
+        self.device = device
+
+    @property
+    def filepath(self):
+        return self.directory + self.name
+
+    @filepath.setter
+    def filepath(self, filepath):
+        (directory, self.name) = DupFinder.db.split_path(filepath)
+        self.directory = sys.intern(directory)
+
+    def __getitem__(self, key):
+        if key not in FileEntry.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in FileEntry.KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in FileEntry.KEYS
+
+    def get(self, key, default=None):
+        if key not in FileEntry.KEYS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return FileEntry.KEYS
+
+    def __eq__(self, other):
+        if not isinstance(other, FileEntry):
+            return NotImplemented
+        return all(self[key] == other[key] for key in FileEntry.KEYS)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FileEntry(%r)' % dict(self)
+
+
+def _dir_id(path):
+    """
+    Returns identity of directory (device, inode) used to not visit the same
+    directory twice (i.e. through symlinks).
     """
-    This function recursively finds all files in given directory
+    DupFinder.stats.add('stat_calls')
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino)
+
+
+def _scan_error(error, onerror):
+    DupFinder.stats.add('scan_errors')
+    if onerror is not None:
+        onerror(error)
+
+
+def enumerate_directory(path, onerror=None, skip=None, ondone=None,
+                        scan_filter=None):
+    """
+    This function finds all files in given directory and its subdirectories.
+    Directories are walked iteratively and files are yielded as soon as they
+    are found, in the same order as recursive walk would find them.
+    Symlinked directories are followed, but no directory is walked twice, so
+    symlink loops are harmless.
 
     Parameters
     ----------
     path : string
            Starting directory from which to find all files
+    onerror : function
+           Called with OSError instance for every directory or entry that
+           could not be read (i.e. permission denied). Such directories and
+           entries are skipped.
+    skip : set
+           Paths (ending with separator) of subdirectories not to be walked,
+           i.e. completed by interrupted indexing.
+    ondone : function
+           Called with path of every directory whose files (with files of its
+           subdirectories) were all yielded without errors.
+    scan_filter : DupFinder.filters.ScanFilter
+           Files and directories to be skipped. Skipped directories are not
+           listed at all.
+    Returns
+    -------
+           Generator of DirEntry objects
+    """
+    rules = None
+    try:
+        root_id = _dir_id(path)
+        visited = {root_id}
+        if scan_filter is not None:
+            rules = scan_filter.rules(path)
+        # [path, scandir iterator, walked without errors, filter rules]
+        stack = [[path, os.scandir(path), True, rules]]
+        DupFinder.stats.add('directories_scanned')
+    except OSError as e:
+        _scan_error(e, onerror)
+        return
+    try:
+        while stack:
+            try:
+                with DupFinder.stats.timed('scan'):
+                    f = next(stack[-1][1], None)
+            except OSError as e:
+                _scan_error(e, onerror)
+                stack[-1][2] = False
+                f = None
+            if f is None:
+                (done, it, complete, _) = stack.pop()
+                it.close()
+                if not complete and stack:
+                    stack[-1][2] = False
+                elif complete and ondone is not None:
+                    ondone(done)
+                continue
+            try:
+                with DupFinder.stats.timed('scan'):
+                    is_file = f.is_file()
+                    if not is_file and f.is_dir():
+                        if skip and os.path.join(f.path, '') in skip:
+                            DupFinder.stats.add('directories_skipped')
+                            continue
+                        rules = stack[-1][3]
+                        if scan_filter is not None and \
+                                not scan_filter.accepts_directory(f, rules):
+                            DupFinder.stats.add('directories_filtered')
+                            continue
+                        dir_id = _dir_id(f.path)
+                        if scan_filter is not None and \
+                                scan_filter.one_filesystem and \
+                                dir_id[0] != root_id[0]:
+                            DupFinder.stats.add('directories_filtered')
+                            continue
+                        if dir_id not in visited:
+                            visited.add(dir_id)
+                            if scan_filter is not None:
+                                rules = scan_filter.rules(f.path, rules)
+                            stack.append([f.path, os.scandir(f.path), True,
+                                          rules])
+                            DupFinder.stats.add('directories_scanned')
+                    elif is_file and scan_filter is not None and \
+                            not scan_filter.accepts_file(f, stack[-1][3]):
+                        DupFinder.stats.add('files_filtered')
+                        continue
+            except OSError as e:
+                _scan_error(e, onerror)
+                stack[-1][2] = False
+                continue
+            if is_file:
+                DupFinder.stats.add('entries_scanned')
+                yield f
+    finally:
+        for frame in stack:
+            frame[1].close()
+
+
+def make_executor(jobs, use_processes=False):
+    """
+    Creates executor that hashes files in parallel. Threads are good enough
+    for big files as xxhash releases GIL while hashing, processes may help
+    with lots of small files where Python overhead dominates.
+
+    Parameters
+    ----------
+    jobs: int
+        Number of workers. For 1 or less no executor is created.
+    use_processes: boolean
+        Use process pool instead of thread pool.
+
+    Returns
+    -------
+    concurrent.futures.Executor or None if hashing should be done serially.
+    """
+    if jobs is None or jobs <= 1:
+        return None
+    if use_processes:
+        return concurrent.futures.ProcessPoolExecutor(jobs)
+    return concurrent.futures.ThreadPoolExecutor(jobs)
+
+
+def _map(executor, func, items):
+    """
+    Maps func over items with executor (or serially if there is none).
+    Results are returned in order of items.
+    """
+    if executor is None:
+        return map(func, items)
+    return executor.map(func, items, chunksize=MAP_CHUNKSIZE)
+
+
+def _disk_key(entry):
+    """
+    Returns (device, inode) of entry used to order reads. Inode numbers
+    roughly follow placement of files on disk.
+    """
+    return (entry.get('device') or 0, entry.get('inode') or 0)
+
+
+def _completions(executor, func, items, keys, device_jobs=None):
+    """
+    Starts calls of func for all items, in order of their keys (see
+    _disk_key), and returns generator of (index of item, result) yielded as
+    soon as calls finish. With executor calls are started right away and
+    run even before their results are asked for, without it they are made
+    one by one as results are asked for.
+
+    With device_jobs set no more than that many calls for single device
+    (first part of key) are running at once, the next one is started as
+    soon as one of them finishes. Low value (1 or 2) avoids seeking of
+    spinning disks, while other devices are still read in parallel.
+    """
+    order = sorted(range(len(items)), key=keys.__getitem__)
+    if executor is None or device_jobs is None:
+        return zip(order, _map(executor, func, [items[idx] for idx in order]))
+    queues = {}
+    for idx in order:
+        queues.setdefault(keys[idx][0], collections.deque()).append(idx)
+    # Results are passed to the consumer through futures of their own, as
+    # calls are submitted later (from callbacks of the finished ones).
+    results = {concurrent.futures.Future(): idx for idx in order}
+    placeholders = {idx: future for (future, idx) in results.items()}
+    active = collections.Counter()
+    lock = threading.Lock()
+    launching = False
+
+    def finish(device, placeholder, future):
+        nonlocal launching
+        try:
+            placeholder.set_result(future.result())
+        except BaseException as e:
+            placeholder.set_exception(e)
+        with lock:
+            active[device] -= 1
+            if launching:
+                # Started calls are picked up by the running launch.
+                return
+            launching = True
+        launch()
+
+    def launch():
+        # Callbacks of calls finished already run right away, so only one
+        # thread submits at a time and others leave new calls to it.
+        nonlocal launching
+        while True:
+            with lock:
+                ready = []
+                for (device, queue) in queues.items():
+                    while queue and active[device] < device_jobs:
+                        ready.append((device, queue.popleft()))
+                        active[device] += 1
+                if not ready:
+                    launching = False
+                    return
+            for (device, idx) in ready:
+                placeholder = placeholders[idx]
+                try:
+                    future = executor.submit(func, items[idx])
+                except BaseException as e:
+                    placeholder.set_exception(e)
+                    continue
+                future.add_done_callback(
+                    functools.partial(finish, device, placeholder))
+
+    def collect():
+        try:
+            for future in concurrent.futures.as_completed(results):
+                yield (results[future], future.result())
+        finally:
+            with lock:
+                for queue in queues.values():
+                    queue.clear()
+
+    launching = True
+    launch()
+    return collect()
+
+
+def _schedule(executor, func, items, keys, device_jobs=None):
+    """
+    Calls func for all items (see _completions) and returns results in order
+    of items.
+    """
+    results = [None] * len(items)
+    for (idx, result) in _completions(executor, func, items, keys,
+                                      device_jobs):
+        results[idx] = result
+    return results
+
+
+def _get_buffer(chunk_size):
+    """
+    Returns preallocated read buffer of given size for current thread.
+    """
+    cache = getattr(_buffers, 'cache', None)
+    if cache is None:
+        cache = _buffers.cache = {}
+    buf = cache.get(chunk_size)
+    if buf is None:
+        buf = cache[chunk_size] = bytearray(chunk_size)
+    return buf
+
+
+def _hash_mmap(fo, hasher, chunk_size):
+    """
+    Feeds hasher with memory mapped file content. Returns False if file
+    cannot be mapped (i.e. it is empty or not a real file), so caller can
+    fall back to regular reads.
+    """
+    try:
+        mm = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+    with mm:
+        view = memoryview(mm)
+        try:
+            for offset in range(0, len(mm), chunk_size):
+                hasher.update(view[offset:offset + chunk_size])
+        finally:
+            view.release()
+    return True
+
+
+def _hash_stream(fo, hasher, chunk_size):
+    """
+    Feeds hasher with file content read chunk by chunk into reusable buffer.
+    """
+    buf = _get_buffer(chunk_size)
+    view = memoryview(buf)
+    try:
+        while True:
+            n = fo.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    finally:
+        view.release()
+
+
+def _advise(fo):
+    """
+    Tells OS that file will be read sequentially and only once, so it reads
+    ahead and does not push other data out of page cache. Ignored where
+    posix_fadvise is not available (i.e. Windows) or not supported.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fo.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fo.fileno(), 0, 0, os.POSIX_FADV_NOREUSE)
+    except (OSError, ValueError):
+        pass
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE, use_mmap=False,
+              algorithm=DEFAULT_ALGORITHM):
+    """
+    Calculates hash for the file of given path. File is read in chunks, so
+    memory usage does not depend on file size.
+
+    Parameters
+    ----------
+    path: string
+        Path to file to be hashed
+    chunk_size: int
+        Number of bytes read (and hashed) at once.
+    use_mmap: boolean
+        Memory map the file instead of reading it. Falls back to regular
+        reads if file cannot be mapped.
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
+
     Returns
     -------
-           List of type ScanDir
+        Hash digest calculated for given file, None if it does not exist or
+        cannot be read (counted in scan_errors).
     """
-    s = os.scandir(path)
-    rec = []
-    for f in s:
-        if f.is_file():
-            rec = rec + [f]
-        if f.is_dir():
-            rec = rec + enumerate_directory(f.path)
-    s.close()
-    return rec
+    if path is None or not os.path.isfile(path):
+        return None
+    hasher = ALGORITHMS[algorithm]()
+    try:
+        with open(path, 'rb', buffering=0) as fo:
+            _advise(fo)
+            if not use_mmap or not _hash_mmap(fo, hasher, chunk_size):
+                _hash_stream(fo, hasher, chunk_size)
+    except OSError:
+        DupFinder.stats.add('scan_errors')
+        return None
+    return hasher.hexdigest()
 
 
-def hash_file(path):
+def _read_chunk(fo, chunk_size):
+    """
+    Reads chunk of given size from unbuffered file, shorter only at its end.
     """
-    Calculates hash for the file of given path
+    chunk = fo.read(chunk_size)
+    while 0 < len(chunk) < chunk_size:
+        more = fo.read(chunk_size - len(chunk))
+        if not more:
+            break
+        chunk += more
+    return chunk
+
+
+def compare_files(paths, chunk_size=LOCKSTEP_CHUNK_SIZE):
+    """
+    Compares files (of the same size) byte by byte. All files are read in
+    lockstep, chunk by chunk, and they are split into groups of the same
+    content as soon as they diverge, so file that differs from all others
+    is not read any further. Unlike hashes, the result is exact.
+
+    Parameters
+    ----------
+    paths: list
+        Paths to files to be compared
+    chunk_size: int
+        Number of bytes read from each file at once.
+
+    Returns
+    -------
+        List of groups (with more than one file) of indexes of paths with
+        identical content, in ascending order. Files that cannot be read
+        are left out.
+    """
+    groups = []
+    opened = []
+    try:
+        group = []
+        for (idx, path) in enumerate(paths):
+            try:
+                fo = open(path, 'rb', buffering=0)
+            except OSError:
+                continue
+            opened.append(fo)
+            _advise(fo)
+            group.append((idx, fo))
+        pending = [group]
+        while pending:
+            chunks = {}
+            for (idx, fo) in pending.pop():
+                try:
+                    chunk = _read_chunk(fo, chunk_size)
+                except OSError:
+                    continue
+                chunks.setdefault(chunk, []).append((idx, fo))
+            for (chunk, members) in chunks.items():
+                if len(members) < 2:
+                    continue
+                if chunk:
+                    pending.append(members)
+                else:
+                    groups.append(sorted(idx for (idx, _) in members))
+    finally:
+        for fo in opened:
+            fo.close()
+    return sorted(groups)
+
+
+def partial_hash_file(path, partial_size=PARTIAL_SIZE,
+                      algorithm=DEFAULT_ALGORITHM):
+    """
+    Calculates cheap hash of the first and the last `partial_size` bytes of
+    the file. Files that are different in their partial hashes are surely
+    different, so full hash does not have to be calculated for them.
+    For files not bigger than 2 * `partial_size` the whole content is hashed,
+    so partial hash is the same as full hash.
 
     Parameters
     ----------
     path: string
         Path to file to be hashed
+    partial_size: int
+        Number of bytes to hash from both ends of the file.
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
 
     Returns
     -------
-        Hash digest calculated for given file
+        Hash digest calculated for given file, None if it does not exist or
+        cannot be read (counted in scan_errors).
     """
     if path is None or not os.path.isfile(path):
         return None
-    fo = open(path, 'rb')
-    c = fo.read()
-    r = xxhash.xxh64(c).hexdigest()
-    fo.close()
-    return r
+    hasher = ALGORITHMS[algorithm]()
+    try:
+        with open(path, 'rb', buffering=0) as fo:
+            if os.fstat(fo.fileno()).st_size <= 2 * partial_size:
+                _hash_stream(fo, hasher, CHUNK_SIZE)
+            else:
+                hasher.update(fo.read(partial_size))
+                fo.seek(-partial_size, os.SEEK_END)
+                hasher.update(fo.read(partial_size))
+    except OSError:
+        DupFinder.stats.add('scan_errors')
+        return None
+    return hasher.hexdigest()
 
 
-def conv_file_to_dict(file_obj, calcHashes=True):
+def conv_file_to_dict(file_obj, calcHashes=True,
+                      algorithm=DEFAULT_ALGORITHM):
     """
-    Helper method that converts ScanDir object to dictionary that can be
-    consumed by this application
+    Helper method that converts ScanDir object to FileEntry (dictionary like
+    object) that can be consumed by this application
 
     Parameters
     ----------
@@ -60,23 +589,224 @@ def conv_file_to_dict(file_obj, calcHashes=True):
     calcHashes: boolean
               If Hashes for files needs to be calculated. For optimization
               reasons that is not always desirable nor needed.
+    algorithm: string
+              Name of hash algorithm (see ALGORITHMS).
 
     Returns
     -------
-    Dictionary consumable by this application
+    FileEntry consumable by this application
     """
-    r = {'filepath': file_obj.path,
-         'size': os.stat(file_obj.path).st_size,  # file_obj.stat().st_size,
-         'hash': None}
+    DupFinder.stats.add('stat_calls')
+    with DupFinder.stats.timed('stat'):
+        st = file_obj.stat()
+    r = FileEntry(file_obj.path, st.st_size, mtime=st.st_mtime_ns,
+                  inode=st.st_ino, device=st.st_dev)
     if calcHashes:
-        r['hash'] = hash_file(file_obj.path)
+        fill_up_partial_hash(r, algorithm)
+        fill_up_hash(r, algorithm)
     return r
 
 
-def index_files_in_dir(path, calcHashes=True):
+def _count_hashing(size, full):
+    """
+    Accounts hashing of file of given size in statistics (see
+    DupFinder.stats). It is done by the caller, so work of worker processes
+    is counted as well.
+    """
+    if full:
+        DupFinder.stats.add('full_hashes')
+        DupFinder.stats.add('bytes_hashed', size)
+    else:
+        DupFinder.stats.add('partial_hashes')
+        DupFinder.stats.add('bytes_hashed', min(size, 2 * PARTIAL_SIZE))
+
+
+def _scan(path, onerror=None, skip=None, progress=False, scan_filter=None,
+          symlinks=True):
+    """
+    Walks directory yielding (FileEntry, number of links) for found files.
+    With progress, (path, None) is yielded after files of every completed
+    directory (see enumerate_directory). Without symlinks, symbolic links to
+    files are skipped.
+    """
+    done = collections.deque()
+    ondone = done.append if progress else None
+    for x in enumerate_directory(path, onerror, skip, ondone, scan_filter):
+        while done:
+            yield (done.popleft(), None)
+        if not symlinks and x.is_symlink():
+            continue
+        entry = conv_file_to_dict(x, False)
+        yield (entry, x.stat().st_nlink)
+    while done:
+        yield (done.popleft(), None)
+
+
+def _hash_entry(item, algorithm=DEFAULT_ALGORITHM):
+    """
+    Calculates partial and full hash of file given as (path, size). Small
+    files are read once, as their partial hash covers whole content.
+    """
+    (path, size) = item
+    partial = partial_hash_file(path, PARTIAL_SIZE, algorithm)
+    if partial is None or size <= 2 * PARTIAL_SIZE:
+        return (partial, partial)
+    return (partial, hash_file(path, algorithm=algorithm))
+
+
+def _hash_stage(scanned, executor=None, algorithm=DEFAULT_ALGORITHM,
+                window=DupFinder.pipeline.QUEUE_SIZE, ordered=True,
+                device_jobs=None):
+    """
+    Hashes entries coming from _scan. They are hashed in chunks of `window`
+    files, each chunk in order of files on disk (see _completions). With
+    executor, the next chunk is already being hashed while entries of the
+    current one are consumed. Files with more than one link are hashed once
+    per inode. Completed directories are passed through. Entries are yielded
+    as soon as they are hashed, in the same order as they came or, if
+    `ordered` is False, in order they were hashed. Completed directories
+    always follow all entries that came before them.
+    """
+    func = functools.partial(_hash_entry, algorithm=algorithm)
+    links = {}
+    scanned = iter(scanned)
+    started = collections.deque()
+    while True:
+        while len(started) < 2:
+            chunk = list(itertools.islice(scanned, window))
+            if not chunk:
+                break
+            started.append(_start_chunk(chunk, func, executor, links,
+                                        device_jobs))
+        if not started:
+            return
+        yield from _hash_chunk(*started.popleft(), links, ordered)
+
+
+def _start_chunk(chunk, func, executor, links, device_jobs=None):
+    """
+    Starts hashing of entries of chunk of _hash_stage (see _hash_chunk).
+    Hashes of files with more than one link are remembered in links (None
+    while they are being hashed), their other links are not hashed again.
+    """
+    todo = {}
+    deferred = []
+    for (pos, (entry, nlink)) in enumerate(chunk):
+        if nlink is None:
+            continue
+        key = _inode_key(entry)
+        if key in todo:
+            todo[key][0].append(pos)
+            DupFinder.stats.add('hard_links_skipped')
+        elif nlink > 1 and key in links:
+            # Link being hashed in previous chunk gets its hash once that
+            # chunk is done.
+            if links[key] is None:
+                deferred.append((pos, key))
+            else:
+                (entry['partial_hash'], entry['hash']) = links[key]
+            DupFinder.stats.add('hard_links_skipped')
+        else:
+            todo[key] = ([pos], nlink)
+    groups = list(todo.items())
+    for (key, (positions, nlink)) in groups:
+        size = chunk[positions[0]][0]['size']
+        _count_hashing(size, False)
+        if size > 2 * PARTIAL_SIZE:
+            _count_hashing(size, True)
+        if nlink > 1:
+            links[key] = None
+    completions = _completions(
+        executor, func,
+        [(chunk[positions[0]][0]['filepath'], chunk[positions[0]][0]['size'])
+         for (_, (positions, _)) in groups],
+        [_disk_key(chunk[positions[0]][0]) for (_, (positions, _)) in groups],
+        device_jobs)
+    return (chunk, groups, deferred, completions)
+
+
+def _hash_chunk(chunk, groups, deferred, completions, links, ordered=True):
+    """
+    Yields entries of chunk started by _start_chunk as they get hashed.
+    """
+    for (pos, key) in deferred:
+        (chunk[pos][0]['partial_hash'], chunk[pos][0]['hash']) = links[key]
+    # Positions of entries not hashed yet and of ones yielded out of order.
+    waiting = set(pos for (_, (positions, _)) in groups for pos in positions)
+    early = set()
+    head = 0
+    while True:
+        while head < len(chunk) and head not in waiting:
+            if head not in early:
+                yield chunk[head][0]
+            head += 1
+        with DupFinder.stats.timed('hashing'):
+            completed = next(completions, None)
+        if completed is None:
+            return
+        (idx, result) = completed
+        (key, (positions, nlink)) = groups[idx]
+        for pos in positions:
+            entry = chunk[pos][0]
+            (entry['partial_hash'], entry['hash']) = result
+            waiting.discard(pos)
+            if not ordered and pos > head:
+                early.add(pos)
+                yield entry
+        if nlink > 1:
+            links[key] = result
+
+
+def iter_files_in_dir(path, calcHashes=True, executor=None,
+                      algorithm=DEFAULT_ALGORITHM, onerror=None,
+                      scan_filter=None, device_jobs=None, symlinks=True):
+    """
+    Streaming version of index_files_in_dir. Directory is walked in
+    background thread while files found so far are hashed and consumed, and
+    both stages are connected with bounded queues, so memory used does not
+    depend on number of files.
+
+    Parameters
+    ----------
+    path: string
+          Starting path to index
+    calcHashes: boolean
+          If hashes need to be calculated for files.
+    executor: concurrent.futures.Executor
+          Executor used to calculate hashes in parallel (see make_executor).
+          Hashes are calculated serially if None.
+    algorithm: string
+          Name of hash algorithm (see ALGORITHMS).
+    onerror : function
+          Called with OSError instance for every directory or entry that
+          could not be read (see enumerate_directory).
+    scan_filter : DupFinder.filters.ScanFilter
+          Files and directories to be skipped (see enumerate_directory).
+    device_jobs: int
+          Maximum number of files read at once from single device (see
+          _completions), None for no limit other than number of workers.
+    symlinks: boolean
+          Include symbolic links to files. Their stat is that of the file
+          they point to, so they would look like its hard links.
+
+    Returns
+    -------
+    Generator of FileEntry objects, in order of enumerate_directory.
+    """
+    scanned = DupFinder.pipeline.background(
+        _scan(path, onerror, scan_filter=scan_filter, symlinks=symlinks))
+    if not calcHashes:
+        return (entry for (entry, _) in scanned)
+    return _hash_stage(scanned, executor, algorithm,
+                       device_jobs=device_jobs)
+
+
+def index_files_in_dir(path, calcHashes=True, executor=None,
+                       algorithm=DEFAULT_ALGORITHM, scan_filter=None,
+                       device_jobs=None, symlinks=True):
     """
     Indexes all files in directory with sub directories, returning list of
-    dictionaries with file information.
+    FileEntry objects with file information.
 
     Parameters
     ----------
@@ -85,106 +815,811 @@ def index_files_in_dir(path, calcHashes=True):
     calcHashes: boolean
           If hashes need to be calculated for files. For optimization reason
           this is often not required
+    executor: concurrent.futures.Executor
+          Executor used to calculate hashes in parallel (see make_executor).
+          Hashes are calculated serially if None.
+    algorithm: string
+          Name of hash algorithm (see ALGORITHMS).
+    scan_filter : DupFinder.filters.ScanFilter
+          Files and directories to be skipped (see enumerate_directory).
+    device_jobs: int
+          Maximum number of files read at once from single device (see
+          _completions), None for no limit other than number of workers.
+    symlinks: boolean
+          Include symbolic links to files (see iter_files_in_dir).
 
     Returns
     -------
-    List of dictionaries with files information
+    List of FileEntry objects with files information
+    """
+    return list(iter_files_in_dir(path, calcHashes, executor, algorithm,
+                                  scan_filter=scan_filter,
+                                  device_jobs=device_jobs,
+                                  symlinks=symlinks))
+
+
+def _is_unchanged(entry, indexed):
+    """
+    Checks if file seems to be the same as when it was indexed.
+    """
+    return (indexed is not None and indexed['hash'] is not None
+            and indexed['size'] == entry['size']
+            and indexed['mtime'] == entry['mtime']
+            and indexed['inode'] == entry['inode'])
+
+
+def _under_any(filepath, directories):
+    """
+    Checks if file is in one of directories (paths ending with separator) or
+    in their subdirectories.
     """
-    files = enumerate_directory(path)
-    dict_list = [conv_file_to_dict(x, calcHashes) for x in files]
-    return dict_list
+    directory = os.path.dirname(filepath)
+    while True:
+        if os.path.join(directory, '') in directories:
+            return True
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return False
+        directory = parent
 
 
-def compare_with_db(db, files):
+def _checkpoints(items, batch_size, interval):
     """
-    Compares list of files (dictionary struct) with database and returns two
-    lists of dups and non-dups files. If files suspected of being dups won't
-    have hashes calculated, this method will hash them.
+    Splits items into lists of at most batch_size items. List is cut earlier
+    if interval seconds passed since the previous one. The last list may be
+    empty.
+    """
+    batch = []
+    deadline = time.monotonic() + interval
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size or time.monotonic() >= deadline:
+            yield batch
+            batch = []
+            deadline = time.monotonic() + interval
+    yield batch
+
+
+def update_index(db, path, executor=None, prune=False, resume=False,
+                 scan_filter=None, device_jobs=None):
+    """
+    Incrementally indexes files in directory. Files already in database with
+    the same size, modification time and inode are skipped, new and changed
+    files are hashed and stored (replacing their previous entries). Files
+    are hashed with algorithm used by database.
+    Entries are committed in batches (at least every CHECKPOINT_INTERVAL
+    seconds, files are passed on as soon as they are hashed) together with
+    list of directories completed so far, so interrupted indexing can be
+    resumed without walking them again.
 
     Parameters
     ----------
     db : sqlite3.Connection
         Connection to database
-    files: dict
-        Dictionary of suspected files.
+    path: string
+        Starting path to index
+    executor: concurrent.futures.Executor
+        Executor used to calculate hashes in parallel (see make_executor).
+    prune: boolean
+        Remove entries of files that no longer exist in the directory.
+    resume: boolean
+        Skip directories completed by previous, interrupted indexing of the
+        same path. Otherwise its progress is forgotten.
+    scan_filter : DupFinder.filters.ScanFilter
+        Files and directories to be skipped (see enumerate_directory).
+        Entries of skipped files that still exist are not pruned.
+    device_jobs: int
+        Maximum number of files read at once from single device (see
+        _completions), None for no limit other than number of workers.
+
+    Returns
+    -------
+    (changed, unchanged, removed)
+        Tuple of number of (re)indexed files, number of skipped files and
+        list of paths removed from database. Files in skipped directories
+        are counted in neither. Entries are not kept, so memory used does
+        not depend on number of files (other than indexed ones).
+    """
+    skip = set()
+    if resume:
+        skip = DupFinder.db.get_scan_progress(db, path)
+    else:
+        DupFinder.db.clear_scan_progress(db, path)
+    indexed = {row['filepath']: row
+               for row in DupFinder.db.get_under_path(db, path)
+               if not skip or not _under_any(row['filepath'], skip)}
+    counts = collections.Counter()
+
+    def modified():
+        for (entry, nlink) in DupFinder.pipeline.background(
+                _scan(path, skip=skip, progress=True,
+                      scan_filter=scan_filter)):
+            if nlink is None:
+                yield (entry, nlink)
+            elif _is_unchanged(entry, indexed.pop(entry['filepath'], None)):
+                counts['unchanged'] += 1
+                DupFinder.stats.add('files_unchanged')
+                DupFinder.stats.add('files_done')
+            else:
+                yield (entry, nlink)
+
+    def hashed():
+        algorithm = DupFinder.db.get_algorithm(db)
+        for entry in _hash_stage(modified(), executor, algorithm,
+                                 ordered=False, device_jobs=device_jobs):
+            if isinstance(entry, str):
+                # Completed directory.
+                yield entry
+                continue
+            DupFinder.stats.add('files_done')
+            # Files that disappeared while being hashed are not stored.
+            if entry['hash'] is not None:
+                counts['changed'] += 1
+                yield entry
+
+    # Entries are stored (and committed) in batches while directory is still
+    # being walked and hashed. Directories are recorded as completed in the
+    # same transaction as the last of their files.
+    try:
+        for batch in _checkpoints(hashed(), DupFinder.db.BATCH_SIZE,
+                                  CHECKPOINT_INTERVAL):
+            entries = []
+            for item in batch:
+                if isinstance(item, str):
+                    DupFinder.db.add_scan_progress(db, path, item)
+                else:
+                    entries.append(item)
+            DupFinder.db.add_items(db, entries, rebuild_index=False)
+            DupFinder.stats.add('checkpoints')
+    except BaseException:
+        # Only completed checkpoints are kept.
+        db.rollback()
+        raise
+    DupFinder.db.clear_scan_progress(db, path)
+    removed = []
+    if prune:
+        removed = [filepath for filepath in indexed
+                   if scan_filter is None or not os.path.isfile(filepath)]
+        DupFinder.db.remove_items(db, removed)
+    return (counts['changed'], counts['unchanged'], removed)
+
+
+def rehash_index(db, algorithm, executor=None, device_jobs=None):
+    """
+    Recalculates hashes of all entries in database with another algorithm,
+    which is then recorded as algorithm of the database. Size, modification
+    time and inode of entries are refreshed as well. Entries of files that no
+    longer exist are removed. Database is changed in single transaction, so
+    it never contains hashes of both algorithms.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Connection to database
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
+    executor: concurrent.futures.Executor
+        Executor used to calculate hashes in parallel (see make_executor).
+    device_jobs: int
+        Maximum number of files read at once from single device (see
+        _completions), None for no limit other than number of workers.
+
+    Returns
+    -------
+    (rehashed, removed)
+        Tuple of list of rehashed entries and list of removed paths.
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unknown hash algorithm: ' + algorithm)
+    entries = []
+    removed = []
+    for entry in DupFinder.db.iterate_items(db):
+        DupFinder.stats.add('entries_scanned')
+        DupFinder.stats.add('stat_calls')
+        try:
+            st = os.stat(entry['filepath'])
+        except OSError:
+            removed.append(entry['filepath'])
+            continue
+        entries.append(FileEntry(entry['filepath'], st.st_size,
+                                 mtime=st.st_mtime_ns, inode=st.st_ino,
+                                 device=st.st_dev))
+    fill_up_partial_hashes(entries, executor, algorithm,
+                           device_jobs=device_jobs)
+    fill_up_hashes(entries, executor, algorithm, device_jobs=device_jobs)
+    DupFinder.stats.add('files_done', len(entries))
+    removed.extend(e['filepath'] for e in entries if e['hash'] is None)
+    entries = [e for e in entries if e['hash'] is not None]
+    DupFinder.db.replace_hashes(db, entries, removed, algorithm)
+    return (entries, removed)
+
+
+def _stat_path(path):
+    """
+    Returns (size, mtime, inode, device) of file or None if it does not exist
+    (or is not a regular file).
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+
+def verify_index(db, executor=None, rehash=0.0, fix=False,
+                 device_jobs=None):
+    """
+    Checks entries of database against files. Entries are read in batches,
+    their files are stat-ed in parallel and each batch is hashed (and fixed)
+    before the next one is read. Entries of files that no longer
+    exist are missing, of files with other size, modification time or inode
+    changed and entries without hash unhashed. Part of the other entries
+    can be hashed again to find files changed without trace in their
+    metadata (or damaged).
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Connection to database
+    executor: concurrent.futures.Executor
+        Executor used to stat and hash files in parallel (see
+        make_executor).
+    rehash: float
+        Fraction (0 to 1) of unchanged entries, picked at random, whose files
+        are hashed again and compared with entries.
+    fix: boolean
+        Remove missing entries and store current metadata and hashes of
+        changed, unhashed and mismatched ones.
+    device_jobs: int
+        Maximum number of files read at once from single device (see
+        _completions), None for no limit other than number of workers.
+
+    Returns
+    -------
+    (missing, changed, unhashed, mismatched)
+        Tuple of lists of paths of entries found in each state.
+    """
+    algorithm = DupFinder.db.get_algorithm(db)
+    missing = []
+    changed = []
+    unhashed = []
+    mismatched = []
+    # Batches are read by ranges of row ids, so fixes of one batch do not
+    # disturb reading of the next.
+    for batch in DupFinder.db.iterate_batches(db, VERIFY_BATCH_SIZE):
+        DupFinder.stats.add('entries_scanned', len(batch))
+        DupFinder.stats.add('stat_calls', len(batch))
+        with DupFinder.stats.timed('stat'):
+            stats = list(_map(executor, _stat_path,
+                              [row['filepath'] for row in batch]))
+        gone = []
+        checked = []
+        for (row, st) in zip(batch, stats):
+            if st is None:
+                gone.append(row['filepath'])
+                continue
+            entry = FileEntry(row['filepath'], st[0], mtime=st[1],
+                              inode=st[2], device=st[3])
+            if row['hash'] is None:
+                checked.append((row, entry, unhashed))
+            elif not _is_unchanged(entry, row):
+                checked.append((row, entry, changed))
+            elif rehash and random.random() < rehash:
+                checked.append((row, entry, mismatched))
+        entries = [entry for (_, entry, _) in checked]
+        fill_up_partial_hashes(entries, executor, algorithm,
+                               device_jobs=device_jobs)
+        fill_up_hashes(entries, executor, algorithm, device_jobs=device_jobs)
+        refresh = []
+        for (row, entry, state) in checked:
+            if entry['hash'] is None:
+                # File disappeared while being hashed.
+                gone.append(row['filepath'])
+            elif state is not mismatched or (
+                    entry['hash'] != row['hash'] or row['partial_hash'] not in
+                    (None, entry['partial_hash'])):
+                state.append(row['filepath'])
+                refresh.append(entry)
+        missing.extend(gone)
+        DupFinder.stats.add('files_done', len(batch))
+        if fix:
+            DupFinder.db.remove_items(db, gone)
+            DupFinder.db.add_items(db, refresh, rebuild_index=False)
+    return (missing, changed, unhashed, mismatched)
+
+
+def _match_with_db(db, files, executor, algorithm, index_filter=None,
+                   device_jobs=None):
+    """
+    Returns set of indexes of files that have their duplicate in database.
+    """
+    # Candidates are narrowed down in stages, each resolved with one query.
+    # Filter rejects files before query, sizes it knows exactly.
+    ids = range(len(files))
+    for (fill_up, stage) in ((None, 'size'),
+                             (fill_up_partial_hashes, 'partial_hash'),
+                             (fill_up_hashes, 'hash')):
+        if fill_up is not None:
+            fill_up([files[idx] for idx in ids], executor, algorithm,
+                    device_jobs=device_jobs)
+        candidates = len(ids)
+        if index_filter is not None and stage == 'size':
+            ids = [idx for idx in ids
+                   if index_filter.has_size(files[idx]['size'])]
+            DupFinder.stats.add('rejected_by_size', candidates - len(ids))
+            continue
+        if index_filter is not None and stage == 'partial_hash':
+            ids = [idx for idx in ids if index_filter.may_have_partial_hash(
+                files[idx]['size'], files[idx]['partial_hash'])]
+        ids = DupFinder.db.match_suspects(
+            db, ((idx, files[idx]['size'], files[idx]['partial_hash'],
+                  files[idx]['hash']) for idx in ids), stage)
+        DupFinder.stats.add('rejected_by_' + stage, candidates - len(ids))
+    DupFinder.stats.add('files_done', len(files))
+    return set(ids)
+
+
+def compare_with_db(db, files, executor=None, index_filter=None,
+                    device_jobs=None):
+    """
+    Compares list of files (FileEntry or dictionary struct) with database
+    and returns two lists of dups and non-dups files. If files suspected of
+    being dups won't have hashes calculated, this method will hash them.
+    Partial hash is checked first, so files that differ from all same sized
+    entries in the database near their beginning or end are never fully
+    read. Each stage (size, partial hash, hash) is checked for whole batch
+    of files with single query. Files are hashed with algorithm used by
+    database.
+
+    Parameters
+    ----------
+    db : sqlite3.Connection
+        Connection to database
+    files: iterable
+        File entries of suspected files. Can be a generator (i.e. from
+        iter_files_in_dir), it is consumed in batches of COMPARE_BATCH_SIZE.
+    executor: concurrent.futures.Executor
+        Executor used to calculate hashes in parallel (see make_executor).
+    index_filter: DupFinder.filters.IndexFilter
+        Sizes (and partial hashes) of indexed files loaded in advance (see
+        DupFinder.filters.load_index_filter). Files of sizes not in the index
+        are then rejected without any query.
+    device_jobs: int
+        Maximum number of files read at once from single device (see
+        _completions), None for no limit other than number of workers.
 
     Returns
     -------
     (new_files, dup_files)
         Tuple, where first entry is list of not recognized files and second
-        entry is list of possible duplicates.
+        entry is list of possible duplicates. Both lists keep order of files.
     """
+    algorithm = DupFinder.db.get_algorithm(db)
     new_files = []
     dup_files = []
-    for suspect in files:
-        dba = DupFinder.db.get_by_size(db, suspect['size'])
-        if dba is None or len(dba) == 0:
-            new_files.append(suspect)
-        else:
-            if suspect['hash'] is None:
-                suspect['hash'] = hash_file(suspect['filepath'])
-            # use generator here for (ab)use of short-circuit functionality
-            found_dups = (dba_dups['hash'] == suspect['hash']
-                          for dba_dups in dba)
-            if any(found_dups) > 0:
-                dup_files.append(suspect)
-            else:
-                new_files.append(suspect)
+    files = iter(files)
+    while True:
+        batch = list(itertools.islice(files, COMPARE_BATCH_SIZE))
+        if not batch:
+            break
+        dups = _match_with_db(db, batch, executor, algorithm, index_filter,
+                              device_jobs)
+        for (idx, f) in enumerate(batch):
+            (dup_files if idx in dups else new_files).append(f)
     return (new_files, dup_files)
 
 
-def fill_up_hashes(files):
-    """ Fill up hashes in whole list
+def _inode_key(entry):
+    """
+    Returns key identifying file data - (device, inode), so hard links of the
+    same file share it. Entries without inode information (i.e. on Windows
+    where DirEntry does not provide it) get key of their own.
+    """
+    if not entry.get('inode'):
+        return id(entry)
+    return (entry.get('device'), entry['inode'])
+
+
+def _fill_up(files, key, func, executor=None, cache=None,
+             algorithm=DEFAULT_ALGORITHM, device_jobs=None):
+    """
+    Fills up key in entries that miss it with value from cache or result of
+    func called on their path (see _schedule). Each inode is processed once
+    and result is shared by its links. Returns list of processed entries and
+    list of results.
+    """
+    todo = {}
+    for suspect in files:
+        if suspect[key] is None and cache is not None:
+            suspect[key] = cache.get(suspect, key, algorithm)
+        if suspect[key] is None:
+            todo.setdefault(_inode_key(suspect), []).append(suspect)
+    links = list(todo.values())
+    for entries in links:
+        _count_hashing(entries[0].get('size') or 0, key == 'hash')
+        DupFinder.stats.add('hard_links_skipped', len(entries) - 1)
+    with DupFinder.stats.timed('hashing'):
+        results = _schedule(executor, func,
+                            [entries[0]['filepath'] for entries in links],
+                            [_disk_key(entries[0]) for entries in links],
+                            device_jobs)
+    for (entries, result) in zip(links, results):
+        for suspect in entries:
+            suspect[key] = result
+    return (links, results)
+
+
+def fill_up_hashes(files, executor=None, algorithm=DEFAULT_ALGORITHM,
+                   cache=None, device_jobs=None):
+    """ Fill up hashes in whole list. Hard linked files are hashed once.
     Parameters
     ----------
     files: list
-        list of dictionary entries
+        list of file entries (FileEntry objects or dictionaries)
+    executor: concurrent.futures.Executor
+        Executor used to calculate hashes in parallel (see make_executor).
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
+    cache: DupFinder.cache.HashCache
+        Cache of hashes of unchanged files, consulted before hashing and
+        updated afterwards.
+    device_jobs: int
+        Maximum number of files read at once from single device (see
+        _completions), None for no limit other than number of workers.
     """
-    for suspect in files:
-        fill_up_hash(suspect)
+    (links, _) = _fill_up(files, 'hash',
+                          functools.partial(hash_file, algorithm=algorithm),
+                          executor, cache, algorithm, device_jobs)
+    if cache is not None:
+        cache.put([f for entries in links for f in entries], algorithm)
 
 
-def fill_up_hash(entry):
+def fill_up_hash(entry, algorithm=DEFAULT_ALGORITHM, cache=None):
     """ Fill up hash in dictionary
     Parameters
     ----------
     files: dictionary
         FileDup dictionary.
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
+    cache: DupFinder.cache.HashCache
+        Cache of hashes of unchanged files (see fill_up_hashes).
     """
+    if entry['hash'] is None and cache is not None:
+        entry['hash'] = cache.get(entry, 'hash', algorithm)
     if entry['hash'] is None:
-        entry['hash'] = hash_file(entry['filepath'])
+        entry['hash'] = hash_file(entry['filepath'], algorithm=algorithm)
+        if cache is not None:
+            cache.put([entry], algorithm)
+
+
+def fill_up_partial_hashes(files, executor=None,
+                           algorithm=DEFAULT_ALGORITHM, cache=None,
+                           device_jobs=None):
+    """ Fill up partial hashes in whole list (and full hashes of small
+    files, see fill_up_partial_hash). Hard linked files are hashed once.
+    Parameters
+    ----------
+    files: list
+        list of file entries (FileEntry objects or dictionaries)
+    executor: concurrent.futures.Executor
+        Executor used to calculate hashes in parallel (see make_executor).
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
+    cache: DupFinder.cache.HashCache
+        Cache of hashes of unchanged files (see fill_up_hashes).
+    device_jobs: int
+        Maximum number of files read at once from single device (see
+        _completions), None for no limit other than number of workers.
+    """
+    func = functools.partial(partial_hash_file, partial_size=PARTIAL_SIZE,
+                             algorithm=algorithm)
+    (links, digests) = _fill_up(files, 'partial_hash', func, executor, cache,
+                                algorithm, device_jobs)
+    for (entries, digest) in zip(links, digests):
+        for suspect in entries:
+            if suspect['hash'] is None and \
+                    suspect['size'] <= 2 * PARTIAL_SIZE:
+                suspect['hash'] = digest
+    if cache is not None:
+        cache.put([f for entries in links for f in entries], algorithm)
+
+
+def fill_up_partial_hash(entry, algorithm=DEFAULT_ALGORITHM):
+    """ Fill up partial hash in dictionary. For small files partial hash
+    covers whole content, so full hash is filled up as well.
+    Parameters
+    ----------
+    entry: dictionary
+        FileDup dictionary.
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
+    """
+    fill_up_partial_hashes([entry], None, algorithm)
 
 
-def FindDupFilesInDirectory(directory, delete_duplicates=False):
-    """ Finds Duplicated Files in given directory (recursive) and optionally deletes them.
+def _split_by(entries, key):
+    """
+    Splits entries into groups with the same value of given key. Only groups
+    with more than one entry are returned, entries which could not be hashed
+    (value None) are dropped.
+    """
+    groups = {}
+    for entry in entries:
+        if entry[key] is not None:
+            groups.setdefault(entry[key], []).append(entry)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def _inode_count(group):
+    return len(set(_inode_key(f) for f in group))
+
+
+def _compare_groups(groups, executor=None, device_jobs=None):
+    """
+    Splits groups of entries into groups of files with identical content,
+    comparing them byte by byte (see compare_files). Each inode is read
+    once and its links follow it. Entries keep their order.
+    """
+    links = []
+    for group in groups:
+        by_inode = {}
+        for f in group:
+            by_inode.setdefault(_inode_key(f), []).append(f)
+        links.append(list(by_inode.values()))
+    DupFinder.stats.add('files_compared', sum(len(g) for g in links))
+    with DupFinder.stats.timed('comparing'):
+        results = _schedule(executor, compare_files,
+                            [[entries[0]['filepath'] for entries in g]
+                             for g in links],
+                            [_disk_key(g[0][0]) for g in links],
+                            device_jobs)
+    split = []
+    for (group, group_links, result) in zip(groups, links, results):
+        position = {id(f): idx for (idx, f) in enumerate(group)}
+        matched = set(idx for indexes in result for idx in indexes)
+        split.extend(sorted((f for idx in indexes for f in group_links[idx]),
+                            key=lambda f: position[id(f)])
+                     for indexes in result)
+        split.extend(entries for (idx, entries) in enumerate(group_links)
+                     if idx not in matched and len(entries) > 1)
+    return split
+
+
+def _compare_with_first(groups, executor=None, device_jobs=None):
+    """
+    Splits groups of entries too big to be compared at once (see
+    _compare_groups) into groups of files with identical content. Inodes of
+    group are compared in batches of LOCKSTEP_MAX_FILES - 1, each batch
+    together with the first inode of the group. Entries that differ from it
+    are split the same way, until few enough are left for _compare_groups.
+    """
+    split = []
+    while groups:
+        small = [g for g in groups if _inode_count(g) <= LOCKSTEP_MAX_FILES]
+        split.extend(_compare_groups(small, executor, device_jobs))
+        groups = [g for g in groups if _inode_count(g) > LOCKSTEP_MAX_FILES]
+        step = LOCKSTEP_MAX_FILES - 1
+        batches = []
+        for group in groups:
+            by_inode = {}
+            for f in group:
+                by_inode.setdefault(_inode_key(f), []).append(f)
+            inodes = list(by_inode.values())
+            batches.extend([inodes[0]] + inodes[start:start + step]
+                           for start in range(1, len(inodes), step))
+        DupFinder.stats.add('files_compared', sum(len(b) for b in batches))
+        with DupFinder.stats.timed('comparing'):
+            results = _schedule(executor, compare_files,
+                                [[entries[0]['filepath'] for entries in b]
+                                 for b in batches],
+                                [_disk_key(b[0][0]) for b in batches],
+                                device_jobs)
+        same = set()
+        for (batch, result) in zip(batches, results):
+            for indexes in result:
+                if 0 in indexes:
+                    same.update(_inode_key(batch[idx][0]) for idx in indexes)
+        remaining = []
+        for group in groups:
+            first = _inode_key(group[0])
+            matched = [f for f in group
+                       if _inode_key(f) == first or _inode_key(f) in same]
+            rest = [f for f in group
+                    if _inode_key(f) != first and _inode_key(f) not in same]
+            if len(matched) > 1:
+                split.append(matched)
+            if len(rest) > 1:
+                remaining.append(rest)
+        groups = remaining
+    return split
+
+
+def group_duplicates(files, executor=None, algorithm=DEFAULT_ALGORITHM,
+                     cache=None, compare_bytes=False, device_jobs=None):
+    """ Groups files with identical content. Files are bucketed by size first,
+    then by partial hash and only then by full hash, so files are read only
+    if there is another file of the same size (and partial hash). Hard links
+    of the same file are grouped without being read at all, if there is no
+    other file of their size.
+    Parameters
+    ----------
+    files: list
+        list of file entries (FileEntry objects or dictionaries)
+    executor: concurrent.futures.Executor
+        Executor used to calculate hashes in parallel (see make_executor).
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
+    cache: DupFinder.cache.HashCache
+        Cache of hashes of unchanged files (see fill_up_hashes).
+    compare_bytes: boolean
+        Confirm duplicates byte by byte (see compare_files). Groups of up to
+        LOCKSTEP_MAX_FILES files are compared without hashing them, bigger
+        ones once hashes narrowed them down to that many files. Groups still
+        bigger than that are compared in batches against their first file.
+    device_jobs: int
+        Maximum number of files read at once from single device (see
+        _completions), None for no limit other than number of workers.
+    Returns
+    -------
+    List of duplicate groups. Each group is a list of entries in the order
+    they were given, groups are ordered by their first entry.
+    """
+    by_size = {}
+    for f in files:
+        by_size.setdefault(f['size'], []).append(f)
+    dup_groups = []
+    linked_groups = []
+    unique = 0
+    for g in by_size.values():
+        if len(g) < 2:
+            unique += 1
+            continue
+        if len(set(_inode_key(f) for f in g)) == 1:
+            linked_groups.append(g)
+        else:
+            dup_groups.append(g)
+    DupFinder.stats.add('rejected_by_size', unique)
+    DupFinder.stats.add('files_done', unique)
+    compared = []
+    for (fill_up, key) in ((fill_up_partial_hashes, 'partial_hash'),
+                           (fill_up_hashes, 'hash'), (None, None)):
+        if compare_bytes:
+            small = [g for g in dup_groups
+                     if _inode_count(g) <= LOCKSTEP_MAX_FILES]
+            dup_groups = [g for g in dup_groups
+                          if _inode_count(g) > LOCKSTEP_MAX_FILES]
+            same = _compare_groups(small, executor, device_jobs)
+            compared.extend(same)
+            DupFinder.stats.add('rejected_by_bytes', sum(
+                len(g) for g in small) - sum(len(g) for g in same))
+        if fill_up is None:
+            if compare_bytes:
+                same = _compare_with_first(dup_groups, executor, device_jobs)
+                compared.extend(same)
+                DupFinder.stats.add('rejected_by_bytes', sum(
+                    len(g) for g in dup_groups) - sum(len(g) for g in same))
+                dup_groups = []
+            break
+        candidates = [f for group in dup_groups for f in group]
+        fill_up(candidates, executor, algorithm, cache, device_jobs)
+        dup_groups = [split for group in dup_groups
+                      for split in _split_by(group, key)]
+        DupFinder.stats.add('rejected_by_' + key, len(candidates) - sum(
+            len(group) for group in dup_groups))
+    dup_groups.extend(compared)
+    dup_groups.extend(linked_groups)
+    DupFinder.stats.add('files_done', len(files) - unique)
+    position = {id(f): idx for (idx, f) in enumerate(files)}
+    dup_groups.sort(key=lambda g: position[id(g[0])])
+    return dup_groups
+
+
+def replace_with_link(original, duplicate):
+    """ Replaces duplicate file with hard link to original one. Link is
+    created under unique temporary name in directory of duplicate first, so
+    duplicate is never lost (and link left by interrupted run is no obstacle).
+    Parameters
+    ----------
+    original: string
+        Path to file that is kept
+    duplicate: string
+        Path to file that is replaced
+    Returns
+    -------
+    bool
+        If file was replaced. Files on different devices cannot be linked.
+    """
+    if os.stat(original).st_dev != os.stat(duplicate).st_dev:
+        return False
+    # Name is picked again if it is taken.
+    while True:
+        tmp = os.path.join(os.path.dirname(duplicate),
+                           '.dupfinder-link-%016x' % random.getrandbits(64))
+        try:
+            os.link(original, tmp)
+            break
+        except FileExistsError:
+            continue
+    try:
+        os.replace(tmp, duplicate)
+    except OSError:
+        os.remove(tmp)
+        raise
+    return True
+
+
+def FindDupFilesInDirectory(directory, delete_duplicates=False,
+                            executor=None, algorithm=DEFAULT_ALGORITHM,
+                            link_duplicates=False, cache=None,
+                            compare_bytes=False, scan_filter=None,
+                            onskip=None, device_jobs=None):
+    """ Finds Duplicated Files in given directory (recursive) and optionally
+    deletes them or replaces them with hard links. Symbolic links to files
+    are left out.
     Parameters
     ----------
     directory: string
         Directory to start searching from
     delete_duplicates: boolean
-        Whether to delete found duplicates. Defaults to True
+        Whether to delete found duplicates. Defaults to False
+    executor: concurrent.futures.Executor
+        Executor used to calculate hashes in parallel (see make_executor).
+    algorithm: string
+        Name of hash algorithm (see ALGORITHMS).
+    link_duplicates: boolean
+        Whether to replace found duplicates with hard links to first file of
+        their group. Ignored if delete_duplicates is set.
+    cache: DupFinder.cache.HashCache
+        Cache of hashes, so files unchanged since previous run are not hashed
+        again (see DupFinder.cache.open_cache).
+    compare_bytes: boolean
+        Confirm duplicates byte by byte instead of trusting hashes (see
+        group_duplicates).
+    scan_filter: DupFinder.filters.ScanFilter
+        Files and directories to be skipped (see enumerate_directory).
+    onskip: function
+        Called with path of duplicate that was not replaced with hard link,
+        because it is on other device than first file of its group.
+    device_jobs: int
+        Maximum number of files read at once from single device (see
+        _completions), None for no limit other than number of workers.
     Returns
     -------
-    (files, duplicated_files): tuple
-        files - files that have no duplicates
-        duplicated_files - files that are duplicated
+    (files, dup_groups, linked): tuple
+        files - files that have no duplicates and first files of each
+                duplicate group
+        dup_groups - list of groups of duplicated file paths. First file of
+                     each group is the one that is kept, the others are its
+                     duplicates.
+        linked - duplicates that are already hard links of earlier file in
+                 their group, so deleting them does not free any space.
     """
-    files = index_files_in_dir(directory, False)
-    dup_files = []
-    new_files = []
-    for (idx, f) in enumerate(files):
-        if 'marked' not in f:
-            new_files.append(f['filepath'])
-        for i in range(idx+1, len(files)):
-            if f['size'] == files[i]['size'] and 'marked' not in files[i]:
-                # We have potentially duplicate here.
-                fill_up_hash(f)
-                fill_up_hash(files[i])
-                if (f['hash'] == files[i]['hash']):
-                    # We have duplicate!
-                    dup_files.append(files[i]['filepath'])
-                    files[i]['marked'] = True  # This has been checked already
-    if delete_duplicates:
-        for f in dup_files:
-            os.remove(f)
-    return (new_files, dup_files)
+    # Symbolic links are not copies of files they point to, yet they share
+    # inode with them.
+    files = index_files_in_dir(directory, False, scan_filter=scan_filter,
+                               symlinks=False)
+    groups = group_duplicates(files, executor, algorithm, cache,
+                              compare_bytes, device_jobs)
+    dup_groups = [[f['filepath'] for f in group] for group in groups]
+    linked = []
+    for group in groups:
+        seen = set()
+        for f in group:
+            if _inode_key(f) in seen:
+                linked.append(f['filepath'])
+            seen.add(_inode_key(f))
+    duplicates = set(path for group in dup_groups for path in group[1:])
+    new_files = [f['filepath'] for f in files
+                 if f['filepath'] not in duplicates]
+    for group in groups:
+        for f in group[1:]:
+            if delete_duplicates:
+                os.remove(f['filepath'])
+            elif link_duplicates and _inode_key(f) != _inode_key(group[0]):
+                if not replace_with_link(group[0]['filepath'],
+                                         f['filepath']) and onskip:
+                    onskip(f['filepath'])
+    return (new_files, dup_groups, linked)
@@ -0,0 +1,76 @@
+import queue
+import threading
+
+# Maximum number of items waiting between two stages of processing. Stage
+# that gets that far ahead of the next one waits (backpressure), so memory
+# used does not depend on number of files.
+QUEUE_SIZE = 1024
+# How often (in seconds) blocked producer checks if consumer is still there.
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class _Failure:
+    """
+    Exception raised by producer, passed to consumer to be raised there.
+    """
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+def background(iterable, maxsize=QUEUE_SIZE):
+    """
+    Iterates over iterable in background thread and yields its items through
+    bounded queue, so producing next items overlaps with processing of the
+    previous ones. Exceptions of producer are raised in consumer. If consumer
+    stops iterating, producer is stopped as well.
+
+    Parameters
+    ----------
+    iterable: iterable
+        Source of items, i.e. directory walker
+    maxsize: int
+        Maximum number of items produced ahead of consumer.
+
+    Returns
+    -------
+    Generator of items of iterable, in the same order.
+    """
+    q = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Failure(e))
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
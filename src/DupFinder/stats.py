@@ -0,0 +1,133 @@
+import collections
+import contextlib
+import sys
+import threading
+import time
+
+# Counters and timers are shared by all threads of the process. Work done by
+# worker processes (--use-processes) is accounted for by the parent process.
+_lock = threading.Lock()
+_counters = collections.Counter()
+_seconds = collections.Counter()
+_started = time.perf_counter()
+
+
+def add(name, n=1):
+    """
+    Increases counter of given name by n.
+    """
+    with _lock:
+        _counters[name] += n
+
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Context manager (or decorator) adding time spent in it to timer of given
+    name. Timers of work done in parallel add up, so they can exceed
+    elapsed time.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _seconds[name] += elapsed
+
+
+def reset():
+    """
+    Clears all counters and timers and restarts elapsed time.
+    """
+    global _started
+    with _lock:
+        _counters.clear()
+        _seconds.clear()
+        _started = time.perf_counter()
+
+
+def snapshot():
+    """
+    Returns
+    -------
+    Dictionary with `elapsed` time in seconds, `counters` and `seconds`
+    (timers) dictionaries. It can be serialized to JSON.
+    """
+    with _lock:
+        return {
+            'elapsed': time.perf_counter() - _started,
+            'counters': dict(sorted(_counters.items())),
+            'seconds': dict(sorted(_seconds.items())),
+        }
+
+
+def format_stats(stats):
+    """
+    Formats snapshot of statistics as human readable text.
+    """
+    elapsed = max(stats['elapsed'], 1e-9)
+    lines = ['elapsed: %.3f s' % elapsed]
+    for (name, value) in stats['counters'].items():
+        lines.append('%s: %d (%.1f/s)' % (name, value, value / elapsed))
+    for (name, value) in stats['seconds'].items():
+        lines.append('%s time: %.3f s' % (name, value))
+    return '\n'.join(lines)
+
+
+def _format_eta(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+
+def format_progress(stats):
+    """
+    Formats snapshot of statistics as single progress line with throughput
+    and estimated time left. Estimate assumes that files found so far are
+    all files left to process, so it grows while directory is walked.
+    """
+    counters = stats['counters']
+    elapsed = max(stats['elapsed'], 1e-9)
+    scanned = counters.get('entries_scanned', 0)
+    done = counters.get('files_done', 0)
+    hashed = counters.get('bytes_hashed', 0)
+    line = '%d files found, %d done (%.1f files/s), %.1f MB hashed ' \
+        '(%.1f MB/s)' % (scanned, done, done / elapsed,
+                         hashed / (1024 * 1024),
+                         hashed / (1024 * 1024) / elapsed)
+    if done:
+        line += ', ETA %s' % _format_eta(
+            max(scanned - done, 0) * elapsed / done)
+    return line
+
+
+class Progress:
+    """
+    Prints progress line every `interval` seconds in background thread,
+    between start and stop (or while used as context manager).
+    """
+
+    def __init__(self, interval, out=None):
+        self.interval = interval
+        self.out = out if out is not None else sys.stderr
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            print(format_progress(snapshot()), file=self.out, flush=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
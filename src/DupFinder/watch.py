@@ -0,0 +1,393 @@
+import collections
+import ctypes
+import ctypes.util
+import json
+import os
+import selectors
+import socket
+import stat
+import struct
+import time
+import DupFinder.db
+import DupFinder.fs
+import DupFinder.pipeline
+import DupFinder.stats
+
+# Changes are applied to index once no new events came for that long (in
+# seconds), so files being written are not hashed over and over.
+SETTLE_TIME = 1.0
+# Default path of socket answering queries of watch daemon.
+DEFAULT_SOCKET = os.path.join('~', '.dupfinder.sock')
+# Longest request (one JSON object per line) accepted from client.
+MAX_REQUEST = 64 * 1024
+
+# Events of inotify(7) and flags of inotify_init1(2).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_ONLYDIR)
+# struct inotify_event without name: wd, mask, cookie, len.
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    Thin wrapper of Linux inotify(7) API, through libc. Raises OSError where
+    it is not available.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Starts watching directory, returns watch descriptor.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        Returns list of (wd, mask, name) of events waiting to be read.
+        """
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, _, length) = EVENT.unpack_from(buf, offset)
+            offset += EVENT.size
+            name = buf[offset:offset + length].split(b'\0', 1)[0]
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Keeps index of directory up to date while files in it are created,
+    modified and deleted, and answers whether a file is a duplicate of an
+    indexed one from in-memory map of sizes, partial hashes and hashes of
+    all entries of database.
+    """
+
+    def __init__(self, db, path, executor=None, device_jobs=None):
+        self.db = db
+        self.path = os.path.abspath(path)
+        self.executor = executor
+        self.device_jobs = device_jobs
+        self.algorithm = DupFinder.db.get_algorithm(db)
+        self.inotify = Inotify()
+        # watch descriptor -> directory path
+        self.watches = {}
+        self.sizes = collections.Counter()
+        self.partials = collections.Counter()
+        self.hashes = collections.Counter()
+        self.changed = set()
+        self.removed = set()
+        self.overflow = False
+        self.last_event = None
+        self._stopped = False
+
+    def start(self):
+        """
+        Watches directory tree, brings index of it up to date (see
+        DupFinder.fs.update_index) and loads sizes and hashes of all entries.
+        Watches are set first, so no change is missed.
+        """
+        self._watch_tree(self.path)
+        DupFinder.fs.update_index(self.db, self.path, self.executor,
+                                  prune=True, device_jobs=self.device_jobs)
+        self.sizes.clear()
+        self.partials.clear()
+        self.hashes.clear()
+        for row in DupFinder.db.iterate_items(self.db):
+            self._remember(row)
+
+    def _counted(self, entry):
+        size = entry['size']
+        return ((self.sizes, size),
+                (self.partials, (size, entry['partial_hash'])),
+                (self.hashes, (size, entry['hash'])))
+
+    def _remember(self, entry):
+        for (counter, key) in self._counted(entry):
+            counter[key] += 1
+
+    def _forget(self, entry):
+        for (counter, key) in self._counted(entry):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+
+    def _watch_tree(self, path):
+        """
+        Watches directory and its subdirectories. Returns paths of files
+        found in them.
+        """
+        found = []
+        for (directory, _, files) in os.walk(path):
+            try:
+                wd = self.inotify.add_watch(directory)
+            except OSError:
+                DupFinder.stats.add('scan_errors')
+                continue
+            self.watches[wd] = os.path.join(directory, '')
+            found.extend(os.path.join(directory, f) for f in files)
+        return found
+
+    def _unwatch_tree(self, path):
+        prefix = os.path.join(path, '')
+        for (wd, directory) in list(self.watches.items()):
+            if directory.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def _on_event(self, wd, mask, name):
+        DupFinder.stats.add('watch_events')
+        if mask & IN_Q_OVERFLOW:
+            self.overflow = True
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            return
+        path = directory + name
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            if mask & IN_ISDIR:
+                self._unwatch_tree(path)
+            self.changed.discard(path)
+            self.removed.add(path)
+        elif mask & IN_ISDIR:
+            # Files could have been put there before it was watched.
+            self.changed.update(self._watch_tree(path))
+        else:
+            self.removed.discard(path)
+            self.changed.add(path)
+
+    def apply(self):
+        """
+        Applies changes collected from events to index and in-memory map.
+        After lost events (queue overflow) whole directory is indexed again.
+        """
+        if self.overflow:
+            self.overflow = False
+            self.changed.clear()
+            self.removed.clear()
+            self.start()
+            return
+        # path -> entry replaced or removed
+        old = {}
+        for path in self.removed:
+            for row in DupFinder.db.get_under_path(self.db, path):
+                old[row['filepath']] = row
+        for path in self.removed | self.changed:
+            item = DupFinder.db.get_item(self.db, path)
+            if item is not None:
+                old[path] = item
+        entries = []
+        for path in self.changed:
+            try:
+                DupFinder.stats.add('stat_calls')
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                entries.append(DupFinder.fs.FileEntry(
+                    path, st.st_size, mtime=st.st_mtime_ns, inode=st.st_ino,
+                    device=st.st_dev))
+        DupFinder.fs.fill_up_partial_hashes(entries, self.executor,
+                                            self.algorithm,
+                                            device_jobs=self.device_jobs)
+        DupFinder.fs.fill_up_hashes(entries, self.executor, self.algorithm,
+                                    device_jobs=self.device_jobs)
+        entries = [e for e in entries if e['hash'] is not None]
+        DupFinder.db.remove_items(self.db, list(old))
+        DupFinder.db.add_items(self.db, entries)
+        for row in old.values():
+            self._forget(row)
+        for entry in entries:
+            self._remember(entry)
+        DupFinder.stats.add('files_done', len(entries))
+        self.changed.clear()
+        self.removed.clear()
+
+    def poll(self, timeout=0):
+        """
+        Waits up to timeout seconds for events and applies changes that
+        settled (see SETTLE_TIME).
+        """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.inotify, selectors.EVENT_READ)
+            if selector.select(timeout):
+                self._read_events()
+        self._apply_settled()
+
+    def _read_events(self):
+        for event in self.inotify.read():
+            self._on_event(*event)
+        self.last_event = time.monotonic()
+
+    def _apply_settled(self):
+        if (self.changed or self.removed or self.overflow) and \
+                time.monotonic() - self.last_event >= SETTLE_TIME:
+            self.apply()
+
+    def check(self, path=None, size=None, hash=None):
+        """
+        Checks if file is a duplicate of indexed one. File is given either
+        by path or by size and hash (of algorithm used by database). Files
+        of size not found in index are not read at all, files of partial
+        hash not found are not read whole (as queries are answered one by
+        one). File does not count as a duplicate of its own entry.
+
+        Returns
+        -------
+        bool
+        """
+        if path is not None:
+            size = os.stat(path).st_size
+        if self.sizes[size] <= 0:
+            return False
+        if path is None:
+            return self.hashes[(size, hash)] > 0
+        own = DupFinder.db.get_item(self.db, os.path.abspath(path))
+        if own is not None and own['size'] != size:
+            own = None
+        # Entries without partial hash (indexed by older versions) match
+        # any partial hash.
+        partial = DupFinder.fs.partial_hash_file(path,
+                                                 algorithm=self.algorithm)
+        count = int(own is not None and own['partial_hash'] in (None, partial))
+        if self.partials[(size, partial)] + self.partials[(size, None)] <= \
+                count:
+            return False
+        if size <= 2 * DupFinder.fs.PARTIAL_SIZE:
+            hash = partial
+        else:
+            hash = DupFinder.fs.hash_file(path, algorithm=self.algorithm)
+        count = int(own is not None and own['hash'] == hash)
+        return self.hashes[(size, hash)] > count
+
+    def _answer(self, line):
+        # Malformed requests are answered with error, the daemon goes on.
+        try:
+            request = json.loads(line)
+            (path, size, hash) = (request.get('path'), request.get('size'),
+                                  request.get('hash'))
+            if path is not None:
+                if not isinstance(path, str):
+                    raise TypeError('path has to be string')
+            elif not isinstance(size, int) or isinstance(size, bool) or \
+                    not isinstance(hash, str):
+                raise TypeError('size has to be integer and hash string')
+            return {'duplicate': self.check(path, size, hash)}
+        except (ValueError, TypeError, AttributeError, OSError) as e:
+            return {'error': str(e)}
+
+    def _on_client(self, selector, conn, buffers):
+        # Client that went away (or broke its connection) is dropped, the
+        # others are still served.
+        try:
+            data = conn.recv(MAX_REQUEST)
+            buf = buffers[conn] + data
+            while b'\n' in buf:
+                (line, buf) = buf.split(b'\n', 1)
+                DupFinder.stats.add('watch_queries')
+                conn.sendall(json.dumps(self._answer(line)).encode() + b'\n')
+        except OSError:
+            (data, buf) = (b'', b'')
+        buffers[conn] = buf
+        if not data or len(buf) > MAX_REQUEST:
+            selector.unregister(conn)
+            del buffers[conn]
+            conn.close()
+
+    def serve(self, socket_path=DEFAULT_SOCKET):
+        """
+        Answers queries on Unix socket and applies changes of files until
+        stop is called. Each request is single line with JSON object with
+        `path` of file or its `size` and `hash`, answer is line with JSON
+        object with `duplicate` (or `error`).
+        """
+        socket_path = os.path.expanduser(socket_path)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen()
+        buffers = {}
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.inotify, selectors.EVENT_READ)
+            selector.register(server, selectors.EVENT_READ)
+            try:
+                while not self._stopped:
+                    for (key, _) in selector.select(
+                            DupFinder.pipeline.POLL_INTERVAL):
+                        if key.fileobj is self.inotify:
+                            self._read_events()
+                        elif key.fileobj is server:
+                            (conn, _) = server.accept()
+                            buffers[conn] = b''
+                            selector.register(conn, selectors.EVENT_READ)
+                        else:
+                            self._on_client(selector, key.fileobj, buffers)
+                    self._apply_settled()
+            finally:
+                for conn in buffers:
+                    conn.close()
+                server.close()
+                os.remove(socket_path)
+
+    def stop(self):
+        """
+        Makes serve return (it can be called from another thread or signal
+        handler).
+        """
+        self._stopped = True
+
+    def close(self):
+        self.inotify.close()
+
+
+def query(socket_path, request):
+    """
+    Sends request (dictionary, see Watcher.serve) to watch daemon and returns
+    its answer.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(os.path.expanduser(socket_path))
+        conn.sendall(json.dumps(request).encode() + b'\n')
+        with conn.makefile('rb') as f:
+            return json.loads(f.readline())
@@ -0,0 +1,281 @@
+import DupFinder.fs
+import DupFinder.db
+import argparse
+import functools
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not reported there.
+    resource = None
+
+# Content of generated files is written in pieces of this size.
+WRITE_SIZE = 1024 * 1024
+
+
+def _write_content(path, size, seed):
+    """
+    Writes `size` pseudo random bytes determined by `seed` to file.
+    """
+    rnd = random.Random(seed)
+    with open(path, 'wb') as fo:
+        while size > 0:
+            n = min(size, WRITE_SIZE)
+            fo.write(rnd.randbytes(n))
+            size -= n
+
+
+def generate_tree(root, files=1000, min_size=0, max_size=1024 * 1024,
+                  dup_ratio=0.3, depth=3, fanout=4, hardlink_ratio=0.05,
+                  seed=0):
+    """
+    Generates directory tree with files for benchmarking. The same arguments
+    always give the same tree.
+
+    Parameters
+    ----------
+    root: string
+        Directory in which tree is created.
+    files: int
+        Number of files (including duplicates and hard links).
+    min_size, max_size: int
+        Range of file sizes. Sizes are distributed log-uniformly, so there
+        are many small files and few big ones, as on real disks.
+    dup_ratio: float
+        Part of files that are copies of another file.
+    depth: int
+        Maximum depth of directories.
+    fanout: int
+        Number of subdirectories of each directory.
+    hardlink_ratio: float
+        Part of files that are hard links of another file.
+    seed: int
+        Seed of pseudo random generator.
+
+    Returns
+    -------
+    (files, bytes)
+        Number of files and their total size.
+    """
+    rnd = random.Random(seed)
+    originals = []
+    paths = []
+    total = 0
+    low = math.log(min_size + 1)
+    high = math.log(max_size + 1)
+    for i in range(files):
+        dirs = ['d%d' % rnd.randrange(fanout)
+                for _ in range(rnd.randint(0, depth))]
+        directory = os.path.join(root, *dirs)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'f%d' % i)
+        kind = rnd.random()
+        if paths and kind < hardlink_ratio:
+            source = rnd.choice(paths)
+            os.link(source, path)
+            total += os.path.getsize(source)
+        elif originals and kind < hardlink_ratio + dup_ratio:
+            (size, content_seed) = rnd.choice(originals)
+            _write_content(path, size, content_seed)
+            total += size
+        else:
+            size = int(math.exp(rnd.uniform(low, high))) - 1
+            content_seed = rnd.getrandbits(64)
+            _write_content(path, size, content_seed)
+            originals.append((size, content_seed))
+            total += size
+        paths.append(path)
+    return (files, total)
+
+
+def _reset_peak_rss():
+    """
+    Resets peak resident memory of the process, so it is measured for each
+    stage separately. Works on Linux only, elsewhere peak of whole run is
+    reported.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(results, stage, func, files, size, repeat):
+    """
+    Runs func `repeat` times and records best time of the stage with its
+    throughput.
+    """
+    best = None
+    peak = None
+    for _ in range(repeat):
+        _reset_peak_rss()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        rss = _peak_rss_kb()
+        if best is None or elapsed < best:
+            best = elapsed
+        if rss is not None and (peak is None or rss > peak):
+            peak = rss
+    best = max(best, 1e-9)
+    results[stage] = {
+        'seconds': best,
+        'files_per_s': files / best,
+        'mb_per_s': size / best / (1024 * 1024) if size else None,
+        'peak_rss_kb': peak,
+    }
+
+
+def run_benchmarks(root, executor=None,
+                   algorithm=DupFinder.fs.DEFAULT_ALGORITHM, repeat=1):
+    """
+    Times main stages of DupFinder on directory tree. Files are read from
+    disk cache after the first stage, so numbers show CPU bound performance
+    unless tree is bigger than memory.
+
+    Parameters
+    ----------
+    root: string
+        Directory with files (see generate_tree).
+    executor: concurrent.futures.Executor
+        Executor used to calculate hashes in parallel (see make_executor).
+    algorithm: string
+        Name of hash algorithm (see DupFinder.fs.ALGORITHMS).
+    repeat: int
+        Number of runs of each stage, best one is reported.
+
+    Returns
+    -------
+    Dictionary of stage name to dictionary with seconds, files_per_s,
+    mb_per_s and peak_rss_kb.
+    """
+    results = {}
+    entries = DupFinder.fs.index_files_in_dir(root, False)
+    paths = [e['filepath'] for e in entries]
+    count = len(entries)
+    size = sum(e['size'] for e in entries)
+    _measure(results, 'enumerate_directory',
+             lambda: list(DupFinder.fs.enumerate_directory(root)),
+             count, None, repeat)
+
+    def hash_files():
+        func = functools.partial(DupFinder.fs.hash_file, algorithm=algorithm)
+        if executor is None:
+            digests = map(func, paths)
+        else:
+            digests = executor.map(func, paths,
+                                   chunksize=DupFinder.fs.MAP_CHUNKSIZE)
+        for (entry, digest) in zip(entries, digests):
+            entry['hash'] = digest
+    _measure(results, 'hash_file', hash_files, count, size, repeat)
+    DupFinder.fs.fill_up_partial_hashes(entries, executor, algorithm)
+
+    workdir = tempfile.mkdtemp(prefix='dupfinder-bench-')
+    try:
+        db_file = os.path.join(workdir, 'bench.db')
+
+        def add_items():
+            for name in os.listdir(workdir):
+                os.remove(os.path.join(workdir, name))
+            db = DupFinder.db.create_db(db_file, algorithm)
+            DupFinder.db.add_items(db, entries)
+            db.close()
+        _measure(results, 'add_items', add_items, count, None, repeat)
+
+        def compare_with_db():
+            db = DupFinder.db.connect_db(db_file)
+            files = DupFinder.fs.iter_files_in_dir(root, False)
+            DupFinder.fs.compare_with_db(db, files, executor)
+            db.close()
+        _measure(results, 'compare_with_db', compare_with_db, count, size,
+                 repeat)
+    finally:
+        shutil.rmtree(workdir)
+
+    _measure(results, 'FindDupFilesInDirectory',
+             lambda: DupFinder.fs.FindDupFilesInDirectory(
+                 root, executor=executor, algorithm=algorithm),
+             count, size, repeat)
+    return results
+
+
+def print_results(results, baseline=None):
+    """
+    Prints table of results. With baseline each stage gets its speed up
+    (>1 is faster than baseline).
+    """
+    header = '%-25s %10s %12s %10s %12s' % (
+        'stage', 'seconds', 'files/s', 'MB/s', 'peak RSS kB')
+    if baseline is not None:
+        header += ' %9s' % 'speed up'
+    print(header)
+    for (stage, r) in results.items():
+        line = '%-25s %10.3f %12.1f %10s %12s' % (
+            stage, r['seconds'], r['files_per_s'],
+            '-' if r['mb_per_s'] is None else '%.1f' % r['mb_per_s'],
+            '-' if r['peak_rss_kb'] is None else r['peak_rss_kb'])
+        if baseline is not None and stage in baseline:
+            line += ' %8.2fx' % (baseline[stage]['seconds'] / r['seconds'])
+        print(line)
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmarks DupFinder stages on generated directory tree.')
+subparsers = parser.add_subparsers(help='', dest='command')
+p = subparsers.add_parser('generate', help='Generate directory tree')
+p.add_argument("--files", type=int, default=1000)
+p.add_argument("--min-size", type=int, default=0)
+p.add_argument("--max-size", type=int, default=1024 * 1024)
+p.add_argument("--dup-ratio", type=float, default=0.3)
+p.add_argument("--depth", type=int, default=3)
+p.add_argument("--fanout", type=int, default=4)
+p.add_argument("--hardlink-ratio", type=float, default=0.05)
+p.add_argument("--seed", type=int, default=0)
+p.add_argument("dir")
+p = subparsers.add_parser('run', help='Time stages on directory tree')
+p.add_argument("--jobs", "-j", type=int, default=1, metavar="N")
+p.add_argument("--use-processes", action="store_true")
+p.add_argument("--algorithm", choices=sorted(DupFinder.fs.ALGORITHMS),
+               default=DupFinder.fs.DEFAULT_ALGORITHM)
+p.add_argument("--repeat", type=int, default=3)
+p.add_argument("--save", metavar="baseline.json")
+p.add_argument("--compare", metavar="baseline.json")
+p.add_argument("dir")
+# Guard is needed as worker processes (--use-processes) import this module.
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'generate':
+        if os.path.exists(args.dir) and os.listdir(args.dir):
+            parser.error(args.dir + ' is not empty')
+        (files, size) = generate_tree(
+            args.dir, args.files, args.min_size, args.max_size,
+            args.dup_ratio, args.depth, args.fanout, args.hardlink_ratio,
+            args.seed)
+        print(files, ' files generated, ', size, ' bytes')
+    if args.command == 'run':
+        baseline = None
+        if args.compare is not None:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+        executor = DupFinder.fs.make_executor(args.jobs, args.use_processes)
+        results = run_benchmarks(args.dir, executor, args.algorithm,
+                                 args.repeat)
+        if executor is not None:
+            executor.shutdown()
+        print_results(results, baseline)
+        if args.save is not None:
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=2)
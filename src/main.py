@@ -1,55 +1,338 @@
+import DupFinder.cache
 import DupFinder.fs
 import DupFinder.db
+import DupFinder.filters
+import DupFinder.stats
+import DupFinder.watch
 import argparse
+import itertools
+import json
 import os
+import signal
+import sys
+import time
 
 parser = argparse.ArgumentParser()
 
 subparsers = parser.add_subparsers(help='', dest='command')
-p = subparsers.add_parser('create_db', help='help create_db')
+# Options of all commands.
+common = argparse.ArgumentParser(add_help=False)
+common.add_argument("--stats", action="store_true",
+                    help="print statistics of run to stderr")
+common.add_argument("--stats-json", metavar="file",
+                    help="write statistics of run as JSON ('-' for stdout)")
+common.add_argument("--progress", type=float, nargs="?", const=5.0,
+                    metavar="seconds",
+                    help="print progress every few seconds to stderr")
+# Options of commands walking directory.
+scan = argparse.ArgumentParser(add_help=False)
+scan.add_argument("--min-size", type=int, metavar="bytes")
+scan.add_argument("--max-size", type=int, metavar="bytes")
+scan.add_argument("--include", action="append", default=[],
+                  metavar="pattern")
+scan.add_argument("--exclude", action="append", default=[],
+                  metavar="pattern")
+scan.add_argument("--no-ignore-files", action="store_true")
+scan.add_argument("--one-file-system", action="store_true")
+algorithms = sorted(DupFinder.fs.ALGORITHMS)
+p = subparsers.add_parser('create_db', help='help create_db',
+                          parents=[common])
 p.add_argument("--use_db", "-d", metavar="path_to_db")
-p = subparsers.add_parser('index_dir', help='help for index_dir')
+p.add_argument("--algorithm", choices=algorithms)
+p = subparsers.add_parser('index_dir', help='help for index_dir',
+                          parents=[common, scan])
 p.add_argument("--use_db", "-d", metavar="path_to_db")
+p.add_argument("--prune", action="store_true")
+p.add_argument("--resume", action="store_true")
+p.add_argument("--algorithm", choices=algorithms)
+p.add_argument("--jobs", "-j", type=int, default=1, metavar="N")
+p.add_argument("--use-processes", action="store_true")
+p.add_argument("--device-jobs", type=int, metavar="N")
 p.add_argument("dir")
-p = subparsers.add_parser('check_dir', help='help for check_dir')
+p = subparsers.add_parser('check_dir', help='help for check_dir',
+                          parents=[common, scan])
 p.add_argument("--use_db", "-d", metavar="path_to_db")
+p.add_argument("--jobs", "-j", type=int, default=1, metavar="N")
+p.add_argument("--use-processes", action="store_true")
+p.add_argument("--device-jobs", type=int, metavar="N")
 p.add_argument("--delete-dup-files", action="store_true")
 p.add_argument("--add-new-files-to-index", "-a", action="store_true")
+p.add_argument("--filter-memory", type=int, metavar="MiB",
+               default=DupFinder.filters.FILTER_MEMORY // (1024 * 1024))
+p.add_argument("--bloom", action="store_true")
+p.add_argument("--shard", action="append", default=[], metavar="shard_db")
 p.add_argument("dir")
 p = subparsers.add_parser(
-    'find_dups_in_dir', help='Find Duplicates in directory')
+    'find_dups_in_dir', help='Find Duplicates in directory',
+    parents=[common, scan])
 p.add_argument("--delete-dup-files", action="store_true")
+p.add_argument("--link-dup-files", action="store_true")
+p.add_argument("--compare-bytes", action="store_true")
+p.add_argument("--jobs", "-j", type=int, default=1, metavar="N")
+p.add_argument("--use-processes", action="store_true")
+p.add_argument("--device-jobs", type=int, metavar="N")
+p.add_argument("--algorithm", choices=algorithms,
+               default=DupFinder.fs.DEFAULT_ALGORITHM)
+p.add_argument("--cache", nargs="?", const=DupFinder.cache.DEFAULT_CACHE,
+               metavar="cache_file")
+p.add_argument("--cache-size", type=int, metavar="N",
+               default=DupFinder.cache.MAX_ENTRIES)
 p.add_argument("dir")
-args = parser.parse_args()
+p = subparsers.add_parser(
+    'rehash_db', help='Rehash all entries in db with another algorithm',
+    parents=[common])
+p.add_argument("--use_db", "-d", metavar="path_to_db")
+p.add_argument("--jobs", "-j", type=int, default=1, metavar="N")
+p.add_argument("--use-processes", action="store_true")
+p.add_argument("--device-jobs", type=int, metavar="N")
+p.add_argument("--algorithm", choices=algorithms, required=True)
+p = subparsers.add_parser(
+    'verify_db', help='Check entries of db against files', parents=[common])
+p.add_argument("--use_db", "-d", metavar="path_to_db")
+p.add_argument("--jobs", "-j", type=int, default=1, metavar="N")
+p.add_argument("--use-processes", action="store_true")
+p.add_argument("--device-jobs", type=int, metavar="N")
+p.add_argument("--rehash", type=float, nargs="?", const=1.0, default=0.0,
+               metavar="fraction")
+p.add_argument("--fix", action="store_true")
+p.add_argument("--analyze", action="store_true")
+p.add_argument("--vacuum", action="store_true")
+p = subparsers.add_parser(
+    'merge_db', help='Merge shard databases into db', parents=[common])
+p.add_argument("--use_db", "-d", metavar="path_to_db")
+p.add_argument("shards", nargs="+", metavar="shard_db")
+p = subparsers.add_parser(
+    'search_db', help='Search index by file name or hash',
+    parents=[common])
+p.add_argument("--use_db", "-d", metavar="path_to_db")
+g = p.add_mutually_exclusive_group(required=True)
+g.add_argument("--name", metavar="pattern")
+g.add_argument("--hash", metavar="digest")
+g.add_argument("--duplicates", action="store_true")
+p.add_argument("--size", type=int)
+p = subparsers.add_parser(
+    'watch', help='Keep index of directory up to date and answer queries',
+    parents=[common])
+p.add_argument("--use_db", "-d", metavar="path_to_db")
+p.add_argument("--jobs", "-j", type=int, default=1, metavar="N")
+p.add_argument("--use-processes", action="store_true")
+p.add_argument("--device-jobs", type=int, metavar="N")
+p.add_argument("--socket", default=DupFinder.watch.DEFAULT_SOCKET,
+               metavar="socket_path")
+p.add_argument("dir")
+p = subparsers.add_parser(
+    'query_watch', help='Ask watch daemon if files are duplicates',
+    parents=[common])
+p.add_argument("--socket", default=DupFinder.watch.DEFAULT_SOCKET,
+               metavar="socket_path")
+p.add_argument("files", nargs="+")
+# Guard is needed as worker processes (--use-processes) import this module.
+if __name__ == '__main__':
+    args = parser.parse_args()
 
-db_to_use = '~/DupFinder.db'
-if args.command == 'create_db':
-    if args.use_db is not None or args.use_db != '':
-        db_to_use = args.use_db
-    DupFinder.db.create_db(db_to_use)
-if args.command == 'index_dir':
-    if args.use_db is not None or args.use_db != '':
-        db_to_use = args.use_db
-    db = DupFinder.db.connect_db(db_to_use)
-    index = DupFinder.fs.index_files_in_dir(args.dir)
-    print(len(index), ' files being indexed')
-    DupFinder.db.add_items(db, index)
-    db.close()
-if args.command == 'check_dir':
-    if args.use_db is not None or args.use_db != '':
-        db_to_use = args.use_db
-    db = DupFinder.db.connect_db(db_to_use)
-    files = DupFinder.fs.index_files_in_dir(args.dir, False)
-    new_files, dup_files = DupFinder.fs.compare_with_db(db, files)
-    if args.delete_dup_files:
-        for fi in dup_files:
-            os.remove(fi['filepath'])
-    if args.add_new_files_to_index:
-        DupFinder.fs.fill_up_hashes(new_files)
-        DupFinder.db.add_items(db, new_files)
-    print(len(dup_files), ' duplicated files found')
-    print(len(new_files), ' new files found')
-if args.command == 'find_dups_in_dir':
-    new_files, dup_files = DupFinder.fs.FindDupFilesInDirectory(args.dir,
-                                                                False)
-    print(dup_files)
+    db_to_use = '~/DupFinder.db'
+    executor = None
+    device_jobs = None
+    if 'jobs' in args:
+        executor = DupFinder.fs.make_executor(args.jobs, args.use_processes)
+        device_jobs = args.device_jobs
+    scan_filter = None
+    if 'min_size' in args:
+        scan_filter = DupFinder.filters.ScanFilter(
+            args.min_size, args.max_size, args.include, args.exclude,
+            None if args.no_ignore_files else DupFinder.filters.IGNORE_FILE,
+            args.one_file_system)
+    progress = None
+    if args.command is not None and args.progress is not None:
+        progress = DupFinder.stats.Progress(args.progress)
+        progress.start()
+    if args.command == 'create_db':
+        if args.use_db is not None or args.use_db != '':
+            db_to_use = args.use_db
+        DupFinder.db.create_db(db_to_use, args.algorithm)
+    if args.command == 'index_dir':
+        if args.use_db is not None or args.use_db != '':
+            db_to_use = args.use_db
+        db = DupFinder.db.connect_db(db_to_use)
+        if args.algorithm is not None and \
+                args.algorithm != DupFinder.db.get_algorithm(db):
+            if DupFinder.db.count_items(db) > 0:
+                parser.error('index uses ' + DupFinder.db.get_algorithm(db) +
+                             ' hashes, use rehash_db to change algorithm')
+            DupFinder.db.set_algorithm(db, args.algorithm)
+        changed, unchanged, removed = DupFinder.fs.update_index(
+            db, args.dir, executor, args.prune, args.resume, scan_filter,
+            device_jobs)
+        print(changed, ' files being indexed')
+        print(unchanged, ' unchanged files skipped')
+        if args.prune:
+            print(len(removed), ' vanished files removed from index')
+        db.close()
+    if args.command == 'check_dir':
+        if args.use_db is not None or args.use_db != '':
+            db_to_use = args.use_db
+        db = DupFinder.db.connect_db(db_to_use)
+        try:
+            DupFinder.db.attach_shards(db, args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        index_filter = None
+        if args.filter_memory > 0:
+            index_filter = DupFinder.filters.load_index_filter(
+                db, args.filter_memory * 1024 * 1024, args.bloom)
+        files = DupFinder.fs.iter_files_in_dir(args.dir, False,
+                                               scan_filter=scan_filter)
+        new_files, dup_files = DupFinder.fs.compare_with_db(
+            db, files, executor, index_filter, device_jobs)
+        if args.delete_dup_files:
+            for fi in dup_files:
+                os.remove(fi['filepath'])
+        if args.add_new_files_to_index:
+            algorithm = DupFinder.db.get_algorithm(db)
+            DupFinder.fs.fill_up_partial_hashes(
+                new_files, executor, algorithm, device_jobs=device_jobs)
+            DupFinder.fs.fill_up_hashes(new_files, executor, algorithm,
+                                        device_jobs=device_jobs)
+            DupFinder.db.add_items(db, new_files)
+        print(len(dup_files), ' duplicated files found')
+        print(len(new_files), ' new files found')
+    if args.command == 'find_dups_in_dir':
+        cache = None
+        if args.cache is not None:
+            cache = DupFinder.cache.open_cache(args.cache, args.cache_size)
+        not_linked = []
+        new_files, dup_groups, linked = \
+            DupFinder.fs.FindDupFilesInDirectory(
+                args.dir, args.delete_dup_files, executor, args.algorithm,
+                args.link_dup_files, cache, args.compare_bytes,
+                scan_filter, not_linked.append, device_jobs)
+        if cache is not None:
+            cache.close()
+        linked = set(linked)
+        skipped = set(not_linked)
+        for group in dup_groups:
+            print(group[0])
+            for dup in group[1:]:
+                if dup in linked:
+                    print('    ', dup, ' (already hard linked)')
+                elif dup in skipped:
+                    print('    ', dup, ' (not linked, other filesystem)')
+                else:
+                    print('    ', dup)
+        print(len(dup_groups), ' groups of duplicated files found')
+        print(len(linked), ' of duplicated files are already hard links')
+        if args.link_dup_files:
+            print(len(skipped), ' of duplicated files could not be linked')
+    if args.command == 'rehash_db':
+        if args.use_db is not None or args.use_db != '':
+            db_to_use = args.use_db
+        db = DupFinder.db.connect_db(db_to_use)
+        rehashed, removed = DupFinder.fs.rehash_index(db, args.algorithm,
+                                                      executor, device_jobs)
+        print(len(rehashed), ' files rehashed with ', args.algorithm)
+        print(len(removed), ' vanished files removed from index')
+        db.close()
+    if args.command == 'verify_db':
+        if args.use_db is not None or args.use_db != '':
+            db_to_use = args.use_db
+        if not 0 <= args.rehash <= 1:
+            parser.error('--rehash fraction has to be between 0 and 1')
+        db = DupFinder.db.connect_db(db_to_use)
+        start = time.perf_counter()
+        checked = DupFinder.db.count_items(db)
+        report = DupFinder.fs.verify_index(db, executor, args.rehash,
+                                           args.fix, device_jobs)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        for (state, paths) in zip(['missing', 'changed', 'unhashed',
+                                   'mismatched'], report):
+            for path in paths:
+                print(state, ': ', path)
+        for (state, paths) in zip(['missing', 'changed', 'unhashed',
+                                   'mismatched'], report):
+            print(len(paths), ' ' + state + ' entries' +
+                  (' fixed' if args.fix and paths else ''))
+        print(checked, ' entries checked in %.1f s (%.1f entries/s)'
+              % (elapsed, checked / elapsed))
+        if args.analyze:
+            DupFinder.db.analyze_db(db)
+        if args.vacuum:
+            DupFinder.db.vacuum_db(db)
+        db.close()
+    if args.command == 'merge_db':
+        if args.use_db is not None or args.use_db != '':
+            db_to_use = args.use_db
+        db = DupFinder.db.connect_db(db_to_use)
+        for shard in args.shards:
+            try:
+                merged, skipped = DupFinder.db.merge_db(db, shard)
+            except ValueError as e:
+                parser.error(str(e))
+            print(merged, ' entries merged from ', shard)
+            print(skipped, ' older entries skipped')
+        db.close()
+    if args.command == 'search_db':
+        if args.use_db is not None or args.use_db != '':
+            db_to_use = args.use_db
+        db = DupFinder.db.connect_db(db_to_use)
+        if args.name is not None:
+            for row in DupFinder.db.search_by_name(db, args.name):
+                print(row['filepath'])
+        if args.hash is not None:
+            try:
+                rows = DupFinder.db.search_by_hash(db, args.hash, args.size)
+            except ValueError:
+                parser.error('--hash has to be hex digest')
+            for row in rows:
+                print(row['filepath'])
+        if args.duplicates:
+            groups = 0
+            for (_, group) in itertools.groupby(
+                    DupFinder.db.iterate_duplicates(db),
+                    key=lambda row: (row['size'], row['hash'])):
+                print(next(group)['filepath'])
+                for row in group:
+                    print('    ', row['filepath'])
+                groups += 1
+            print(groups, ' groups of duplicated files found')
+        db.close()
+    if args.command == 'watch':
+        if args.use_db is not None or args.use_db != '':
+            db_to_use = args.use_db
+        db = DupFinder.db.connect_db(db_to_use)
+        try:
+            watcher = DupFinder.watch.Watcher(db, args.dir, executor,
+                                              device_jobs)
+        except OSError as e:
+            parser.error(str(e))
+        signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+        watcher.start()
+        try:
+            watcher.serve(args.socket)
+        except KeyboardInterrupt:
+            pass
+        watcher.close()
+        db.close()
+    if args.command == 'query_watch':
+        for path in args.files:
+            answer = DupFinder.watch.query(
+                args.socket, {'path': os.path.abspath(path)})
+            if 'error' in answer:
+                print(path, ' error: ', answer['error'])
+            elif answer['duplicate']:
+                print(path, ' is duplicate')
+            else:
+                print(path, ' is new')
+    if executor is not None:
+        executor.shutdown()
+    if progress is not None:
+        progress.stop()
+    if args.command is not None and args.stats:
+        print(DupFinder.stats.format_stats(DupFinder.stats.snapshot()),
+              file=sys.stderr)
+    if args.command is not None and args.stats_json is not None:
+        stats = json.dumps(DupFinder.stats.snapshot(), indent=2)
+        if args.stats_json == '-':
+            print(stats)
+        else:
+            with open(args.stats_json, 'w') as f:
+                f.write(stats)
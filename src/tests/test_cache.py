@@ -0,0 +1,69 @@
+import DupFinder.cache
+import DupFinder.fs
+import os
+import time
+from unittest import mock
+
+
+def test_find_dups_with_cache(fs):
+    """
+    Second run with cache hashes only changed files.
+    """
+    fs.create_file('/phonyDir/file1', contents='same')
+    fs.create_file('/phonyDir/file2', contents='same')
+    fs.create_file('/phonyDir/file3', contents='diff')
+    cache = DupFinder.cache.HashCache(':memory:')
+    (_, dup_groups, _) = DupFinder.fs.FindDupFilesInDirectory(
+        '/phonyDir', cache=cache)
+    assert 1 == len(dup_groups)
+    with mock.patch('DupFinder.fs.partial_hash_file',
+                    wraps=DupFinder.fs.partial_hash_file) as mock_hash:
+        (_, again, _) = DupFinder.fs.FindDupFilesInDirectory(
+            '/phonyDir', cache=cache)
+        assert dup_groups == again
+        mock_hash.assert_not_called()
+        with open('/phonyDir/file2', 'w') as f:
+            f.write('diff')
+        os.utime('/phonyDir/file2', ns=(1, 1))
+        (_, dup_groups, _) = DupFinder.fs.FindDupFilesInDirectory(
+            '/phonyDir', cache=cache)
+        assert ['file2'] == [os.path.basename(c.args[0])
+                             for c in mock_hash.call_args_list]
+    assert [['file2', 'file3']] == \
+        [[os.path.basename(f) for f in g] for g in dup_groups]
+    entry = {'filepath': '/phonyDir/file1', 'size': 4, 'hash': None,
+             'mtime': os.stat('/phonyDir/file1').st_mtime_ns,
+             'inode': os.stat('/phonyDir/file1').st_ino}
+    # other algorithm is not taken from cache
+    DupFinder.fs.fill_up_hash(entry, 'xxh3_64', cache)
+    assert DupFinder.fs.hash_file('/phonyDir/file1', algorithm='xxh3_64') == \
+        entry['hash']
+
+
+def test_cache_eviction(tmp_path):
+    """
+    Cache keeps limited number of most recently used entries and drops old
+    ones.
+    """
+    cache_file = str(tmp_path / 'cache.db')
+
+    def entry(i):
+        return {'filepath': 'file%d' % i, 'size': i, 'mtime': i, 'inode': i,
+                'hash': 'hash%d' % i}
+
+    with DupFinder.cache.open_cache(cache_file, max_entries=2) as cache:
+        for i in range(3):
+            cache.put([entry(i)], 'xxh64')
+            time.sleep(0.01)
+        # file0 is used, so file1 is least recently used
+        assert 'hash0' == cache.get(entry(0), 'hash', 'xxh64')
+    with DupFinder.cache.open_cache(cache_file, max_age=3600) as cache:
+        assert 'hash0' == cache.get(entry(0), 'hash', 'xxh64')
+        assert cache.get(entry(1), 'hash', 'xxh64') is None
+        assert 'hash2' == cache.get(entry(2), 'hash', 'xxh64')
+        changed = dict(entry(2), mtime=5)
+        assert cache.get(changed, 'hash', 'xxh64') is None
+    with DupFinder.cache.open_cache(cache_file, max_age=-1) as cache:
+        pass
+    with DupFinder.cache.open_cache(cache_file) as cache:
+        assert cache.get(entry(0), 'hash', 'xxh64') is None
@@ -1,3 +1,6 @@
+import os
+import sqlite3
+import tempfile
 import unittest
 from unittest import mock
 import DupFinder.fs
@@ -12,7 +15,8 @@ class TestFileDup(unittest.TestCase):
         cur.execute("SELECT * from dupfinder")
         description = [x[0] for x in cur.description]
         cur.close()
-        self.assertEqual(['filepath', 'size', 'hash'], description)
+        self.assertEqual(['filepath', 'size', 'hash', 'partial_hash',
+                          'mtime', 'inode', 'device'], description)
         db.close()
 
     @mock.patch('os.path.isfile')
@@ -59,7 +63,9 @@ class TestFileDup(unittest.TestCase):
         because that is how DBs generally work.
         """
         db = DupFinder.db.create_db(":memory:")
-        item = {'filepath': 'something', 'size': 100, 'hash': 'abcdef'}
+        item = {'filepath': 'something', 'size': 100,
+                'hash': '00000000deadbeef', 'partial_hash': 'fedcba9876543210',
+                'mtime': 1, 'inode': 2, 'device': 3}
         r = DupFinder.db.add_item(db, item)
         self.assertTrue(r)
         cur = db.cursor()
@@ -68,8 +74,14 @@ class TestFileDup(unittest.TestCase):
 
     def test_add_items_to_db(self):
         db = DupFinder.db.create_db(":memory:")
-        items = [{'filepath': 'something', 'size': 100, 'hash': 'abcdef'},
-                 {'filepath': 'foobar', 'size': 200, 'hash': 'xyz'}]
+        items = [{'filepath': 'something', 'size': 100,
+                  'hash': '00000000deadbeef',
+                  'partial_hash': 'fedcba9876543210', 'mtime': 1, 'inode': 2,
+                  'device': 3},
+                 {'filepath': 'foobar', 'size': 200,
+                  'hash': 'ffffffffffffffff',
+                  'partial_hash': None, 'mtime': None, 'inode': None,
+                  'device': None}]
         DupFinder.db.add_items(db, items)
         cur = db.cursor()
         cur.execute("SELECT * from dupfinder")
@@ -77,3 +89,306 @@ class TestFileDup(unittest.TestCase):
         self.assertEqual(items[1], cur.fetchone())
         cur.close()
         db.close()
+
+    def test_connect_db_upgrades_old_schema(self):
+        """
+        Database created by older version gets missing columns on connect.
+        Existing rows are kept with empty new columns, except for rows
+        inserted again for the same path - only the latest one is kept.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'old.db')
+            old = sqlite3.connect(db_file)
+            old.execute("CREATE TABLE Dupfinder (filepath, size, hash)")
+            old.execute("INSERT INTO Dupfinder VALUES('something', 100, 'aa')")
+            old.execute("INSERT INTO Dupfinder VALUES('something', 100, 'ab')")
+            old.commit()
+            old.close()
+            db = DupFinder.db.connect_db(db_file)
+            self.assertEqual([{'filepath': 'something', 'size': 100,
+                               'hash': '00000000000000ab',
+                               'partial_hash': None}],
+                             DupFinder.db.get_by_size(db, 100))
+            db.close()
+
+    def test_interrupted_upgrade(self):
+        """
+        Upgrade step interrupted in the middle is rolled back as a whole, so
+        the next connect runs it again from the start.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'old.db')
+            old = sqlite3.connect(db_file)
+            old.execute("CREATE TABLE Dupfinder (filepath, size, hash)")
+            old.execute("INSERT INTO Dupfinder VALUES('something', 100, 'aa')")
+            old.commit()
+            old.close()
+            with mock.patch('DupFinder.db._legacy_items',
+                            side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    DupFinder.db.connect_db(db_file)
+            old = sqlite3.connect(db_file)
+            self.assertEqual([('Dupfinder',)], old.execute(
+                "SELECT name FROM sqlite_master").fetchall())
+            old.close()
+            db = DupFinder.db.connect_db(db_file)
+            self.assertEqual(DupFinder.db.SCHEMA_VERSION,
+                             DupFinder.db.get_schema_version(db))
+            self.assertEqual(['something'], [
+                r['filepath'] for r in DupFinder.db.get_by_size(db, 100)])
+            db.close()
+
+    def test_add_item_replaces_same_path(self):
+        """
+        Adding item with path that is already in database replaces the entry.
+        """
+        db = DupFinder.db.create_db(":memory:")
+        item = {'filepath': 'something', 'size': 100,
+                'hash': '00000000deadbeef', 'partial_hash': 'fedcba9876543210',
+                'mtime': 1, 'inode': 2, 'device': 3}
+        DupFinder.db.add_item(db, item)
+        item = dict(item, size=200, hash='0123456789abcdef', mtime=5)
+        DupFinder.db.add_item(db, item)
+        cur = db.cursor()
+        cur.execute("SELECT * from dupfinder")
+        self.assertEqual([item], cur.fetchall())
+        db.close()
+
+    def test_get_under_path_and_remove_items(self):
+        """
+        Only entries inside given directory are returned (not the ones in
+        directories with the same name prefix). Removed entries are gone.
+        """
+        db = DupFinder.db.create_db(":memory:")
+        paths = [os.path.join('dir', 'file1'),
+                 os.path.join('dir', 'sub', 'file2'),
+                 os.path.join('dir2', 'file3')]
+        DupFinder.db.add_items(db, [
+            {'filepath': p, 'size': 1, 'hash': 'a' * 16,
+             'partial_hash': 'a' * 16, 'mtime': 1, 'inode': 1, 'device': 1}
+            for p in paths])
+        self.assertEqual(sorted(paths[:2]), sorted(
+            [r['filepath'] for r in DupFinder.db.get_under_path(db, 'dir')]))
+        DupFinder.db.remove_items(db, paths[:1])
+        self.assertEqual(paths[1:2], [
+            r['filepath'] for r in DupFinder.db.get_under_path(db, 'dir')])
+        db.close()
+
+    def test_match_suspects(self):
+        """
+        Suspects are matched by size, then by partial hash (entries without
+        partial hash match any) and then by hash.
+        """
+        db = DupFinder.db.create_db(":memory:")
+        DupFinder.db.add_items(db, [
+            {'filepath': 'a', 'size': 1, 'hash': '1' * 16,
+             'partial_hash': 'a1' * 8, 'mtime': 1, 'inode': 1, 'device': 1},
+            {'filepath': 'b', 'size': 2, 'hash': '2' * 16,
+             'partial_hash': None, 'mtime': 1, 'inode': 2, 'device': 1}])
+        (h1, h2, hx) = ('1' * 16, '2' * 16, 'f' * 16)
+        (p1, px) = ('a1' * 8, 'b2' * 8)
+        suspects = [(0, 1, p1, h1), (1, 1, px, h1), (2, 2, px, h2),
+                    (3, 2, px, hx), (4, 3, p1, h1)]
+        self.assertEqual([0, 1, 2, 3], DupFinder.db.match_suspects(
+            db, suspects, 'size'))
+        self.assertEqual([0, 2, 3], DupFinder.db.match_suspects(
+            db, suspects, 'partial_hash'))
+        self.assertEqual([0, 2], DupFinder.db.match_suspects(
+            db, suspects, 'hash'))
+        db.close()
+
+    def test_add_items_bulk(self):
+        """
+        Items can be given as generator, are committed in batches and
+        SizeHashIndex is in place after load with index rebuild.
+        """
+        db = DupFinder.db.create_db(":memory:")
+        items = [{'filepath': 'file%d' % i, 'size': i % 3, 'hash': '%016x' % i,
+                  'partial_hash': None, 'mtime': 1, 'inode': i, 'device': 1}
+                 for i in range(10)]
+        DupFinder.db.add_items(db, (i for i in items), batch_size=3,
+                               rebuild_index=True)
+        self.assertEqual(10, DupFinder.db.count_items(db))
+        self.assertFalse(db.in_transaction)
+        indexes = [row['name'] for row in
+                   db.execute("PRAGMA index_list(Files)").fetchall()]
+        self.assertIn('SizeHashIndex', indexes)
+        self.assertEqual(['file1', 'file4', 'file7'], sorted(
+            r['filepath'] for r in DupFinder.db.get_by_size(db, 1)))
+        with self.assertRaises(AssertionError):
+            DupFinder.db.add_items(db, [dict(items[0], hash=None)])
+        db.close()
+
+    def test_connect_db_pragmas(self):
+        """
+        File databases are switched to write-ahead log.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, 'test.db')
+            DupFinder.db.create_db(db_file).close()
+            db = DupFinder.db.connect_db(db_file)
+            self.assertEqual('wal', db.execute(
+                "PRAGMA journal_mode").fetchone()['journal_mode'])
+            db.close()
+
+    def test_schema_version(self):
+        """
+        New database has current schema version, duplicate lookup by size and
+        hash is a single index search.
+        """
+        db = DupFinder.db.create_db(":memory:")
+        self.assertEqual(DupFinder.db.SCHEMA_VERSION,
+                         DupFinder.db.get_schema_version(db))
+        plan = db.execute("EXPLAIN QUERY PLAN SELECT * FROM Files "
+                          "WHERE size = 1 AND hash = 2").fetchall()
+        self.assertIn('SizeHashIndex', plan[0]['detail'])
+        db.close()
+
+    def test_algorithm(self):
+        """
+        Hash algorithm is recorded in database, 128 bit hashes are stored and
+        read back.
+        """
+        db = DupFinder.db.create_db(":memory:")
+        self.assertEqual('xxh64', DupFinder.db.get_algorithm(db))
+        db.close()
+        db = DupFinder.db.create_db(":memory:", 'xxh3_128')
+        self.assertEqual('xxh3_128', DupFinder.db.get_algorithm(db))
+        item = {'filepath': 'something', 'size': 100, 'hash': 'f0' * 16,
+                'partial_hash': '0f' * 16, 'mtime': 1, 'inode': 2, 'device': 3}
+        DupFinder.db.add_item(db, item)
+        self.assertEqual([item], list(DupFinder.db.iterate_items(db)))
+        self.assertEqual([0], DupFinder.db.match_suspects(
+            db, [(0, 100, '0f' * 16, 'f0' * 16)], 'hash'))
+        db.close()
+
+    def test_merge_db(self):
+        """
+        Entries of shard are merged into database, entries of the same file
+        keep the newer one. Shards of another algorithm are refused.
+        """
+        def item(filepath, mtime, h):
+            return {'filepath': filepath, 'size': 100, 'hash': h * 16,
+                    'partial_hash': '0f' * 8, 'mtime': mtime, 'inode': 2,
+                    'device': 3}
+        with tempfile.TemporaryDirectory() as tmp:
+            master_file = os.path.join(tmp, 'master.db')
+            shard_file = os.path.join(tmp, 'shard.db')
+            other_file = os.path.join(tmp, 'other.db')
+            db = DupFinder.db.create_db(master_file)
+            DupFinder.db.add_items(db, [item('/a/x', 5, '1'),
+                                        item('/a/y', 5, '1')])
+            shard = DupFinder.db.create_db(shard_file)
+            DupFinder.db.add_items(shard, [item('/a/x', 7, '2'),
+                                           item('/a/y', 3, '3'),
+                                           item('/b/z', 1, '4')])
+            shard.close()
+            DupFinder.db.create_db(other_file, 'xxh3_64').close()
+            self.assertEqual((2, 1), DupFinder.db.merge_db(db, shard_file))
+            self.assertEqual([item('/a/x', 7, '2'), item('/a/y', 5, '1'),
+                              item('/b/z', 1, '4')],
+                             sorted(DupFinder.db.iterate_items(db),
+                                    key=lambda i: i['filepath']))
+            self.assertEqual((0, 3), DupFinder.db.merge_db(db, shard_file))
+            self.assertEqual(3, DupFinder.db.count_items(db))
+            with self.assertRaises(ValueError):
+                DupFinder.db.merge_db(db, other_file)
+            db.close()
+
+    def test_attach_shards(self):
+        """
+        Comparisons search database together with attached shards, which are
+        opened read-only. Shards of outdated schema are refused.
+        """
+        def item(filepath, size):
+            return {'filepath': filepath, 'size': size, 'hash': 'f0' * 8,
+                    'partial_hash': '0f' * 8, 'mtime': 1, 'inode': 2,
+                    'device': 3}
+        with tempfile.TemporaryDirectory() as tmp:
+            shard_file = os.path.join(tmp, 'shard.db')
+            shard = DupFinder.db.create_db(shard_file)
+            DupFinder.db.add_items(shard, [item('/b/z', 100),
+                                           item('/b/y', 300)])
+            shard.close()
+            shard_stat = os.stat(shard_file)
+            old_file = os.path.join(tmp, 'old.db')
+            old = sqlite3.connect(old_file)
+            old.execute("CREATE TABLE Dupfinder (filepath, size, hash)")
+            old.close()
+            db = DupFinder.db.create_db(os.path.join(tmp, 'master.db'))
+            DupFinder.db.add_items(db, [item('/a/x', 200),
+                                        item('/a/w', 300)])
+            suspects = [(0, 100, '0f' * 8, 'f0' * 8)]
+            self.assertEqual([], DupFinder.db.match_suspects(
+                db, suspects, 'hash'))
+            DupFinder.db.attach_shards(db, [shard_file])
+            self.assertEqual([0], DupFinder.db.match_suspects(
+                db, suspects, 'hash'))
+            self.assertEqual([100, 200, 300],
+                             list(DupFinder.db.iterate_sizes(db)))
+            self.assertEqual([100, 200],
+                             list(DupFinder.db.iterate_sizes(db, 2)))
+            self.assertEqual(2, DupFinder.db.count_items(db))
+            self.assertEqual(4, DupFinder.db.count_indexed(db))
+            with self.assertRaises(sqlite3.OperationalError):
+                db.execute("DELETE FROM shard0.Files")
+            plan = db.execute(
+                "EXPLAIN QUERY PLAN " +
+                DupFinder.db.GET_SIZES_SQL.format('shard0'), (-1,)).fetchall()
+            self.assertNotIn('TEMP B-TREE',
+                             ' '.join(row['detail'] for row in plan))
+            with self.assertRaises(ValueError):
+                DupFinder.db.attach_shards(
+                    db, [os.path.join(tmp, 'missing.db')])
+            with self.assertRaises(ValueError):
+                DupFinder.db.attach_shards(db, [old_file])
+            db.close()
+            old = sqlite3.connect(old_file)
+            self.assertEqual([('Dupfinder',)], old.execute(
+                "SELECT name FROM sqlite_master").fetchall())
+            old.close()
+            self.assertEqual((shard_stat.st_size, shard_stat.st_mtime_ns),
+                             (os.stat(shard_file).st_size,
+                              os.stat(shard_file).st_mtime_ns))
+
+    def test_search(self):
+        """
+        Entries are found by name (or path) pattern using name index, by hash
+        (with or without size) and duplicate groups are listed biggest first.
+        """
+        def item(filepath, size, h):
+            return {'filepath': filepath, 'size': size, 'hash': h * 16,
+                    'partial_hash': None, 'mtime': 1, 'inode': 2,
+                    'device': 3}
+        db = DupFinder.db.create_db(":memory:")
+        DupFinder.db.add_items(db, [
+            item('/a/x.txt', 1, '1'), item('/b/x.txt', 1, '1'),
+            item('/a/y.jpg', 2, '2'), item('/c/z.jpg', 2, '2'),
+            item('/c/w', 3, '2')])
+
+        def paths(cursor):
+            return sorted(row['filepath'] for row in cursor)
+        self.assertEqual(['/a/x.txt', '/b/x.txt'],
+                         paths(DupFinder.db.search_by_name(db, 'x.txt')))
+        self.assertEqual(['/a/y.jpg', '/c/z.jpg'],
+                         paths(DupFinder.db.search_by_name(db, '*.jpg')))
+        self.assertEqual(['/c/w', '/c/z.jpg'],
+                         paths(DupFinder.db.search_by_name(db, '/c/*')))
+        self.assertEqual([], paths(DupFinder.db.search_by_name(db, 'X*')))
+        plan = db.execute("EXPLAIN QUERY PLAN " + DupFinder.db.SEARCH_NAME_SQL,
+                          {'name': 'x*', 'pattern': '*'}).fetchall()
+        self.assertIn('NameIndex (name>? AND name<?)', plan[0]['detail'])
+        self.assertEqual(['/a/y.jpg', '/c/w', '/c/z.jpg'],
+                         paths(DupFinder.db.search_by_hash(db, '2' * 16)))
+        self.assertEqual(['/c/w'], paths(
+            DupFinder.db.search_by_hash(db, '2' * 16, 3)))
+        plan = db.execute("EXPLAIN QUERY PLAN " + DupFinder.db.SEARCH_HASH_SQL,
+                          (1,)).fetchall()
+        self.assertIn('HashIndex (hash=?)', plan[0]['detail'])
+        with self.assertRaises(ValueError):
+            DupFinder.db.search_by_hash(db, 'not hex')
+        self.assertEqual([('/a/y.jpg', 2), ('/c/z.jpg', 2), ('/a/x.txt', 1),
+                          ('/b/x.txt', 1)],
+                         [(row['filepath'], row['size'])
+                          for row in DupFinder.db.iterate_duplicates(db)])
+        db.close()
@@ -0,0 +1,102 @@
+import DupFinder.db
+import DupFinder.filters
+import DupFinder.fs
+import os
+from unittest import mock
+
+
+def test_bloom_filter():
+    """
+    Added keys are always found, most of the others are not.
+    """
+    bloom = DupFinder.filters.BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(b'key%d' % i)
+    assert all(b'key%d' % i in bloom for i in range(1000))
+    assert sum(b'other%d' % i in bloom for i in range(1000)) < 50
+
+
+def test_index_filter(fs):
+    """
+    Filter knows sizes of indexed files exactly and rejects files with
+    partial hash that is not indexed. Files rejected by filter are not
+    queried at all. Filter is not loaded if it does not fit in memory.
+    """
+    fs.create_file('/phonyDir/dir1/file1', contents='same')
+    fs.create_file('/phonyDir/dir1/file2', contents='other')
+    fs.create_file('/phonyDir/dir2/file3', contents='same')
+    fs.create_file('/phonyDir/dir2/file4', contents='unique size')
+    fs.create_file('/phonyDir/dir2/file5', contents='diff')
+    db = DupFinder.db.create_db(":memory:")
+    DupFinder.fs.update_index(db, '/phonyDir/dir1')
+    index_filter = DupFinder.filters.load_index_filter(db)
+    assert [4, 5] == list(index_filter.sizes)
+    assert index_filter.bloom is None
+    assert index_filter.has_size(4)
+    assert not index_filter.has_size(6)
+    assert DupFinder.filters.load_index_filter(db, 8) is None
+    index_filter = DupFinder.filters.load_index_filter(db, partial_hashes=True)
+    same = DupFinder.fs.partial_hash_file('/phonyDir/dir2/file3')
+    diff = DupFinder.fs.partial_hash_file('/phonyDir/dir2/file5')
+    assert index_filter.may_have_partial_hash(4, same)
+    assert not index_filter.may_have_partial_hash(4, diff)
+    files = DupFinder.fs.index_files_in_dir('/phonyDir/dir2', False)
+    match_suspects = DupFinder.db.match_suspects
+    queried = []
+
+    def match(db, suspects, stage):
+        suspects = list(suspects)
+        queried.append((stage, len(suspects)))
+        return match_suspects(db, suspects, stage)
+
+    with mock.patch('DupFinder.db.match_suspects', side_effect=match):
+        (non_dup, dup) = DupFinder.fs.compare_with_db(
+            db, files, index_filter=index_filter)
+    assert [('partial_hash', 1), ('hash', 1)] == queried
+    assert ['file3'] == [os.path.basename(f['filepath']) for f in dup]
+    assert 2 == len(non_dup)
+
+
+def test_scan_filter(fs):
+    """
+    Excluded directories (by pattern or by ignore file of any directory
+    above) are never listed, files are filtered by size, include and
+    exclude patterns. Walk stays on the filesystem it started on.
+    """
+    fs.create_file('/phonyDir/keep.txt', contents='1234')
+    fs.create_file('/phonyDir/empty.txt')
+    fs.create_file('/phonyDir/big.txt', contents='1234567890')
+    fs.create_file('/phonyDir/image.jpg', contents='1234')
+    fs.create_file('/phonyDir/.git/objects/ab', contents='1234')
+    fs.create_file('/phonyDir/sub/keep.txt', contents='1234')
+    fs.create_file('/phonyDir/sub/cache/file.txt', contents='1234')
+    fs.create_file('/phonyDir/sub/deep/cache.txt', contents='1234')
+    fs.create_file('/phonyDir/sub/deep/junk.txt', contents='1234')
+    fs.create_file('/phonyDir/sub/.dupfinderignore',
+                   contents='# comment\n\ncache/\ndeep/junk.txt\n')
+    fs.add_mount_point('/phonyDir/mnt')
+    fs.create_file('/phonyDir/mnt/keep.txt', contents='1234')
+    scan_filter = DupFinder.filters.ScanFilter(
+        min_size=1, max_size=5, include=['*.txt'], exclude=['.git'],
+        one_filesystem=True)
+    with mock.patch('os.scandir', wraps=os.scandir) as mock_scandir:
+        found = [f.path for f in DupFinder.fs.enumerate_directory(
+            '/phonyDir', scan_filter=scan_filter)]
+        listed = [c.args[0] for c in mock_scandir.call_args_list]
+    assert sorted(['/phonyDir/keep.txt', '/phonyDir/sub/keep.txt',
+                   '/phonyDir/sub/deep/cache.txt']) == sorted(found)
+    assert sorted(['/phonyDir', '/phonyDir/sub', '/phonyDir/sub/deep']) == \
+        sorted(listed)
+    everything = DupFinder.fs.index_files_in_dir(
+        '/phonyDir', False,
+        scan_filter=DupFinder.filters.ScanFilter(ignore_file=None))
+    assert 11 == len(everything)
+    db = DupFinder.db.create_db(':memory:')
+    DupFinder.fs.update_index(db, '/phonyDir')
+    (_, _, removed) = DupFinder.fs.update_index(
+        db, '/phonyDir', prune=True, scan_filter=scan_filter)
+    assert [] == removed
+    os.remove('/phonyDir/big.txt')
+    (_, _, removed) = DupFinder.fs.update_index(
+        db, '/phonyDir', prune=True, scan_filter=scan_filter)
+    assert ['/phonyDir/big.txt'] == removed
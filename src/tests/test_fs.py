@@ -1,8 +1,15 @@
+import collections
+import concurrent.futures
 import DupFinder.fs
 import DupFinder.db
+import DupFinder.stats
 import os
+import sys
+import threading
+import time
 import pyfakefs
 import pytest
+from unittest import mock
 import xxhash
 
 
@@ -29,6 +36,49 @@ def test_enumerate_directory(fs):
     assert sorted(result) == sorted(expected)
 
 
+def test_enumerate_directory_symlink_loop(fs):
+    """
+    Symlinked directories are followed, but never twice, so loops do not
+    make walker run forever and files are not reported twice.
+    """
+    fs.create_file('/phonyDir/file1')
+    fs.create_file('/phonyDir/dir1/file2')
+    fs.create_symlink('/phonyDir/dir1/loop', '/phonyDir')
+    fs.create_symlink('/phonyDir/link', '/otherDir')
+    fs.create_file('/otherDir/file3')
+    file_list = DupFinder.fs.enumerate_directory('/phonyDir')
+    result = [x.name for x in file_list]
+    assert sorted(['file1', 'file2', 'file3']) == sorted(result)
+
+
+def test_enumerate_directory_errors(tmp_path):
+    """
+    Unreadable directories are skipped and reported to onerror, walk goes on.
+    Not existing start directory gives nothing.
+    """
+    (tmp_path / 'locked').mkdir()
+    (tmp_path / 'locked' / 'file2').write_text('test')
+    (tmp_path / 'dir1').mkdir()
+    (tmp_path / 'dir1' / 'file3').write_text('test')
+    (tmp_path / 'file1').write_text('test')
+    scandir = os.scandir
+
+    def locked_scandir(path):
+        if os.path.basename(path) == 'locked':
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    errors = []
+    with mock.patch('os.scandir', locked_scandir):
+        file_list = list(DupFinder.fs.enumerate_directory(str(tmp_path),
+                                                          errors.append))
+    assert sorted(['file1', 'file3']) == sorted([x.name for x in file_list])
+    assert 1 == len(errors)
+    assert isinstance(errors[0], PermissionError)
+    assert [] == list(DupFinder.fs.enumerate_directory(
+        str(tmp_path / 'notexisting')))
+
+
 def test_index_files(fs):
     """
     Test indexing files in given folder. They should land in database.
@@ -65,6 +115,107 @@ def test_index_files_wo_hashes(fs):
     assert [] == [x for x in r if x['hash'] is not None]
 
 
+def test_update_index(fs):
+    """
+    Second indexing of the same directory hashes only new and changed files
+    and optionally removes entries of deleted files.
+    """
+    fs.create_file('/phonyDir/file1', contents='test1')
+    fs.create_file('/phonyDir/file2', contents='test2')
+    fs.create_file('/phonyDir/dir1/file3', contents='test3')
+    fs.create_file('/phonyDir2/file4', contents='test4')
+    db = DupFinder.db.create_db(":memory:")
+    assert (3, 0, []) == DupFinder.fs.update_index(db, '/phonyDir')
+    DupFinder.fs.update_index(db, '/phonyDir2')
+    # change one, delete one, add one
+    with open('/phonyDir/file1', 'w') as f:
+        f.write('changed')
+    os.utime('/phonyDir/file1', ns=(1, 1))
+    os.remove('/phonyDir/file2')
+    fs.create_file('/phonyDir/dir1/file5', contents='test5')
+    with mock.patch('DupFinder.db.add_items',
+                    wraps=DupFinder.db.add_items) as mock_add:
+        assert (2, 1, []) == DupFinder.fs.update_index(db, '/phonyDir')
+    assert ['file1', 'file5'] == sorted(
+        os.path.basename(f['filepath'])
+        for (args, _) in mock_add.call_args_list for f in args[1])
+    assert 5 == len(db.execute("SELECT * FROM Dupfinder").fetchall())
+    (changed, unchanged, removed) = DupFinder.fs.update_index(
+        db, '/phonyDir', prune=True)
+    assert (0, 3) == (changed, unchanged)
+    assert ['file2'] == [os.path.basename(f) for f in removed]
+    rows = db.execute("SELECT * FROM Dupfinder").fetchall()
+    assert ['file1', 'file3', 'file4', 'file5'] == sorted(
+        os.path.basename(r['filepath']) for r in rows)
+    assert xxhash.xxh64(b'changed').hexdigest() in [r['hash'] for r in rows]
+
+
+@mock.patch('DupFinder.fs.CHECKPOINT_INTERVAL', 0)
+def test_update_index_resume(fs):
+    """
+    Interrupted indexing keeps committed entries and completed directories,
+    resumed one does not walk completed directories again and does not
+    prune their entries.
+    """
+    fs.create_file('/phonyDir/dir1/file1', contents='test1')
+    fs.create_file('/phonyDir/dir1/file2', contents='test2')
+    fs.create_file('/phonyDir/dir2/file3', contents='test3')
+    fs.create_file('/phonyDir/dir3/file4', contents='test4')
+    db = DupFinder.db.create_db(":memory:")
+    add_items = DupFinder.db.add_items
+    calls = []
+
+    def interrupted(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > 4:
+            raise KeyboardInterrupt()
+        add_items(*args, **kwargs)
+
+    with mock.patch('DupFinder.db.add_items', side_effect=interrupted):
+        with pytest.raises(KeyboardInterrupt):
+            DupFinder.fs.update_index(db, '/phonyDir')
+    done = DupFinder.db.get_scan_progress(db, '/phonyDir')
+    assert ['dir1'] == [os.path.basename(os.path.dirname(d)) for d in done]
+    assert 3 == DupFinder.db.count_items(db)
+    with mock.patch('DupFinder.fs.conv_file_to_dict',
+                    wraps=DupFinder.fs.conv_file_to_dict) as mock_conv:
+        (changed, unchanged, removed) = DupFinder.fs.update_index(
+            db, '/phonyDir', prune=True, resume=True)
+    assert 2 == mock_conv.call_count
+    assert (1, 1, []) == (changed, unchanged, removed)
+    assert 4 == DupFinder.db.count_items(db)
+    assert set() == DupFinder.db.get_scan_progress(db, '/phonyDir')
+
+
+@mock.patch('DupFinder.fs.CHECKPOINT_INTERVAL', 0)
+def test_update_index_interrupted_hashing(fs):
+    """
+    Files hashed before indexing was interrupted in the middle of hashing
+    are committed, without waiting for the rest of their chunk.
+    """
+    fs.create_file('/phonyDir/dir1/file1', contents='test1')
+    fs.create_file('/phonyDir/dir1/file2', contents='test2')
+    fs.create_file('/phonyDir/dir2/file3', contents='test3')
+    fs.create_file('/phonyDir/dir2/file4', contents='test4')
+    db = DupFinder.db.create_db(":memory:")
+    hash_entry = DupFinder.fs._hash_entry
+    calls = []
+
+    def interrupted(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > 3:
+            raise KeyboardInterrupt()
+        return hash_entry(*args, **kwargs)
+
+    with mock.patch('DupFinder.fs._hash_entry', side_effect=interrupted):
+        with pytest.raises(KeyboardInterrupt):
+            DupFinder.fs.update_index(db, '/phonyDir')
+    assert 4 == len(calls)
+    assert 3 == DupFinder.db.count_items(db)
+    done = DupFinder.db.get_scan_progress(db, '/phonyDir')
+    assert ['dir1'] == [os.path.basename(os.path.dirname(d)) for d in done]
+
+
 def test_find_two_ident_file(fs):
     """
     Given we have two files, in different folders, first index one file and
@@ -146,11 +297,13 @@ def test_find_duplicates_in_dir(fs):
     fs.create_file('/phonyDir/dir2/this_file_is_duped3', contents='same')
     fs.create_file('/phonyDir/dir2/this_file_is_not_duped', contents='test2')
     # What to expect?
-    exp_duped_files = [  # '/phonyDir/dir1/this_file_is_duped',
+    exp_dup_groups = [[
+        '\\phonyDir\\dir1\\this_file_is_duped',
         '\\phonyDir\\dir1\\this_file_is_duped2',
         '\\phonyDir\\dir1\\dir2\\this_file_is_duped4',
         '\\phonyDir\\dir2\\this_file_is_duped3',
-    ]
+    ]]
+    exp_duped_files = exp_dup_groups[0][1:]
     exp_survived_files = [
         '\\phonyDir\\dir1\\this_file_is_duped',
         '\\phonyDir\\dir1\\this_file_is_not_duped',
@@ -158,26 +311,49 @@ def test_find_duplicates_in_dir(fs):
         '\\phonyDir\\dir2\\this_file_is_not_duped',
     ]
     # Execute!
-    (new_files, dup_files) = DupFinder.fs.FindDupFilesInDirectory('/phonyDir')
-    assert exp_duped_files == dup_files
+    (new_files, dup_groups, linked) = \
+        DupFinder.fs.FindDupFilesInDirectory('/phonyDir')
+    assert exp_dup_groups == dup_groups
+    assert [] == linked
     assert exp_survived_files == new_files
     # dup_files should still be there
-    for f in dup_files:
+    for f in exp_duped_files:
         assert os.path.isfile(f)
     # new_files should be there
     for f in new_files:
         assert os.path.isfile(f)
-    (new_files, dup_files) = DupFinder.fs.FindDupFilesInDirectory('/phonyDir', True)
-    assert exp_duped_files == dup_files
+    (new_files, dup_groups, linked) = DupFinder.fs.FindDupFilesInDirectory(
+        '/phonyDir', True)
+    assert exp_dup_groups == dup_groups
     assert exp_survived_files == new_files
     # dup_files should be deleted
-    for f in dup_files:
+    for f in exp_duped_files:
         assert not os.path.isfile(f)
     # new_files should be there
     for f in new_files:
         assert os.path.isfile(f)
 
 
+def test_group_duplicates(fs):
+    """
+    Files are grouped by content. Only groups with more than one file are
+    returned, in order of their first file, with files in given order.
+    Files of the same size but different content are not grouped.
+    """
+    fs.create_file('/phonyDir/a1', contents='aaaa')
+    fs.create_file('/phonyDir/b1', contents='bb')
+    fs.create_file('/phonyDir/c1', contents='cccc')
+    fs.create_file('/phonyDir/b2', contents='bb')
+    fs.create_file('/phonyDir/a2', contents='aaaa')
+    fs.create_file('/phonyDir/a3', contents='aaaa')
+    fs.create_file('/phonyDir/single', contents='single')
+    files = [DupFinder.fs.conv_file_to_dict(x, False) for x in sorted(
+        DupFinder.fs.enumerate_directory('/phonyDir'), key=lambda e: e.name)]
+    groups = DupFinder.fs.group_duplicates(files)
+    assert [['a1', 'a2', 'a3'], ['b1', 'b2']] == \
+        [[os.path.basename(f['filepath']) for f in g] for g in groups]
+
+
 def test_hash_file(fs):
     """ Test to hash a file
     Cases
@@ -201,6 +377,99 @@ def test_hash_file(fs):
     assert DupFinder.fs.hash_file('/phonyDir/') is None
 
 
+def test_hash_file_chunked(fs):
+    """ Hashing in chunks gives the same digest as hashing whole content
+    Cases
+    -----
+    - Chunk smaller than file, not dividing its size
+    - Chunk bigger than file
+    - Empty file
+    - mmap requested (falls back to reads on fake filesystem)
+    """
+    content = b'0123456789abcdef' * 10 + b'tail'
+    expected = xxhash.xxh64(content).hexdigest()
+    fs.create_file('/phonyDir/testfile', contents=content)
+    fs.create_file('/phonyDir/empty', contents=b'')
+    assert DupFinder.fs.hash_file('/phonyDir/testfile', 7) == expected
+    assert DupFinder.fs.hash_file('/phonyDir/testfile', 4096) == expected
+    assert DupFinder.fs.hash_file(
+        '/phonyDir/empty', 7) == xxhash.xxh64(b'').hexdigest()
+    assert DupFinder.fs.hash_file(
+        '/phonyDir/testfile', 7, use_mmap=True) == expected
+
+
+def test_partial_hash_file(fs):
+    """ Partial hash covers only both ends of the file
+    Cases
+    -----
+    - Files different only in the middle have the same partial hash
+    - Files different at the end have different partial hashes
+    - Small file partial hash equals full hash
+    - Not existing file (should return None)
+    """
+    fs.create_file('/phonyDir/file1', contents=b'a' * 10 + b'x' + b'a' * 10)
+    fs.create_file('/phonyDir/file2', contents=b'a' * 10 + b'y' + b'a' * 10)
+    fs.create_file('/phonyDir/file3', contents=b'a' * 20 + b'z')
+    fs.create_file('/phonyDir/small', contents=b'small')
+    assert DupFinder.fs.partial_hash_file('/phonyDir/file1', 4) == \
+        DupFinder.fs.partial_hash_file('/phonyDir/file2', 4)
+    assert DupFinder.fs.partial_hash_file('/phonyDir/file1', 4) != \
+        DupFinder.fs.partial_hash_file('/phonyDir/file3', 4)
+    assert DupFinder.fs.partial_hash_file('/phonyDir/small') == \
+        DupFinder.fs.hash_file('/phonyDir/small')
+    assert DupFinder.fs.partial_hash_file('notexisting.txt') is None
+
+
+def test_unreadable_file(fs):
+    """
+    File that cannot be read is not hashed (and counted as scan error),
+    indexing and search for duplicates go on with the other files.
+    """
+    fs.create_file('/phonyDir/locked', contents='test')
+    fs.create_file('/phonyDir/file1', contents='test')
+    fs.create_file('/phonyDir/file2', contents='test')
+    real_open = open
+
+    def locked_open(path, *args, **kwargs):
+        if path == '/phonyDir/locked':
+            raise PermissionError(13, 'Permission denied', path)
+        return real_open(path, *args, **kwargs)
+
+    DupFinder.stats.reset()
+    with mock.patch('DupFinder.fs.open', locked_open, create=True):
+        assert DupFinder.fs.hash_file('/phonyDir/locked') is None
+        assert DupFinder.fs.partial_hash_file('/phonyDir/locked') is None
+        db = DupFinder.db.create_db(":memory:")
+        DupFinder.fs.update_index(db, '/phonyDir')
+        (_, dup_groups, _) = DupFinder.fs.FindDupFilesInDirectory(
+            '/phonyDir')
+    assert DupFinder.stats.snapshot()['counters']['scan_errors'] >= 2
+    assert ['/phonyDir/file1', '/phonyDir/file2'] == sorted(
+        entry['filepath'] for entry in DupFinder.db.iterate_items(db))
+    assert [['/phonyDir/file1', '/phonyDir/file2']] == [
+        sorted(g) for g in dup_groups]
+
+
+@mock.patch('DupFinder.fs.PARTIAL_SIZE', 4)
+def test_compare_with_db_partial_hash_rejects(fs):
+    """
+    Same sized file that differs from indexed one in partial hash is new and
+    its full hash is never calculated.
+    """
+    fs.create_file('/phonyDir/dir1/file1', contents='0123456789')
+    fs.create_file('/phonyDir/dir2/file2', contents='0123456780')
+    db = DupFinder.db.create_db(":memory:")
+    DupFinder.db.add_items(
+        db, DupFinder.fs.index_files_in_dir('/phonyDir/dir1'))
+    new_files = DupFinder.fs.index_files_in_dir('/phonyDir/dir2', False)
+    with mock.patch('DupFinder.fs.hash_file') as mock_hash:
+        (non_dup, dup) = DupFinder.fs.compare_with_db(db, new_files)
+        mock_hash.assert_not_called()
+    assert len(non_dup) == 1
+    assert len(dup) == 0
+    assert non_dup[0]['hash'] is None
+
+
 def test_fill_up_hash(fs):
     """ Fills up hash in dictionary
     Cases
@@ -269,3 +538,419 @@ def test_fill_up_hashes(fs):
     DupFinder.fs.fill_up_hashes(lis)
     assert lis[0]['hash'] == xxhash.xxh64('test').hexdigest()
     assert lis[1]['hash'] == xxhash.xxh64('test2').hexdigest()
+
+
+def test_make_executor():
+    """
+    No executor for single job, thread pool by default, process pool on
+    demand.
+    """
+    assert DupFinder.fs.make_executor(1) is None
+    assert DupFinder.fs.make_executor(None) is None
+    with DupFinder.fs.make_executor(2) as executor:
+        assert isinstance(executor, concurrent.futures.ThreadPoolExecutor)
+    with DupFinder.fs.make_executor(2, True) as executor:
+        assert isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+
+
+def test_parallel_hashing(fs):
+    """
+    Hashing with thread pool gives the same results, in the same order, as
+    serial hashing.
+    """
+    for i in range(20):
+        fs.create_file('/phonyDir/file%d' % i, contents='test%d' % (i % 5))
+    fs.create_file('/phonyDir/dir1/file', contents='test0')
+    serial = DupFinder.fs.index_files_in_dir('/phonyDir')
+    with DupFinder.fs.make_executor(4) as executor:
+        parallel = DupFinder.fs.index_files_in_dir('/phonyDir', True, executor)
+        db = DupFinder.db.create_db(":memory:")
+        DupFinder.db.add_items(db, parallel[:5])
+        new_files = DupFinder.fs.index_files_in_dir('/phonyDir', False)
+        (non_dup, dup) = DupFinder.fs.compare_with_db(db, new_files, executor)
+        groups = DupFinder.fs.group_duplicates(
+            DupFinder.fs.index_files_in_dir('/phonyDir', False), executor)
+    assert serial == parallel
+    assert [] == non_dup
+    assert [f['filepath'] for f in new_files] == [f['filepath'] for f in dup]
+    assert [[f['filepath'] for f in g]
+            for g in DupFinder.fs.group_duplicates(serial)] == \
+        [[f['filepath'] for f in g] for g in groups]
+
+
+@mock.patch('DupFinder.fs.COMPARE_BATCH_SIZE', 2)
+def test_iter_files_in_dir(fs):
+    """
+    Streamed files are the same, in the same order, as indexed ones, with or
+    without hashes, and compare_with_db accepts them as a generator, checking
+    them batch by batch.
+    """
+    for i in range(7):
+        fs.create_file('/phonyDir/file%d' % i, contents='test%d' % (i % 3))
+    fs.create_file('/phonyDir/dir1/file', contents='test0')
+    expected = DupFinder.fs.index_files_in_dir('/phonyDir')
+    assert expected == list(DupFinder.fs.iter_files_in_dir('/phonyDir'))
+    with DupFinder.fs.make_executor(3) as executor:
+        assert expected == list(DupFinder.fs.iter_files_in_dir(
+            '/phonyDir', True, executor))
+    streamed = DupFinder.fs.iter_files_in_dir('/phonyDir', False)
+    db = DupFinder.db.create_db(":memory:")
+    DupFinder.db.add_items(db, expected[:2])
+    (non_dup, dup) = DupFinder.fs.compare_with_db(db, streamed)
+    assert sorted(f['filepath'] for f in expected) == \
+        sorted(f['filepath'] for f in non_dup + dup)
+    assert ['file2', 'file5'] == sorted(
+        os.path.basename(f['filepath']) for f in non_dup)
+    assert 6 == len(dup)
+
+
+def test_disk_order():
+    """
+    Files are hashed in order of their device and inode, results get to
+    their entries. With device_jobs no more files of one device are hashed
+    at once, even with more workers.
+    """
+    entries = [{'filepath': 'f%d' % i, 'size': 1, 'hash': None,
+                'device': i % 2, 'inode': 10 - i} for i in range(6)]
+    calls = []
+    lock = threading.Lock()
+    running = collections.Counter()
+    peak = collections.Counter()
+
+    def fake_hash(path, algorithm):
+        device = int(path[1:]) % 2
+        with lock:
+            calls.append(path)
+            running[device] += 1
+            peak[device] = max(peak[device], running[device])
+        time.sleep(0.01)
+        with lock:
+            running[device] -= 1
+        return 'hash of ' + path
+
+    with mock.patch('DupFinder.fs.hash_file', side_effect=fake_hash):
+        DupFinder.fs.fill_up_hashes(entries)
+        assert ['f4', 'f2', 'f0', 'f5', 'f3', 'f1'] == calls
+        assert all(e['hash'] == 'hash of ' + e['filepath'] for e in entries)
+        for e in entries:
+            e['hash'] = None
+        peak.clear()
+        with DupFinder.fs.make_executor(4) as executor:
+            DupFinder.fs.fill_up_hashes(entries, executor, device_jobs=1)
+    assert {0: 1, 1: 1} == peak
+    assert all(e['hash'] == 'hash of ' + e['filepath'] for e in entries)
+
+
+def test_hash_stage_lookahead(fs):
+    """
+    Next chunk of files is hashed while the current one is consumed and hard
+    link in it is not hashed again while its inode is hashed in the current
+    chunk.
+    """
+    for i in range(4):
+        fs.create_file('/phonyDir/f%d' % i, contents='test%d' % i)
+    os.link('/phonyDir/f0', '/phonyDir/l0')
+
+    def entry(name, nlink=1):
+        st = os.stat('/phonyDir/' + name)
+        return (DupFinder.fs.FileEntry('/phonyDir/' + name, st.st_size,
+                                       inode=st.st_ino, device=st.st_dev),
+                nlink)
+
+    scanned = [entry('f0', 2), entry('f1'), entry('f2'), entry('l0', 2),
+               entry('f3')]
+    hash_entry = DupFinder.fs._hash_entry
+    calls = []
+
+    def recorded(item, algorithm):
+        calls.append(os.path.basename(item[0]))
+        return hash_entry(item, algorithm)
+
+    with mock.patch('DupFinder.fs._hash_entry', side_effect=recorded):
+        with DupFinder.fs.make_executor(2) as executor:
+            hashed = DupFinder.fs._hash_stage(scanned, executor, window=3)
+            first = next(hashed)
+            for _ in range(100):
+                if 'f3' in calls:
+                    break
+                time.sleep(0.01)
+            assert 'f3' in calls
+            rest = list(hashed)
+    assert ['f0', 'f1', 'f2', 'l0', 'f3'] == [
+        os.path.basename(e['filepath']) for e in [first] + rest]
+    assert ['f0', 'f1', 'f2', 'f3'] == sorted(calls)
+    assert xxhash.xxh64(b'test0').hexdigest() == rest[2]['hash']
+
+
+def test_algorithms(fs):
+    """
+    Files are hashed with algorithm recorded in database and index can be
+    rehashed with another one.
+    """
+    fs.create_file('/phonyDir/dir1/file1', contents='test')
+    fs.create_file('/phonyDir/dir1/file2', contents='gone')
+    fs.create_file('/phonyDir/dir2/file3', contents='test')
+    assert DupFinder.fs.hash_file('/phonyDir/dir1/file1',
+                                  algorithm='xxh3_128') == \
+        xxhash.xxh3_128(b'test').hexdigest()
+    db = DupFinder.db.create_db(":memory:", 'xxh3_128')
+    DupFinder.fs.update_index(db, '/phonyDir/dir1')
+    assert xxhash.xxh3_128(b'test').hexdigest() in \
+        [r['hash'] for r in DupFinder.db.iterate_items(db)]
+    new_files = DupFinder.fs.index_files_in_dir('/phonyDir/dir2', False)
+    (non_dup, dup) = DupFinder.fs.compare_with_db(db, new_files)
+    assert (0, 1) == (len(non_dup), len(dup))
+    os.remove('/phonyDir/dir1/file2')
+    (rehashed, removed) = DupFinder.fs.rehash_index(db, 'xxh3_64')
+    assert 'xxh3_64' == DupFinder.db.get_algorithm(db)
+    assert [xxhash.xxh3_64(b'test').hexdigest()] == \
+        [r['hash'] for r in DupFinder.db.iterate_items(db)]
+    assert ['file2'] == [os.path.basename(f) for f in removed]
+    new_files = DupFinder.fs.index_files_in_dir('/phonyDir/dir2', False)
+    (non_dup, dup) = DupFinder.fs.compare_with_db(db, new_files)
+    assert (0, 1) == (len(non_dup), len(dup))
+
+
+def test_hardlinks(fs):
+    """
+    Hard links are hashed once, reported as already linked duplicates and
+    real duplicates can be replaced with hard links.
+    """
+    fs.create_file('/phonyDir/file1', contents='same')
+    os.link('/phonyDir/file1', '/phonyDir/link1')
+    fs.create_file('/phonyDir/file2', contents='same')
+    fs.create_file('/phonyDir/file3', contents='diff')
+    fs.create_file('/phonyDir/big', contents='big file')
+    os.link('/phonyDir/big', '/phonyDir/big_link')
+    files = DupFinder.fs.index_files_in_dir('/phonyDir', False)
+    with mock.patch('DupFinder.fs.partial_hash_file',
+                    wraps=DupFinder.fs.partial_hash_file) as mock_hash:
+        DupFinder.fs.fill_up_partial_hashes(files)
+        assert 4 == mock_hash.call_count
+    links = [f for f in files if 'link1' in f['filepath'] or
+             f['filepath'].endswith('file1')]
+    assert links[0]['hash'] == links[1]['hash']
+    with mock.patch('DupFinder.fs.partial_hash_file',
+                    wraps=DupFinder.fs.partial_hash_file) as mock_hash:
+        (new_files, dup_groups, linked) = \
+            DupFinder.fs.FindDupFilesInDirectory('/phonyDir',
+                                                 link_duplicates=True)
+        # big file has no other file of its size than its own link
+        assert 3 == mock_hash.call_count
+    assert 2 == len(dup_groups)
+    assert 2 == len(linked)
+    assert sorted(['big_link', 'link1']) == \
+        sorted(os.path.basename(f) for f in linked)
+    group = [g for g in dup_groups if len(g) == 3][0]
+    assert 1 == len(set(os.stat(f).st_ino for f in group))
+    assert 3 == os.stat(group[0]).st_nlink
+
+
+def test_symlinks_not_hard_links(fs):
+    """
+    Symbolic link to file is neither reported as its hard link nor deleted
+    as its duplicate.
+    """
+    fs.create_file('/phonyDir/real', contents='same')
+    fs.create_symlink('/phonyDir/alias', '/phonyDir/real')
+    (_, dup_groups, linked) = DupFinder.fs.FindDupFilesInDirectory(
+        '/phonyDir', delete_duplicates=True)
+    assert ([], []) == (dup_groups, linked)
+    assert os.path.isfile('/phonyDir/real')
+
+
+def test_link_duplicates_skipped(fs):
+    """
+    Duplicates on other device than kept file are reported as skipped, link
+    left behind by interrupted run does not stop replacing.
+    """
+    fs.add_mount_point('/phonyDir/other')
+    fs.create_file('/phonyDir/file1', contents='same')
+    fs.create_file('/phonyDir/file2', contents='same')
+    fs.create_file('/phonyDir/file2.dupfinder-link', contents='stale')
+    fs.create_file('/phonyDir/other/file3', contents='same')
+    skipped = []
+    (_, dup_groups, _) = DupFinder.fs.FindDupFilesInDirectory(
+        '/phonyDir', link_duplicates=True, onskip=skipped.append)
+    (kept, *duplicates) = dup_groups[0]
+    assert 2 == len(duplicates)
+    assert skipped
+    for path in duplicates:
+        if path in skipped:
+            assert os.stat(path).st_dev != os.stat(kept).st_dev
+        else:
+            assert os.stat(path).st_ino == os.stat(kept).st_ino
+    assert sorted(['file1', 'file2', 'file2.dupfinder-link', 'other']) == \
+        sorted(os.listdir('/phonyDir'))
+
+
+def test_replace_with_link_name_taken(fs):
+    """
+    Temporary name of link that is already taken is replaced with another
+    one.
+    """
+    fs.create_file('/phonyDir/file1', contents='same')
+    fs.create_file('/phonyDir/file2', contents='same')
+    fs.create_file('/phonyDir/.dupfinder-link-%016x' % 1, contents='taken')
+    with mock.patch('random.getrandbits', side_effect=[1, 2]):
+        assert DupFinder.fs.replace_with_link('/phonyDir/file1',
+                                              '/phonyDir/file2')
+    assert os.stat('/phonyDir/file1').st_ino == \
+        os.stat('/phonyDir/file2').st_ino
+    assert sorted(['.dupfinder-link-%016x' % 1, 'file1', 'file2']) == \
+        sorted(os.listdir('/phonyDir'))
+
+
+def test_file_entry():
+    """
+    FileEntry behaves like dictionary with file information, but is smaller
+    and shares directory part of path with other entries.
+    """
+    path = os.path.join('some', 'dir', 'file')
+    entry = DupFinder.fs.FileEntry(path, 42, inode=7)
+    as_dict = {'filepath': path, 'size': 42, 'hash': None,
+               'partial_hash': None, 'mtime': None, 'inode': 7,
+               'device': None}
+    assert as_dict == dict(entry)
+    assert entry['filepath'] == entry.filepath == path
+    entry['hash'] = 'abc'
+    assert 'abc' == entry.hash
+    assert 'hash' in entry
+    assert entry.get('marked') is None
+    with pytest.raises(KeyError):
+        entry['marked']
+    with pytest.raises(KeyError):
+        entry['marked'] = True
+    other = DupFinder.fs.FileEntry(os.path.join('some', 'dir', 'other'), 1)
+    assert entry.directory is other.directory
+    assert entry != other
+    assert DupFinder.fs.FileEntry(path, 42, 'abc', inode=7) == entry
+    assert sys.getsizeof(entry) < sys.getsizeof(as_dict)
+
+
+@mock.patch('DupFinder.fs.LOCKSTEP_MAX_FILES', 4)
+def test_compare_bytes(fs):
+    """
+    Files are compared byte by byte in lockstep, reading stops at first
+    difference. Small groups are not hashed at all, bigger ones are
+    narrowed down by hashes first. Hard links are read once.
+    """
+    chunk = DupFinder.fs.LOCKSTEP_CHUNK_SIZE
+    fs.create_file('/phonyDir/a1', contents='a' * (3 * chunk))
+    fs.create_file('/phonyDir/a2', contents='a' * (3 * chunk))
+    fs.create_file('/phonyDir/b1', contents='b' + 'a' * (3 * chunk - 1))
+    fs.create_file('/phonyDir/c1', contents='a' * (3 * chunk - 1) + 'c')
+    os.link('/phonyDir/a1', '/phonyDir/a3')
+    paths = ['/phonyDir/a1', '/phonyDir/b1', '/phonyDir/a2', '/phonyDir/c1',
+             '/phonyDir/missing']
+    assert [[0, 2]] == DupFinder.fs.compare_files(paths)
+    for i in range(5):
+        fs.create_file('/phonyDir/d%d' % i, contents='dd%d' % (i % 2))
+    files = [DupFinder.fs.conv_file_to_dict(x, False) for x in sorted(
+        DupFinder.fs.enumerate_directory('/phonyDir'), key=lambda e: e.name)]
+    with mock.patch('DupFinder.fs.partial_hash_file',
+                    side_effect=DupFinder.fs.partial_hash_file) as mock_hash:
+        groups = DupFinder.fs.group_duplicates(files, compare_bytes=True)
+        # only d files, of which there are too many to compare right away
+        assert 5 == mock_hash.call_count
+    assert [['a1', 'a2', 'a3'], ['d0', 'd2', 'd4'], ['d1', 'd3']] == \
+        [[os.path.basename(f['filepath']) for f in g] for g in groups]
+    assert [[f['filepath'] for f in g] for g in groups] == \
+        [[f['filepath'] for f in g]
+         for g in DupFinder.fs.group_duplicates(files)]
+
+
+@mock.patch('DupFinder.fs.LOCKSTEP_MAX_FILES', 4)
+def test_compare_bytes_big_group(fs):
+    """
+    Groups still too big to be compared at once after hashing are compared
+    in batches against their first file, so colliding hashes are caught.
+    Files that differ from the first one are compared among themselves.
+    """
+    for i in range(7):
+        fs.create_file('/phonyDir/e%d' % i, contents='e%d' % (i // 5))
+    for i in range(5):
+        fs.create_file('/phonyDir/f%d' % i, contents='f%d' % (i % 2))
+    files = [DupFinder.fs.conv_file_to_dict(x, False) for x in sorted(
+        DupFinder.fs.enumerate_directory('/phonyDir'), key=lambda e: e.name)]
+
+    def colliding(path, *args, **kwargs):
+        return os.path.basename(path)[0] * 16
+
+    with mock.patch('DupFinder.fs.partial_hash_file',
+                    side_effect=colliding):
+        assert [['e0', 'e1', 'e2', 'e3', 'e4', 'e5', 'e6'],
+                ['f0', 'f1', 'f2', 'f3', 'f4']] == \
+            [[os.path.basename(f['filepath']) for f in g]
+             for g in DupFinder.fs.group_duplicates(files)]
+        for f in files:
+            f['partial_hash'] = f['hash'] = None
+        with mock.patch('DupFinder.fs.compare_files',
+                        wraps=DupFinder.fs.compare_files) as mock_compare:
+            groups = DupFinder.fs.group_duplicates(files, compare_bytes=True)
+    assert [['e0', 'e1', 'e2', 'e3', 'e4'], ['e5', 'e6'],
+            ['f0', 'f2', 'f4'], ['f1', 'f3']] == \
+        [[os.path.basename(f['filepath']) for f in g] for g in groups]
+    assert all(len(args[0]) <= 4 for (args, _) in mock_compare.call_args_list)
+
+
+def test_verify_index(fs):
+    """
+    Missing, changed, unhashed entries and entries of files modified without
+    change of metadata (found by rehashing) are reported, and fixed on
+    request.
+    """
+    for i in range(5):
+        fs.create_file('/phonyDir/file%d' % i, contents='test%d' % i)
+    db = DupFinder.db.create_db(":memory:")
+    DupFinder.fs.update_index(db, '/phonyDir')
+    os.remove('/phonyDir/file0')
+    with open('/phonyDir/file1', 'w') as f:
+        f.write('changed')
+    st = os.stat('/phonyDir/file2')
+    with open('/phonyDir/file2', 'w') as f:
+        f.write('test9')
+    os.utime('/phonyDir/file2', ns=(st.st_atime_ns, st.st_mtime_ns))
+    db.execute("UPDATE Files SET hash = NULL WHERE name = 'file3'")
+    expected = (['/phonyDir/file0'], ['/phonyDir/file1'],
+                ['/phonyDir/file3'], [])
+    assert expected == DupFinder.fs.verify_index(db)
+    expected = expected[:3] + (['/phonyDir/file2'],)
+    with DupFinder.fs.make_executor(2) as executor:
+        assert expected == DupFinder.fs.verify_index(db, executor, 1.0)
+    assert expected == DupFinder.fs.verify_index(db, rehash=1.0, fix=True)
+    assert ([], [], [], []) == DupFinder.fs.verify_index(db, rehash=1.0)
+    assert 4 == DupFinder.db.count_items(db)
+    DupFinder.db.analyze_db(db)
+    DupFinder.db.vacuum_db(db)
+
+
+@mock.patch('DupFinder.fs.VERIFY_BATCH_SIZE', 2)
+def test_verify_index_batches(fs):
+    """
+    Entries are hashed and fixed batch by batch, entry of file that
+    disappeared while being hashed is reported only as missing.
+    """
+    for i in range(5):
+        fs.create_file('/phonyDir/file%d' % i, contents='test%d' % i)
+    db = DupFinder.db.create_db(":memory:")
+    DupFinder.fs.update_index(db, '/phonyDir')
+    for i in (1, 3, 4):
+        with open('/phonyDir/file%d' % i, 'w') as f:
+            f.write('changed%d' % i)
+    fill_up_partial_hashes = DupFinder.fs.fill_up_partial_hashes
+
+    def vanishing(entries, *args, **kwargs):
+        if any(e['filepath'] == '/phonyDir/file3' for e in entries):
+            os.remove('/phonyDir/file3')
+        return fill_up_partial_hashes(entries, *args, **kwargs)
+
+    with mock.patch('DupFinder.fs.fill_up_partial_hashes',
+                    side_effect=vanishing), \
+            mock.patch('DupFinder.db.add_items',
+                       wraps=DupFinder.db.add_items) as mock_add:
+        assert (['/phonyDir/file3'], ['/phonyDir/file1', '/phonyDir/file4'],
+                [], []) == DupFinder.fs.verify_index(db, fix=True)
+    assert 3 == mock_add.call_count
+    assert ([], [], [], []) == DupFinder.fs.verify_index(db, rehash=1.0)
+    assert 4 == DupFinder.db.count_items(db)
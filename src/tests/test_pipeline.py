@@ -0,0 +1,45 @@
+import DupFinder.pipeline
+import pytest
+import threading
+
+
+def test_background():
+    """
+    Items are passed in order, at most maxsize ahead of consumer, and errors
+    of producer are raised in consumer.
+    """
+    produced = []
+
+    def numbers():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    items = DupFinder.pipeline.background(numbers(), 2)
+    assert 0 == next(items)
+    # one item taken, two waiting in queue and one blocked on put
+    assert len(produced) <= 4
+    assert list(range(1, 10)) == list(items)
+
+    def failing():
+        yield 1
+        raise ValueError('walker failed')
+
+    items = DupFinder.pipeline.background(failing())
+    assert 1 == next(items)
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_background_stops_producer():
+    """
+    Producer thread ends when consumer stops iterating.
+    """
+    def endless():
+        while True:
+            yield threading.current_thread()
+
+    items = DupFinder.pipeline.background(endless(), 1)
+    thread = next(items)
+    items.close()
+    assert not thread.is_alive()
@@ -0,0 +1,60 @@
+import DupFinder.fs
+import DupFinder.db
+import DupFinder.stats
+import io
+import json
+import time
+from unittest import mock
+
+
+def test_stats(fs):
+    """
+    Stages of indexing and comparing are counted.
+    """
+    fs.create_file('/phonyDir/dir1/file1', contents='same')
+    fs.create_file('/phonyDir/dir1/file2', contents='other')
+    fs.create_file('/phonyDir/dir2/file3', contents='same')
+    fs.create_file('/phonyDir/dir2/file4', contents='unique size')
+    fs.create_file('/phonyDir/dir2/file5', contents='diff')
+    DupFinder.stats.reset()
+    db = DupFinder.db.create_db(":memory:")
+    DupFinder.fs.update_index(db, '/phonyDir/dir1')
+    counters = DupFinder.stats.snapshot()['counters']
+    assert 2 == counters['entries_scanned']
+    assert 2 == counters['rows_inserted']
+    assert 2 == counters['partial_hashes']
+    assert 9 == counters['bytes_hashed']
+    DupFinder.stats.reset()
+    files = DupFinder.fs.iter_files_in_dir('/phonyDir/dir2', False)
+    DupFinder.fs.compare_with_db(db, files)
+    stats = DupFinder.stats.snapshot()
+    counters = stats['counters']
+    assert 3 == counters['entries_scanned']
+    assert 3 == counters['files_done']
+    assert 1 == counters['rejected_by_size']
+    assert 1 == counters['rejected_by_partial_hash']
+    assert 0 == counters['rejected_by_hash']
+    assert counters['db_queries'] > 0
+    assert stats['seconds']['db'] > 0
+    # statistics can be saved as JSON
+    assert stats == json.loads(json.dumps(stats))
+    assert 'entries_scanned: 3' in DupFinder.stats.format_stats(stats)
+
+
+def test_progress():
+    """
+    Progress line shows throughput and time left of files found so far.
+    """
+    stats = {'elapsed': 10.0, 'seconds': {},
+             'counters': {'entries_scanned': 300, 'files_done': 100,
+                          'bytes_hashed': 20 * 1024 * 1024}}
+    assert '300 files found, 100 done (10.0 files/s), 20.0 MB hashed ' \
+        '(2.0 MB/s), ETA 0:00:20' == DupFinder.stats.format_progress(stats)
+    out = io.StringIO()
+    with DupFinder.stats.Progress(0.01, out):
+        with mock.patch('DupFinder.stats.snapshot', return_value=stats):
+            for _ in range(100):
+                if out.getvalue():
+                    break
+                time.sleep(0.01)
+    assert 'ETA 0:00:20' in out.getvalue()
@@ -0,0 +1,175 @@
+import DupFinder.db
+import DupFinder.fs
+import DupFinder.watch
+import json
+import os
+import sys
+import threading
+import time
+import pytest
+from unittest import mock
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'),
+                                reason='inotify is Linux only')
+
+
+def _poll_until(watcher, condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        watcher.poll(0.1)
+    return condition()
+
+
+@mock.patch('DupFinder.watch.SETTLE_TIME', 0)
+def test_watcher(tmp_path):
+    """
+    Files created, modified and deleted in watched directory are indexed
+    and forgotten as they change. Duplicates are told from in-memory map,
+    file is not a duplicate of its own entry.
+    """
+    watched = tmp_path / 'watched'
+    (watched / 'sub').mkdir(parents=True)
+    (watched / 'sub' / 'a').write_text('aaaa')
+    (tmp_path / 'copy').write_text('aaaa')
+    (tmp_path / 'other').write_text('bbbb')
+    db_file = str(tmp_path / 'test.db')
+    db = DupFinder.db.create_db(db_file)
+    watcher = DupFinder.watch.Watcher(db, str(watched))
+    watcher.start()
+    assert watcher.check(str(tmp_path / 'copy'))
+    assert not watcher.check(str(tmp_path / 'other'))
+    assert not watcher.check(str(watched / 'sub' / 'a'))
+    (watched / 'new').mkdir()
+    (watched / 'new' / 'b').write_text('bbbb')
+    assert _poll_until(watcher, lambda: watcher.check(
+        str(tmp_path / 'other')))
+    assert 2 == DupFinder.db.count_items(db)
+    (watched / 'sub' / 'a').write_text('cccc')
+    assert _poll_until(watcher, lambda: not watcher.check(
+        str(tmp_path / 'copy')))
+    os.remove(watched / 'new' / 'b')
+    os.rmdir(watched / 'new')
+    assert _poll_until(watcher, lambda: not watcher.check(
+        str(tmp_path / 'other')))
+    assert [str(watched / 'sub' / 'a')] == [
+        row['filepath'] for row in DupFinder.db.iterate_items(db)]
+    watcher.close()
+    db.close()
+
+
+@mock.patch('DupFinder.watch.SETTLE_TIME', 0)
+def test_watcher_socket(tmp_path):
+    """
+    Queries are answered over Unix socket, by path or by size and hash.
+    """
+    (tmp_path / 'watched').mkdir()
+    (tmp_path / 'watched' / 'a').write_text('aaaa')
+    (tmp_path / 'copy').write_text('aaaa')
+    db = DupFinder.db.create_db(str(tmp_path / 'test.db'))
+    watcher = DupFinder.watch.Watcher(db, str(tmp_path / 'watched'))
+    watcher.start()
+    (entry,) = DupFinder.db.iterate_items(db)
+    socket_path = str(tmp_path / 'sock')
+    answers = []
+
+    def client():
+        try:
+            deadline = time.monotonic() + 5
+            while not os.path.exists(socket_path) and \
+                    time.monotonic() < deadline:
+                time.sleep(0.01)
+            for request in [{'path': str(tmp_path / 'copy')},
+                            {'size': 4, 'hash': entry['hash']},
+                            {'size': 5, 'hash': entry['hash']},
+                            {'path': str(tmp_path / 'missing')}]:
+                answers.append(DupFinder.watch.query(socket_path, request))
+        finally:
+            watcher.stop()
+
+    # Database is used by thread that created it, queries come from another.
+    thread = threading.Thread(target=client)
+    thread.start()
+    watcher.serve(socket_path)
+    thread.join()
+    assert [{'duplicate': True}, {'duplicate': True},
+            {'duplicate': False}] == answers[:3]
+    assert 'error' in answers[3]
+    assert not os.path.exists(socket_path)
+    watcher.close()
+    db.close()
+
+
+def test_watcher_partial_hash_first(tmp_path):
+    """
+    File of indexed size is hashed whole only if its partial hash matches
+    an entry.
+    """
+    size = 3 * DupFinder.fs.PARTIAL_SIZE
+    (tmp_path / 'watched').mkdir()
+    (tmp_path / 'watched' / 'a').write_text('a' * size)
+    (tmp_path / 'copy').write_text('a' * size)
+    (tmp_path / 'other').write_text('b' * size)
+    db = DupFinder.db.create_db(str(tmp_path / 'test.db'))
+    watcher = DupFinder.watch.Watcher(db, str(tmp_path / 'watched'))
+    watcher.start()
+    with mock.patch('DupFinder.fs.hash_file',
+                    wraps=DupFinder.fs.hash_file) as mock_hash:
+        assert not watcher.check(str(tmp_path / 'other'))
+        mock_hash.assert_not_called()
+        assert watcher.check(str(tmp_path / 'copy'))
+        assert 1 == mock_hash.call_count
+    watcher.close()
+    db.close()
+
+
+def test_watcher_client_gone(tmp_path):
+    """
+    Connection of client that went away is closed, without stopping the
+    daemon.
+    """
+    (tmp_path / 'watched').mkdir()
+    db = DupFinder.db.create_db(str(tmp_path / 'test.db'))
+    watcher = DupFinder.watch.Watcher(db, str(tmp_path / 'watched'))
+    for error in ['recv', 'sendall']:
+        conn = mock.Mock()
+        conn.recv.return_value = b'{"size": 1, "hash": "00"}\n'
+        getattr(conn, error).side_effect = BrokenPipeError()
+        selector = mock.Mock()
+        buffers = {conn: b''}
+        watcher._on_client(selector, conn, buffers)
+        selector.unregister.assert_called_once_with(conn)
+        conn.close.assert_called_once_with()
+        assert {} == buffers
+    watcher.close()
+    db.close()
+
+
+def test_watcher_malformed_requests(tmp_path):
+    """
+    Request with values of wrong type is answered with error and the
+    daemon still answers following requests.
+    """
+    (tmp_path / 'watched').mkdir()
+    (tmp_path / 'watched' / 'a').write_text('aaaa')
+    db = DupFinder.db.create_db(str(tmp_path / 'test.db'))
+    watcher = DupFinder.watch.Watcher(db, str(tmp_path / 'watched'))
+    watcher.start()
+    (entry,) = DupFinder.db.iterate_items(db)
+    conn = mock.Mock()
+    conn.recv.return_value = b'\n'.join(
+        [b'{"size": [1]}', b'{"size": 5, "hash": ["x"]}',
+         b'{"path": null, "size": 5, "hash": {}}', b'{"path": 3}',
+         b'[]', b'{"size": true, "hash": "00"}',
+         ('{"size": 4, "hash": "%s"}' % entry['hash']).encode(), b''])
+    buffers = {conn: b''}
+    with mock.patch('os.stat', wraps=os.stat) as mock_stat:
+        watcher._on_client(mock.Mock(), conn, buffers)
+        mock_stat.assert_not_called()
+    answers = [json.loads(args[0]) for (args, _) in
+               conn.sendall.call_args_list]
+    assert 7 == len(answers)
+    assert all('error' in answer for answer in answers[:6])
+    assert {'duplicate': True} == answers[6]
+    conn.close.assert_not_called()
+    watcher.close()
+    db.close()